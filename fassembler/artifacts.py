@@ -0,0 +1,389 @@
+"""
+Downloading and unpacking tarballs in one pass, keeping a copy of
+each tarball in a local cache.
+
+``Maker.unpack_tarball`` reads the tarball straight from the HTTP
+response with ``tarfile`` (in stream mode), so nothing is written to
+disk but the unpacked files -- and, as it goes, a copy of the tarball
+in the ``ArtifactCache``.  The next time the same URL is unpacked the
+copy is used instead (if its checksum still matches).
+
+The cache is kept in ``var/artifacts/`` (or wherever the
+``artifact_cache`` setting in ``[general]`` points)::
+
+    ab/abcdef.../OpenplansZope-2.9.8-0.tar.bz2
+    ab/abcdef.../OpenplansZope-2.9.8-0.tar.bz2.sha1
+
+where ``abcdef...`` is the sha1 of the URL, and the ``.sha1`` file
+has the sha1 of the tarball's content.
+
+A tarball can also be unpacked incrementally (``update_stream``): a
+manifest of what was unpacked is kept in the destination directory,
+and the next time only the files whose content changed are written,
+and files that are no longer in the tarball are removed.
+"""
+
+import os
+import shutil
+import tarfile
+from fassembler import parallelbz2
+from fassembler.util import sha1
+
+class ArtifactCache(object):
+    """
+    The cache of downloaded tarballs in the directory ``path``.
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+
+    def filename(self, url):
+        key = sha1(url).hexdigest()
+        return os.path.join(self.path, key[:2], key, os.path.basename(url.split('#', 1)[0]))
+
+    def lookup(self, url, checksum=None):
+        """
+        Returns the filename of the cached copy of ``url``, or None if
+        there isn't one, or its content doesn't match the checksum it
+        was stored with (or ``checksum``, if given).
+        """
+        filename = self.filename(url)
+        if not os.path.exists(filename) or not os.path.exists(filename + '.sha1'):
+            return None
+        f = open(filename + '.sha1')
+        stored = f.read().strip()
+        f.close()
+        digest = file_sha1(filename)
+        if digest != stored or (checksum and digest != checksum):
+            self.logger.warn('Cached copy %s of %s is damaged or out of date; removing it'
+                             % (filename, url))
+            self.remove(url)
+            return None
+        return filename
+
+    def start(self, url):
+        """
+        Returns ``(tmp_filename, file)``, the file to write a new copy
+        of ``url`` to; pass the filename to ``commit`` or ``abort``
+        afterwards.
+        """
+        filename = self.filename(url)
+        dir = os.path.dirname(filename)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        tmp_filename = '%s.tmp-%s' % (filename, os.getpid())
+        return tmp_filename, open(tmp_filename, 'wb')
+
+    def commit(self, url, tmp_filename, digest):
+        filename = self.filename(url)
+        os.rename(tmp_filename, filename)
+        f = open(filename + '.sha1', 'w')
+        f.write(digest + '\n')
+        f.close()
+        self.logger.info('Stored a copy of %s in %s' % (url, filename))
+
+    def abort(self, tmp_filename):
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+
+    def remove(self, url):
+        filename = self.filename(url)
+        for name in filename, filename + '.sha1':
+            if os.path.exists(name):
+                os.unlink(name)
+
+class DownloadStream(object):
+    """
+    A file-like object reading from ``fileobj`` (like an HTTP
+    response) that computes the sha1 of what is read, and copies it
+    to ``copy`` (another file) if given.
+    """
+
+    def __init__(self, fileobj, copy=None):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.digest = sha1()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        self.bytes += len(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        return data
+
+    def finish(self):
+        """
+        Reads whatever is left (tarfile stops at the end of the
+        archive, before the end of the file), closes everything, and
+        returns the sha1 of the content.
+        """
+        while self.read(65536):
+            pass
+        self.fileobj.close()
+        if self.copy is not None:
+            self.copy.close()
+        return self.digest.hexdigest()
+
+    def close(self):
+        self.fileobj.close()
+        if self.copy is not None:
+            self.copy.close()
+
+def file_sha1(filename):
+    digest = sha1()
+    f = open(filename, 'rb')
+    while 1:
+        chunk = f.read(65536)
+        if not chunk:
+            break
+        digest.update(chunk)
+    f.close()
+    return digest.hexdigest()
+
+def safe_members(tar, dest_dir, logger):
+    """
+    Yields the members of the (streamed) tarfile, leaving out any
+    that would be written outside of ``dest_dir``.
+    """
+    dest_dir = os.path.abspath(dest_dir)
+    for member in tar:
+        path = os.path.abspath(os.path.join(dest_dir, member.name))
+        if path != dest_dir and not path.startswith(dest_dir + os.path.sep):
+            logger.warn('Not unpacking %s (it is outside of %s)' % (member.name, dest_dir))
+            continue
+        yield member
+
+def extract_stream(fileobj, dest_dir, logger, jobs=None):
+    """
+    Unpacks the tarball (compressed with gzip or bzip2, or not at
+    all) read from ``fileobj`` into ``dest_dir``, reading it just
+    once, from start to end.  Returns the number of members.
+
+    bzip2 is decompressed with ``jobs`` processes (see
+    ``fassembler.parallelbz2``).
+    """
+    stream = parallelbz2.open_stream(fileobj, jobs)
+    try:
+        tar = tarfile.open(fileobj=stream, mode='r|*')
+        count = [0]
+        def members():
+            for member in safe_members(tar, dest_dir, logger):
+                count[0] += 1
+                yield member
+        try:
+            if hasattr(tar, 'extractall'):
+                tar.extractall(dest_dir, members=members())
+            else:
+                # Python 2.4
+                for member in members():
+                    tar.extract(member, dest_dir)
+        finally:
+            tar.close()
+    finally:
+        stream.close()
+    return count[0]
+
+# The manifest update_stream keeps in the destination directory:
+manifest_filename = '.fassembler-manifest.txt'
+
+# Files up to this size are held in memory while checking if they
+# changed; larger files are written to a temporary file:
+buffer_size = 1024*1024
+
+def read_manifest(dest_dir):
+    """
+    Reads the manifest in ``dest_dir``, returning ``{path: (size,
+    sha1)}`` (``sha1`` is ``'symlink'`` for symlinks); empty if there
+    is no manifest.
+    """
+    filename = os.path.join(dest_dir, manifest_filename)
+    result = {}
+    if not os.path.exists(filename):
+        return result
+    f = open(filename)
+    try:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            digest, size, path = line.split(' ', 2)
+            result[path] = (int(size), digest)
+    finally:
+        f.close()
+    return result
+
+def write_manifest(dest_dir, manifest):
+    filename = os.path.join(dest_dir, manifest_filename)
+    tmp_filename = '%s.tmp-%s' % (filename, os.getpid())
+    f = open(tmp_filename, 'w')
+    f.write('# The files unpacked here by fassembler: sha1 size path\n')
+    for path in sorted(manifest):
+        size, digest = manifest[path]
+        f.write('%s %s %s\n' % (digest, size, path))
+    f.close()
+    os.rename(tmp_filename, filename)
+
+def member_path(member):
+    """
+    The normalized (relative) path of a tarball member.
+    """
+    path = os.path.normpath(member.name)
+    if path == '.':
+        return ''
+    return path
+
+def update_stream(fileobj, dest_dir, logger, jobs=None):
+    """
+    Like ``extract_stream``, but only writes the files whose content
+    differs from what is in ``dest_dir`` already, and removes the files
+    that were unpacked there the last time but are not in the tarball
+    anymore (unless they were changed since; those are left in place,
+    with a warning).  Returns the number of members.
+
+    A file is taken to be unchanged on disk if it has the size
+    recorded in the manifest; files that aren't in the manifest are
+    read to compare them.
+    """
+    dest_dir = os.path.abspath(dest_dir)
+    old = read_manifest(dest_dir)
+    new = {}
+    written = []
+    count = 0
+    stream = parallelbz2.open_stream(fileobj, jobs)
+    try:
+        tar = tarfile.open(fileobj=stream, mode='r|*')
+        try:
+            for member in safe_members(tar, dest_dir, logger):
+                count += 1
+                path = member_path(member)
+                target = os.path.join(dest_dir, path)
+                if member.isfile():
+                    digest, changed = update_file(tar, member, target, old.get(path))
+                    new[path] = (member.size, digest)
+                    if changed:
+                        written.append(path)
+                elif member.issym():
+                    new[path] = (0, 'symlink')
+                    if os.path.islink(target) and os.readlink(target) == member.linkname:
+                        continue
+                    if os.path.lexists(target):
+                        os.unlink(target)
+                    tar.extract(member, dest_dir)
+                    written.append(path)
+                elif member.isdir():
+                    if not os.path.isdir(target):
+                        tar.extract(member, dest_dir)
+                else:
+                    # Hard links and special files
+                    tar.extract(member, dest_dir)
+        finally:
+            tar.close()
+    finally:
+        stream.close()
+    removed, kept = remove_old_files(dest_dir, old, new)
+    write_manifest(dest_dir, new)
+    logger.notify('%s of %s files changed; %s files removed'
+                  % (len(written), len(new), len(removed)))
+    for path in written:
+        logger.info('Updated %s' % path)
+    for path in removed:
+        logger.info('Removed %s' % path)
+    if kept:
+        logger.warn('Files that are no longer in the tarball, but were changed locally '
+                    'and so were not removed:\n  %s' % '\n  '.join(kept))
+    return count
+
+def update_file(tar, member, target, recorded):
+    """
+    Writes the content of ``member`` to ``target``, unless ``target``
+    has that content already.  ``recorded`` is ``(size, sha1)`` from
+    the manifest (or None).  Returns ``(sha1, written)``.
+    """
+    disk_digest = None
+    if (os.path.isfile(target) and not os.path.islink(target)
+        and os.path.getsize(target) == member.size):
+        if recorded is not None and recorded[0] == member.size:
+            disk_digest = recorded[1]
+        else:
+            disk_digest = file_sha1(target)
+    dir = os.path.dirname(target)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    tmp_filename = '%s.tmp-%s' % (target, os.getpid())
+    out = None
+    if disk_digest is None or member.size > buffer_size:
+        out = open(tmp_filename, 'wb')
+    chunks = []
+    digest = sha1()
+    source = tar.extractfile(member)
+    try:
+        try:
+            while 1:
+                chunk = source.read(65536)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if out is None:
+                    chunks.append(chunk)
+                else:
+                    out.write(chunk)
+        finally:
+            if out is not None:
+                out.close()
+    except:
+        if out is not None and os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    digest = digest.hexdigest()
+    if digest == disk_digest:
+        if out is not None:
+            os.unlink(tmp_filename)
+        return digest, False
+    if out is None:
+        out = open(tmp_filename, 'wb')
+        out.write(''.join(chunks))
+        out.close()
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    os.rename(tmp_filename, target)
+    os.chmod(target, member.mode & 07777)
+    os.utime(target, (member.mtime, member.mtime))
+    return digest, True
+
+def remove_old_files(dest_dir, old, new):
+    """
+    Removes the files in the ``old`` manifest that aren't in the
+    ``new`` one, if they haven't been changed.  Returns ``(removed,
+    kept)``, lists of paths.
+    """
+    removed = []
+    kept = []
+    for path in sorted(old):
+        if path in new:
+            continue
+        size, digest = old[path]
+        target = os.path.join(dest_dir, path)
+        if digest == 'symlink':
+            if os.path.islink(target):
+                os.unlink(target)
+                removed.append(path)
+            continue
+        if not os.path.isfile(target) or os.path.islink(target):
+            continue
+        if os.path.getsize(target) != size or file_sha1(target) != digest:
+            kept.append(path)
+            continue
+        os.unlink(target)
+        removed.append(path)
+        # Remove the directories this leaves empty:
+        dir = os.path.dirname(target)
+        while dir != dest_dir and dir.startswith(dest_dir + os.path.sep):
+            try:
+                os.rmdir(dir)
+            except OSError:
+                break
+            dir = os.path.dirname(dir)
+    return removed, kept
@@ -0,0 +1,201 @@
+"""
+Keeps track of what earlier builds did, so that work that was
+already done can be skipped.
+
+The state is kept in ``var/fassembler/build-state.txt``, with one
+record per line::
+
+    kind<TAB>project<TAB>key<TAB>value
+
+There are two kinds of records:
+
+``fingerprint``:
+    The fingerprint (see ``fingerprint_task``) each incremental task
+    had the last time it ran successfully.
+
+``checkpoint``:
+    The signature (see ``signature_hash``) of each task that has
+    completed since the project was last started from the beginning,
+    used by ``--resume``.
+"""
+
+import os
+from fassembler.util import sha1
+
+class BuildState(object):
+    """
+    The records from ``filename``.  Changes are kept in memory until
+    ``save()`` is called.
+    """
+
+    def __init__(self, filename, maker, logger):
+        self.filename = filename
+        self.maker = maker
+        self.logger = logger
+        self.records = None
+        self.changed = {}
+
+    def get(self, kind, project, key):
+        """
+        Returns the value recorded for the key, or None.
+        """
+        if self.records is None:
+            self.records = self.read()
+        return self.records.get((kind, project, clean_field(key)))
+
+    def set(self, kind, project, key, value):
+        """
+        Records a value; a value of None removes the record.
+        """
+        if self.records is None:
+            self.records = self.read()
+        record = (kind, project, clean_field(key))
+        if value is None:
+            self.records.pop(record, None)
+        else:
+            self.records[record] = value
+        self.changed[record] = value
+
+    def clear(self, kind, project):
+        """
+        Removes all the records of one kind for the project.
+        """
+        if self.records is None:
+            self.records = self.read()
+        for record in self.records.keys():
+            if record[:2] == (kind, project):
+                self.set(kind, project, record[2], None)
+
+    def read(self):
+        records = {}
+        if not os.path.exists(self.filename):
+            return records
+        f = open(self.filename)
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split('\t')
+            if len(parts) != 4:
+                self.logger.debug('Bad line in %s: %r' % (self.filename, line))
+                continue
+            records[tuple(parts[:3])] = parts[3]
+        f.close()
+        return records
+
+    def save(self):
+        """
+        Writes the changes to the file.  Records written by other
+        processes since the file was read are kept.
+        """
+        if not self.changed or self.maker.simulate:
+            return
+        lock = self.maker.process_lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            records = self.read()
+            for record, value in self.changed.items():
+                if value is None:
+                    records.pop(record, None)
+                else:
+                    records[record] = value
+            dir = os.path.dirname(self.filename)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            lines = ['\t'.join(record + (value,)) + '\n'
+                     for record, value in sorted(records.items())]
+            tmp_filename = self.filename + '.tmp'
+            f = open(tmp_filename, 'w')
+            f.write('# Written by fassembler; delete to rebuild everything\n')
+            f.writelines(lines)
+            f.close()
+            os.rename(tmp_filename, self.filename)
+            self.records = records
+            self.changed = {}
+        finally:
+            if lock is not None:
+                lock.release()
+
+def clean_field(value):
+    """
+    Makes a value safe to use as a field of a record.
+    """
+    for char in '\t\r\n':
+        value = value.replace(char, ' ')
+    return value
+
+def signature_hash(task):
+    """
+    Returns a hash of the (bound) task's signature, or None if it
+    can't be determined.
+    """
+    try:
+        signature = task.signature()
+    except Exception, e:
+        task.logger.debug('Cannot get the signature of task %s: %s' % (task.name, e))
+        return None
+    digest = sha1()
+    hash_lines(digest, signature)
+    return digest.hexdigest()
+
+def fingerprint_task(task, previous):
+    """
+    Returns the fingerprint of a (bound) task: a hash of its
+    signature, of the content of the files it reads, of what it
+    computes from the settings (``task.fingerprint_data()``, like
+    filled-in templates), and of ``previous`` (the fingerprint of the
+    task before it).  Because
+    of that last part a task's fingerprint changes whenever an
+    earlier task in the project changes.
+
+    Returns None if the task's signature can't be determined.
+    """
+    try:
+        signature = task.signature()
+        paths = task.fingerprint_files()
+        data = task.fingerprint_data()
+    except Exception, e:
+        task.logger.debug('Cannot fingerprint task %s: %s' % (task.name, e))
+        return None
+    digest = sha1()
+    digest.update(previous)
+    hash_lines(digest, signature)
+    for path in paths:
+        hash_path(digest, task.maker.path(path))
+    for value in data:
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        digest.update('data %s\n' % len(value))
+        digest.update(value)
+    return digest.hexdigest()
+
+def hash_lines(digest, lines):
+    for line in lines:
+        if isinstance(line, unicode):
+            line = line.encode('utf8')
+        digest.update(line + '\n')
+
+def hash_path(digest, path):
+    """
+    Adds the content of a file, or of all the files in a directory
+    (ignoring .svn directories), to ``digest``.
+    """
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            if '.svn' in dirnames:
+                dirnames.remove('.svn')
+            dirnames.sort()
+            for filename in sorted(filenames):
+                hash_path(digest, os.path.join(dirpath, filename))
+    elif os.path.exists(path):
+        digest.update('file %s\n' % path)
+        f = open(path, 'rb')
+        while 1:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+        f.close()
+    else:
+        digest.update('missing %s\n' % path)
@@ -15,6 +15,9 @@ from fassembler.filemaker import Maker
 from fassembler.config import ConfigParser
 from fassembler.text import indent
 from fassembler.environ import Environment
+from fassembler.namespace import template_cache
+from fassembler.scheduler import ProjectScheduler
+from fassembler import timing
 
 description = """\
 fassembler assembles files.
@@ -74,12 +77,75 @@ parser.add_option(
     dest='quick',
     help='Try to do things quickly (may not be as safe)')
 
+parser.add_option(
+    '--smart-update',
+    action='store_true',
+    dest='smart_update',
+    help='Only update svn checkouts that are behind the repository (asks each svn '
+    'server once for the last changed revision of all its repositories)')
+
+parser.add_option(
+    '--svn-mirror',
+    metavar='DIR',
+    dest='svn_mirror',
+    help='Keep local mirrors of the svn repositories (made with svnsync) in DIR, '
+    'and check out from them (the general svn_mirror setting does the same)')
+
+parser.add_option(
+    '--compress-jobs',
+    metavar='N',
+    dest='compress_jobs',
+    type='int',
+    help='Use N processes to decompress bzip2 tarballs made of several streams '
+    '(like the ones pbzip2 makes); the default is one per CPU (the general '
+    'compress_jobs setting does the same)')
+
 parser.add_option(
     '--beep',
     action='store_true',
     dest='beep',
     help='Beep everytime a question is asked')
 
+parser.add_option(
+    '--force-task',
+    metavar='PATTERN',
+    dest='force_tasks',
+    action='append',
+    default=[],
+    help='Run the tasks matching PATTERN (like "Make Zope" or "opencore.*"), and '
+    'the tasks after them, even if nothing has changed since they last ran '
+    '(you may use this more than once)')
+
+parser.add_option(
+    '--resume',
+    action='store_true',
+    dest='resume',
+    help='Skip the tasks that were completed before the last build of each project '
+    'failed, starting again at the failed task')
+
+parser.add_option(
+    '-j', '--jobs',
+    metavar='N',
+    dest='jobs',
+    type='int',
+    default=1,
+    help='Build up to N projects at once, in separate processes (projects wait '
+    'for the projects they depend on); implies --no-interactive')
+
+parser.add_option(
+    '--spool-output',
+    action='store_true',
+    dest='spool_output',
+    help='Write the complete output of every command that is run to a file in '
+    'logs/commands/ (normally only the end of the output is kept)')
+
+parser.add_option(
+    '--profile',
+    metavar='FILE',
+    dest='profile',
+    help='Record how long each task and command takes, and write the timings '
+    'to FILE (in the Chrome trace event format) and a summary to FILE.txt')
+
 parser.add_option(
     '-H', '--project-help',
     action='store_true',
@@ -125,6 +191,12 @@ def main(options, args):
     if len(args) < 1:
         raise CommandError(
             "You must provide at least one project")
+    if options.jobs < 1:
+        raise CommandError(
+            "--jobs must be at least 1", show_usage=False)
+    if options.compress_jobs is not None and options.compress_jobs < 1:
+        raise CommandError(
+            "--compress-jobs must be at least 1", show_usage=False)
     base_path = options.base_path
     if base_path and base_path.startswith('ase=') or base_path == 'ase':
         # Sign that you used -base instead of --base
@@ -176,7 +248,23 @@ def main(options, args):
     merge_config(config, environ.config, overwrite=True)
     maker = Maker(base_path, simulate=options.simulate,
                   interactive=not options.no_interactive, logger=logger,
-                  quick=options.quick, beep=options.beep)
+                  quick=options.quick, beep=options.beep,
+                  force_tasks=options.force_tasks, resume=options.resume,
+                  smart_update=options.smart_update)
+    svn_mirror = options.svn_mirror or environ.config.getdefault('general', 'svn_mirror')
+    if svn_mirror:
+        maker.svn_mirror_dir = os.path.abspath(svn_mirror)
+    compress_jobs = options.compress_jobs
+    if compress_jobs is None and environ.config.getdefault('general', 'compress_jobs'):
+        compress_jobs = int(environ.config.get('general', 'compress_jobs'))
+    maker.compress_jobs = compress_jobs
+    if options.spool_output:
+        maker.spool_dir = os.path.join(base_path, 'logs', 'commands')
+    if options.profile and not options.project_help:
+        if timing.json is None:
+            raise CommandError(
+                "--profile requires the json module (or simplejson)", show_usage=False)
+        maker.profile = timing.BuildProfile(os.path.abspath(options.profile), logger)
     environ.maker = maker
     
     projects = []
@@ -214,39 +302,53 @@ def main(options, args):
         ## FIXME: maybe ask if they want to see effective configuration here?
         #config.write(sys.stdout)
         raise CommandError('Errors in configuration', show_usage=False)
-    for project in projects:
-        if options.project_help:
-            description = project.make_description()
-            print description
+    try:
+        if options.jobs > 1 and len(projects) > 1 and not options.project_help:
+            scheduler = ProjectScheduler(projects, maker, environ, logger, options.jobs)
+            success = scheduler.run()
         else:
-            if len(projects) > 1:
-                logger.notify(' Starting project %s' % project.project_name, color='black green_bg')
-                logger.indent += 2
-            try:
-                try:
-                    project.run()
-                    logger.notify('Done with project %s' % project.project_name)
-                    environ.save()
-                finally:
+            for project in projects:
+                if options.project_help:
+                    description = project.make_description()
+                    print description
+                else:
                     if len(projects) > 1:
-                        logger.indent -= 2
-            except CommandError:
-                raise
-            except KeyboardInterrupt:
-                raise CommandError('^C', show_usage=False)
-            except Exception, e:
+                        logger.notify(' Starting project %s' % project.project_name, color='black green_bg')
+                        logger.indent += 2
+                    try:
+                        try:
+                            project.run()
+                            logger.notify('Done with project %s' % project.project_name)
+                            environ.save()
+                        finally:
+                            if len(projects) > 1:
+                                logger.indent -= 2
+                    except CommandError:
+                        raise
+                    except KeyboardInterrupt:
+                        raise CommandError('^C', show_usage=False)
+                    except Exception, e:
+                        success = False
+                        continue_projects = maker.handle_exception(sys.exc_info())
+                        if continue_projects:
+                            continue
+                        else:
+                            break
+                        ## FIXME: should revert environ here
+    finally:
+        try:
+            # E.g., stops ZEO if a project started it:
+            if not maker.run_cleanups():
                 success = False
-                continue_projects = maker.handle_exception(sys.exc_info())
-                if continue_projects:
-                    continue
-                else:
-                    break
-                ## FIXME: should revert environ here
+        finally:
+            if maker.profile is not None:
+                maker.profile.write()
     if not options.project_help:
         if success:
             logger.notify('Installation successful.')
         else:
             logger.notify('Installation not completely successful.')
+    logger.info('Template cache: %s' % template_cache)
     ## FIXME: commit etc/?
 
 _var_re = re.compile(r'^(?:\[(\w+)\])?\s*(\w+)=(.*)$')
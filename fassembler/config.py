@@ -5,6 +5,7 @@ The configuration file loader (based on INITools)
 from initools import configparser
 import re
 import urllib
+import weakref
 
 _url_re = re.compile(r'^https?://')
 
@@ -23,6 +24,45 @@ class ConfigParser(configparser.RawConfigParser):
         except (configparser.NoSectionError, configparser.NoOptionError), e:
             return default
 
+    def set(self, section, option, value, *args, **kw):
+        configparser.RawConfigParser.set(self, section, option, value, *args, **kw)
+        self.notify_change(section, option)
+
+    def remove_option(self, section, option):
+        result = configparser.RawConfigParser.remove_option(self, section, option)
+        self.notify_change(section, option)
+        return result
+
+    def remove_section(self, section):
+        result = configparser.RawConfigParser.remove_section(self, section)
+        self.notify_change(section, None)
+        return result
+
+    def add_change_listener(self, listener):
+        """
+        Calls ``listener.config_changed(config, section, option)``
+        whenever an option is set or removed (``option`` is None when
+        a whole section is removed).  Only a weak reference to the
+        listener is kept.
+        """
+        if '_change_listeners' not in self.__dict__:
+            self._change_listeners = []
+        self._change_listeners.append(weakref.ref(listener))
+
+    def notify_change(self, section, option):
+        listeners = self.__dict__.get('_change_listeners')
+        if not listeners:
+            return
+        section = self.sectionxform(section)
+        if option is not None:
+            option = self.optionxform(option)
+        for ref in list(listeners):
+            listener = ref()
+            if listener is None:
+                listeners.remove(ref)
+            else:
+                listener.config_changed(self, section, option)
+
     def _open(self, filename, mode='r'):
         if mode == 'r' and _url_re.search(filename):
             # Load an HTTP url
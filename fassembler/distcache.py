@@ -0,0 +1,169 @@
+"""
+A cache of the distributions (source archives and eggs) downloaded
+while building, shared by all the virtualenvs of a build (and kept
+between builds), so that each distribution is only downloaded once.
+
+The cache is kept in ``var/dist-cache/`` (or wherever the
+``dist_cache`` setting in ``[general]`` points), and looks like::
+
+    objects/ab/abcdef.../Name-1.0.tar.gz
+        Each distribution, stored under the sha1 of its content.
+    dists/Name-1.0.tar.gz
+        A hard link to the object; this directory is given to
+        easy_install as a ``find_links`` location.
+    pip/
+        pip's own download cache (used with ``--download-cache``).
+
+easy_install is run with a build directory in the cache (``-b``),
+which keeps the distributions it downloads; ``harvest`` moves them
+into the cache afterwards.  Distributions that pip downloaded are
+added too (see ``seed``), so easy_install can find those as well.
+"""
+
+import os
+import shutil
+import tempfile
+import urllib
+from fassembler.util import sha1
+
+class DistributionCache(object):
+    """
+    The distribution cache in the directory ``path``.
+    """
+
+    archive_extensions = ['.tar.gz', '.tgz', '.tar.bz2', '.tar', '.zip', '.egg']
+
+    def __init__(self, path, maker, logger):
+        self.path = path
+        self.maker = maker
+        self.logger = logger
+        self.seeded = False
+
+    @property
+    def find_links(self):
+        """
+        The directory easy_install should look in for distributions.
+        """
+        return os.path.join(self.path, 'dists')
+
+    @property
+    def pip_download_cache(self):
+        return os.path.join(self.path, 'pip')
+
+    def make_build_directory(self):
+        """
+        Creates an empty directory for easy_install to download into
+        (with ``easy_install -b``).  Pass it to ``harvest`` after
+        easy_install has run.
+        """
+        tmp = os.path.join(self.path, 'tmp')
+        if self.maker.simulate:
+            return os.path.join(tmp, 'easy_install-simulated')
+        self.ensure_dirs()
+        if not self.seeded:
+            self.seed()
+        return tempfile.mkdtemp(prefix='easy_install-', dir=tmp)
+
+    def seed(self):
+        """
+        Adds the distributions in pip's download cache (from earlier
+        runs) that aren't in the cache yet.
+        """
+        self.seeded = True
+        pip_cache = self.pip_download_cache
+        if not os.path.isdir(pip_cache):
+            return
+        added = []
+        for filename in sorted(os.listdir(pip_cache)):
+            # pip names the files after their (quoted) URL:
+            name = urllib.unquote(filename).split('#', 1)[0].rstrip('/').split('/')[-1]
+            if (not self.is_archive(name)
+                or os.path.exists(os.path.join(self.find_links, name))):
+                continue
+            if self.add(os.path.join(pip_cache, filename), name=name):
+                added.append(name)
+        if added:
+            self.logger.info('Added from the pip download cache: %s' % ', '.join(added))
+
+    def ensure_dirs(self):
+        for name in 'objects', 'dists', 'tmp', 'pip':
+            dir = os.path.join(self.path, name)
+            if not os.path.exists(dir):
+                try:
+                    os.makedirs(dir)
+                except OSError:
+                    # Another process may have just created it
+                    if not os.path.isdir(dir):
+                        raise
+
+    def is_archive(self, filename):
+        for ext in self.archive_extensions:
+            if filename.endswith(ext):
+                return True
+        return False
+
+    def harvest(self, build_dir):
+        """
+        Adds the distributions easy_install downloaded into
+        ``build_dir`` to the cache, then removes ``build_dir`` (along
+        with anything easy_install unpacked there).
+        """
+        if self.maker.simulate or not os.path.isdir(build_dir):
+            return
+        added = []
+        for filename in sorted(os.listdir(build_dir)):
+            path = os.path.join(build_dir, filename)
+            if os.path.isfile(path) and self.is_archive(filename):
+                if self.add(path):
+                    added.append(filename)
+        if added:
+            self.logger.info('Added to the distribution cache: %s' % ', '.join(added))
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    def object_path(self, filename, name):
+        """
+        Returns ``(digest, path)``: the sha1 of the file's content, and
+        where that content is stored in the cache (as ``name``).
+        """
+        digest = sha1()
+        f = open(filename, 'rb')
+        while 1:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+        f.close()
+        digest = digest.hexdigest()
+        return digest, os.path.join(self.path, 'objects', digest[:2], digest, name)
+
+    def add(self, filename, name=None):
+        """
+        Adds a distribution to the cache, as ``name`` (by default the
+        name of the file).  Returns true if it wasn't there yet.
+        """
+        if name is None:
+            name = os.path.basename(filename)
+        self.ensure_dirs()
+        digest, obj = self.object_path(filename, name)
+        link = os.path.join(self.find_links, name)
+        if os.path.exists(obj) and os.path.exists(link) and os.path.samefile(obj, link):
+            return False
+        if not os.path.exists(obj):
+            obj_dir = os.path.dirname(obj)
+            if not os.path.exists(obj_dir):
+                os.makedirs(obj_dir)
+            # Copied under a temporary name first, so that other
+            # processes never see a partial file:
+            tmp = '%s.tmp-%s' % (obj, os.getpid())
+            shutil.copyfile(filename, tmp)
+            os.rename(tmp, obj)
+        # The newest download of a filename wins:
+        tmp = '%s.tmp-%s' % (link, os.getpid())
+        try:
+            os.link(obj, tmp)
+        except (OSError, AttributeError):
+            shutil.copyfile(obj, tmp)
+        os.rename(tmp, link)
+        self.logger.debug('Stored %s in the distribution cache as %s'
+                          % (name, digest))
+        return True
@@ -1,7 +1,10 @@
 import os
 import socket
+from fassembler.artifacts import ArtifactCache
+from fassembler.buildstate import BuildState
 from fassembler.config import ConfigParser
-from fassembler.util import asbool
+from fassembler.distcache import DistributionCache
+from fassembler.util import asbool, cpu_count
 from initools.configparser import CanonicalFilenameSet
 import string
 import random
@@ -46,6 +49,9 @@ class Environment(object):
         # Gets set later:
         self.maker = None
         self.simulated_built_projects = []
+        self._build_state = None
+        self._dist_cache = None
+        self._artifact_cache = None
 
     @property
     def hostname(self):
@@ -59,6 +65,39 @@ class Environment(object):
         """
         return socket.gethostname().split('.')[0]
 
+    @property
+    def cpu_count(self):
+        """
+        The number of CPUs this computer has (1 if that can't be
+        found out).
+        """
+        return cpu_count()
+
+    @property
+    def memory_mb(self):
+        """
+        The physical memory of this computer, in megabytes (None if
+        that can't be found out).
+        """
+        try:
+            pages = os.sysconf('SC_PHYS_PAGES')
+            page_size = os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            pages = page_size = 0
+        if pages > 0 and page_size > 0:
+            return pages * page_size // (1024*1024)
+        try:
+            f = open('/proc/meminfo')
+            try:
+                for line in f:
+                    if line.startswith('MemTotal:'):
+                        return int(line.split()[1]) // 1024
+            finally:
+                f.close()
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
     @property
     def fq_hostname(self):
         """
@@ -142,6 +181,62 @@ class Environment(object):
     def var(self):
         return self.config.get('general', 'var')
 
+    @property
+    def build_state(self):
+        """
+        The record of what earlier builds did (a
+        ``fassembler.buildstate.BuildState``), kept in
+        ``var/fassembler/build-state.txt``.
+        """
+        if self._build_state is None:
+            self._build_state = BuildState(
+                os.path.join(self.var_path, 'fassembler', 'build-state.txt'),
+                self.maker, self.logger)
+        return self._build_state
+
+    @property
+    def var_path(self):
+        """
+        Like ``var``, but works before the ``var`` setting is saved.
+        """
+        return self.config.getdefault('general', 'var') or os.path.join(self.base_path, 'var')
+
+    @property
+    def dist_cache(self):
+        """
+        The cache of downloaded distributions shared by all the
+        virtualenvs (a ``fassembler.distcache.DistributionCache``), in
+        ``var/dist-cache`` unless the ``dist_cache`` setting says
+        otherwise.  None if ``dist_cache`` is set to nothing.
+        """
+        path = self.config.getdefault('general', 'dist_cache')
+        if path is None:
+            path = os.path.join(self.var_path, 'dist-cache')
+        if not path.strip():
+            return None
+        path = os.path.abspath(path.strip())
+        if self._dist_cache is None or self._dist_cache.path != path:
+            self._dist_cache = DistributionCache(path, self.maker, self.logger)
+        return self._dist_cache
+
+    @property
+    def artifact_cache(self):
+        """
+        The cache of downloaded tarballs (a
+        ``fassembler.artifacts.ArtifactCache``), in ``var/artifacts``
+        unless the ``artifact_cache`` setting says otherwise.  None if
+        ``artifact_cache`` is set to nothing.
+        """
+        path = self.config.getdefault('general', 'artifact_cache')
+        if path is None:
+            path = os.path.join(self.var_path, 'artifacts')
+        if not path.strip():
+            return None
+        path = os.path.abspath(path.strip())
+        if self._artifact_cache is None or self._artifact_cache.path != path:
+            self._artifact_cache = ArtifactCache(path, self.logger)
+        return self._artifact_cache
+
     def save(self):
         """
         Save the configuration in etc/build.ini
@@ -153,10 +248,50 @@ class Environment(object):
         ## FIXME: this should use ensure_file or something
         ## FIXME: somehow this is clearing the config file when no changes are made
         ## (the self._parser is None check avoids this, but only incidentally)
-        self.logger.info('Writing environment config file: %s' % self.config_filename)
-        f = open(self.config_filename, 'wb')
-        self.config.write_sources(f, CanonicalFilenameSet([self.config_filename, None, '<cmdline>']))
-        f.close()
+        lock = self.process_lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            if lock is not None:
+                self.merge_saved_config()
+            self.logger.info('Writing environment config file: %s' % self.config_filename)
+            f = open(self.config_filename, 'wb')
+            self.config.write_sources(f, CanonicalFilenameSet([self.config_filename, None, '<cmdline>']))
+            f.close()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def merge_saved_config(self):
+        """
+        Pick up settings another process has saved to build.ini since
+        it was read.  Settings changed by this process are kept.
+        """
+        if not os.path.exists(self.config_filename):
+            return
+        saved = ConfigParser()
+        saved.read([self.config_filename])
+        config = self.config
+        for section in saved.sections():
+            if not config.has_section(section):
+                config.add_section(section)
+            for option in saved.options(section):
+                if config.has_option(section, option):
+                    filename = config.setting_location(section, option)[0]
+                    if filename is None or filename == '<cmdline>':
+                        continue
+                config.set(section, option, saved.get(section, option),
+                           filename=self.config_filename)
+
+    @property
+    def process_lock(self):
+        """
+        The lock held while writing shared files, if other processes
+        are building at the same time (see ``Maker.process_lock``).
+        """
+        if self.maker is None:
+            return None
+        return self.maker.process_lock
 
     random_string = staticmethod(random_string)
 
@@ -185,6 +320,16 @@ class Environment(object):
             # Didn't really build at all
             self.simulated_built_projects.append(name)
             return
+        lock = self.process_lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            self._write_built_project(name, time)
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _write_built_project(self, name, time):
         dest = self.maker.path('etc/projects.txt')
         if os.path.exists(dest):
             f = open(dest, 'r')
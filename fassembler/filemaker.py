@@ -6,19 +6,30 @@ Everything happens in the Maker object.
 # (c) 2005 Ian Bicking, Ben Bangert, and contributors; written for Paste (http://pythonpaste.org)
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 # This was originally based on paste.filemaker
+import artifacts
+import errno
 import os
 import re
+import select
 import shutil
 import string
 import subprocess
+import svnwc
 import sys
 import tempfile
 import tempita
+import threading
+import time
+import urllib
+import urlparse
 import util
 
+from collections import deque
+from datetime import datetime
 from difflib import unified_diff, context_diff
 from environ import random_string
 from getpass import getpass
+from text import indent
 
 EXE_MODE = 0111
 
@@ -39,6 +50,51 @@ class RunCommandError(OSError):
                                              self.command,
                                              self.returncode)
 
+class OutputTail(object):
+    """
+    Keeps the last ``limit`` bytes (or so; whole lines are kept) of the
+    output of a command, and optionally writes all of it to the file
+    object ``spool``.  If ``keep_all`` is true all of the output is
+    kept too (see ``getall()``).
+    """
+
+    def __init__(self, limit, spool=None, keep_all=False):
+        self.limit = limit
+        self.spool = spool
+        self.lines = deque()
+        self.size = 0
+        self.dropped = 0
+        self.all = None
+        if keep_all:
+            self.all = []
+
+    def add(self, line):
+        if self.spool is not None:
+            self.spool.write(line)
+        if self.all is not None:
+            self.all.append(line)
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.limit and len(self.lines) > 1:
+            old = self.lines.popleft()
+            self.size -= len(old)
+            self.dropped += len(old)
+
+    def getvalue(self):
+        """
+        The tail of the output (for error reports).
+        """
+        value = ''.join(self.lines)
+        if self.dropped:
+            value = '[%s bytes of output not kept]\n%s' % (self.dropped, value)
+        return value
+
+    def getall(self):
+        """
+        All of the output (only if ``keep_all`` was given).
+        """
+        return ''.join(self.all)
+
 class Maker(object):
     """
     Instances of Maker are abstractions of several pieces of context:
@@ -48,6 +104,10 @@ class Maker(object):
     * A simulate flag (if true, then nothing should *actually* be done)
     * An interactive flag (if true, then query the user about some changes)
     * A quick flag (if true, skip some checks to make this run faster)
+    * A list of patterns matching tasks that should be run even if
+      nothing has changed since they last ran (force_tasks)
+    * A resume flag (if true, skip the tasks that completed before
+      the last run failed)
 
     All actions should ideally go through this object.
 
@@ -59,7 +119,11 @@ class Maker(object):
                  simulate=False, 
                  interactive=True,
                  quick=False,
-                 beep=False):
+                 beep=False,
+                 force_tasks=None,
+                 resume=False,
+                 smart_update=False,
+                 compress_jobs=None):
         """
         Initialize the Maker.  Files go under base_path.
         """
@@ -69,6 +133,45 @@ class Maker(object):
         self.interactive = interactive
         self.quick = quick
         self.beep = beep
+        self.force_tasks = force_tasks or []
+        self.resume = resume
+        self.smart_update = smart_update
+        # The number of processes used to decompress bzip2 (None for
+        # one per CPU):
+        self.compress_jobs = compress_jobs
+        # The last changed revision of svn URLs (unquoted), found out
+        # this run:
+        self._svn_remote_revisions = {}
+        # The UUIDs of svn repositories, by their root URL:
+        self._svn_repositories = {}
+        # Checkouts can be made in several threads (see InstallSpec);
+        # this guards the two dictionaries above:
+        self._svn_info_lock = threading.RLock()
+        # If set, checkouts are made from local mirrors of the svn
+        # repositories, kept in this directory:
+        self.svn_mirror_dir = None
+        self._svn_mirrors = {}
+        self._svn_mirror_lock = threading.Lock()
+        # How much of the output of each command run_command keeps:
+        self.output_tail_size = 256*1024
+        # If set, run_command writes the complete output of every
+        # command to a file in this directory:
+        self.spool_dir = None
+        self._spool_count = 0
+        self._ask_lock = threading.Lock()
+        # Paths waiting to be added to svn by flush_svn_adds:
+        self._svn_adds = []
+        self._svn_adds_pending = {}
+        # Set to a fassembler.timing.BuildProfile with --profile:
+        self.profile = None
+        # Set (to a fassembler.util.DirectoryLock) when other
+        # processes are building in the same base_path at once:
+        self.process_lock = None
+        # Things kept for the rest of the run (like a ZEO server one
+        # project started that the next can use), by name:
+        self.services = {}
+        # Called by run_cleanups at the end of the run:
+        self._cleanups = []
     
     def copy_file(self, src, dest=None, dest_dir=None, template_vars=None,
                   interpolater=None, overwrite=False, svn_add=True):
@@ -359,18 +462,16 @@ class Maker(object):
             self.logger.notify('Creating %s' % self.display_path(dir))
             if not self.simulate:
                 os.mkdir(dir)
-            if (svn_add and
-                os.path.exists(os.path.join(os.path.dirname(dir), '.svn'))):
-                self.svn_command('add', dir)
+            if svn_add and self._in_svn(dir):
+                self.svn_add(dir)
             if package:
                 initfile = os.path.join(dir, '__init__.py')
                 f = open(initfile, 'wb')
                 f.write("#\n")
                 f.close()
                 self.logger.notify('Creating %s' % self.display_path(initfile))
-                if (svn_add and
-                    os.path.exists(os.path.join(os.path.dirname(dir), '.svn'))):
-                    self.svn_command('add', initfile)
+                if svn_add and self._in_svn(initfile):
+                    self.svn_add(initfile)
         else:
             self.logger.debug("Directory already exists: %s" % self.display_path(dir))
 
@@ -392,8 +493,8 @@ class Maker(object):
                 f.close()
             if executable:
                 self.make_executable(filename)
-            if svn_add and os.path.exists(os.path.join(os.path.dirname(filename), '.svn')):
-                self.svn_command('add', filename)
+            if svn_add and self._in_svn(filename):
+                self.svn_add(filename)
             return
         f = open(filename, 'rb')
         old_content = f.read()
@@ -444,16 +545,113 @@ class Maker(object):
 
     _svn_failed = False
 
+    def _in_svn(self, path):
+        """
+        True if the directory ``path`` is in is under svn control (or
+        will be, once the adds waiting in ``svn_add`` are done).
+        """
+        parent = os.path.dirname(path)
+        return (os.path.exists(os.path.join(parent, '.svn'))
+                or parent in self._svn_adds_pending)
+
+    def svn_add(self, path):
+        """
+        Adds ``path`` (just the file or directory, not what is in the
+        directory) to svn.  The adds are queued, and done by
+        ``flush_svn_adds`` (after each task).
+        """
+        if path in self._svn_adds_pending:
+            return
+        self._svn_adds.append(path)
+        self._svn_adds_pending[path] = True
+
+    def flush_svn_adds(self):
+        """
+        Does the svn adds queued by ``svn_add``, with one ``svn add``
+        per working copy.  If that fails, the paths are added one at
+        a time, so that each failure can be reported.
+        """
+        paths = self._svn_adds
+        if not paths:
+            return
+        pending = self._svn_adds_pending
+        self._svn_adds = []
+        self._svn_adds_pending = {}
+        working_copies = []
+        by_working_copy = {}
+        for path in paths:
+            root = self._svn_working_copy_root(path, pending)
+            if root not in by_working_copy:
+                working_copies.append(root)
+                by_working_copy[root] = []
+            by_working_copy[root].append(path)
+        for root in working_copies:
+            paths = by_working_copy[root]
+            self.logger.info('Adding %s paths to svn in %s'
+                             % (len(paths), self.display_path(root)))
+            try:
+                self._run_svn_add(paths)
+                continue
+            except RunCommandError, e:
+                if len(paths) == 1:
+                    self.logger.warn('Could not add %s to svn: %s'
+                                     % (self.display_path(paths[0]), (e.stderr or str(e)).strip()))
+                    continue
+                self.logger.info('svn add failed; adding the paths one at a time')
+            except OSError, e:
+                if not self._svn_failed:
+                    self.logger.warn('Unable to run svn command (%s); proceeding anyway' % e)
+                    self._svn_failed = True
+                return
+            for path in paths:
+                try:
+                    self._run_svn_add([path])
+                except RunCommandError, e:
+                    self.logger.warn('Could not add %s to svn: %s'
+                                     % (self.display_path(path), (e.stderr or str(e)).strip()))
+
+    def _run_svn_add(self, paths):
+        if self.process_lock is not None:
+            self.process_lock.acquire()
+        try:
+            self.run_command(['svn', 'add', '--depth=empty', '--parents'] + paths,
+                             log_error=False)
+        finally:
+            if self.process_lock is not None:
+                self.process_lock.release()
+
+    def _svn_working_copy_root(self, path, pending):
+        """
+        The top of the working copy that ``path`` will be added to.
+        """
+        while 1:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return path
+            if not (os.path.exists(os.path.join(parent, '.svn'))
+                    or parent in pending):
+                return path
+            path = parent
+
     def svn_command(self, *args, **kw):
         """
         Run an svn command, but don't raise an exception if it fails.
+        Returns the output.
         """
+        kw.setdefault('keep_output', True)
+        # Concurrent svn commands in one working copy fail on its lock:
+        if self.process_lock is not None:
+            self.process_lock.acquire()
         try:
-            return self.run_command('svn', *args, **kw)
-        except OSError, e:
-            if not self._svn_failed:
-                self.logger.warn('Unable to run svn command (%s); proceeding anyway' % e)
-                self._svn_failed = True
+            try:
+                return self.run_command('svn', *args, **kw)
+            except OSError, e:
+                if not self._svn_failed:
+                    self.logger.warn('Unable to run svn command (%s); proceeding anyway' % e)
+                    self._svn_failed = True
+        finally:
+            if self.process_lock is not None:
+                self.process_lock.release()
 
     def ensure_symlink(self, source, dest, overwrite=False):
         """
@@ -539,7 +737,8 @@ class Maker(object):
         """
         Runs the command (either a single string, or a script with
         arguments), respecting verbosity and simulation.  Returns
-        stdout, or None if simulating.
+        stdout if ``keep_output`` is given, otherwise (or if
+        simulating) None.
 
         Some keyword arguments are supported:
 
@@ -587,6 +786,26 @@ class Maker(object):
 
         ``shell``:
             Run the command string in a child shell. Default False.
+
+        ``output_tail_size``:
+            Error reports (the log and ``RunCommandError``) only show
+            the last this-many bytes of stdout and of stderr; by
+            default ``self.output_tail_size``.  Output is read as it
+            comes, so the log filter sees each line as soon as it is
+            written.
+
+        ``keep_output``:
+            If true, all of stdout (and stderr) is kept and returned,
+            for callers that read the output.  By default only the
+            tails are kept (so commands with a lot of output, like
+            ``pip -vvvv``, don't fill up memory), and None is returned
+            instead of stdout.
+
+        ``spool``:
+            If true, the complete output is written to a file in
+            ``self.spool_dir`` (or ``logs/commands/`` if that isn't
+            set).  By default the output is spooled only if
+            ``self.spool_dir`` is set.
         """
         cwd = popdefault(kw, 'cwd', self.base_path) or self.base_path
         cwd = self.path(cwd)
@@ -604,6 +823,9 @@ class Maker(object):
         stdin = popdefault(kw, 'stdin', None)
         log_filter = popdefault(kw, 'log_filter', None)
         use_shell = popdefault(kw, 'shell', False)
+        output_tail_size = popdefault(kw, 'output_tail_size', self.output_tail_size)
+        keep_output = popdefault(kw, 'keep_output', False)
+        spool = popdefault(kw, 'spool', self.spool_dir is not None)
         if extra_path:
             env = env.copy()
             path_parts = env.get('PATH', '').split(os.path.pathsep)
@@ -621,6 +843,7 @@ class Maker(object):
             stdin_argument = subprocess.PIPE
         else:
             stdin_argument = None
+        start_time = time.time()
         try:
             proc = subprocess.Popen(cmd,
                                     cwd=cwd,
@@ -649,51 +872,44 @@ class Maker(object):
                 return None
         if stdin:
             proc.stdin.write(stdin)
-        if log_filter:
-            stdout = []
-            stdout_pipe = proc.stdout
-            while 1:
-                line = stdout_pipe.readline()
-                if not line:
-                    break
-                stdout.append(line)
-                line = line.rstrip()
-                if isinstance(log_filter, int):
-                    level = log_filter
-                else:
-                    level = log_filter(line)
-                if isinstance(level, tuple):
-                    line, level = level
-                if line:
-                    self.logger.log(level, line)
-                if not self.logger.stdout_level_matches(level):
-                    self.logger.show_progress()
-            stdout = ''.join(stdout)
-            stderr = ''
-            # Bug #2128: The return code isn't set just by reading stdout;
-            # you have to call wait() or communicate().
-            proc.wait()
+            proc.stdin.close()
+        spool_file = spool_filename = None
+        if spool:
+            spool_file, spool_filename = self._open_spool_file(cmd, cwd)
+        try:
+            stdout_tail = OutputTail(output_tail_size, spool_file, keep_all=keep_output)
+            stderr_tail = OutputTail(output_tail_size, spool_file, keep_all=keep_output)
+            self._read_output(proc, stdout_tail, stderr_tail, log_filter)
+        finally:
+            if spool_file is not None:
+                spool_file.close()
+        stdout = stdout_tail.getvalue()
+        stderr = stderr_tail.getvalue()
+        # Bug #2128: The return code isn't set just by reading stdout;
+        # you have to call wait() or communicate().
+        if self.profile is not None:
+            rusage = self._wait_rusage(proc)
+            self.profile.add_command(
+                cmd, start_time, time.time(), rusage,
+                output_bytes=(stdout_tail.size + stdout_tail.dropped
+                              + stderr_tail.size + stderr_tail.dropped))
         else:
-            stdout, stderr = proc.communicate()
+            proc.wait()
         if proc.returncode and not expect_returncode:
             if log_error:
                 self.logger.log(slice(self.logger.WARN, self.logger.FATAL),
                                 'Running %s' % self._format_command(cmd), color='bold red')
                 self.logger.warn('Error (exit code: %s)' % proc.returncode, color='bold red')
+                # The output is indented here rather than with
+                # logger.indent, which other threads may be using:
                 if stdout:
                     self.logger.warn('stdout:')
-                    self.logger.indent += 2
-                    try:
-                        self.logger.warn(stdout)
-                    finally:
-                        self.logger.indent -= 2
+                    self.logger.warn(indent(stdout, '  ', dedent=False))
                 if stderr:
                     self.logger.warn('stderr:')
-                    self.logger.indent += 2
-                    try:
-                        self.logger.warn(stderr)
-                    finally:
-                        self.logger.indent -= 2
+                    self.logger.warn(indent(stderr, '  ', dedent=False))
+                if spool_filename:
+                    self.logger.warn('Complete output in %s' % self.display_path(spool_filename))
             raise RunCommandError("Error executing command %s (code %s)" %
                                   (self._format_command(cmd), proc.returncode),
                                   command=cmd, stdout=stdout, stderr=stderr,
@@ -702,11 +918,111 @@ class Maker(object):
             self.logger.debug('Command error output:\n%s' % stderr)
         if stdout:
             self.logger.debug('Command output:\n%s' % stdout)
+        if keep_output:
+            stdout = stdout_tail.getall()
+            stderr = stderr_tail.getall()
+        else:
+            stdout = stderr = None
         if return_full:
             return (stdout, stderr, proc.returncode)
         else:
             return stdout
 
+    def _read_output(self, proc, stdout_tail, stderr_tail, log_filter):
+        """
+        Reads stdout and stderr (if it is a separate pipe) of the
+        process until both are closed, a line at a time, as the
+        output comes.  Lines go to the tails; stdout lines are also
+        passed through the log filter.
+        """
+        streams = {}
+        for pipe, tail, is_stdout in [(proc.stdout, stdout_tail, True),
+                                      (proc.stderr, stderr_tail, False)]:
+            if pipe is not None:
+                # [tail, is_stdout, partial line]
+                streams[pipe.fileno()] = [tail, is_stdout, '']
+        while streams:
+            try:
+                readable = select.select(streams.keys(), [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                stream = streams[fd]
+                tail, is_stdout, partial = stream
+                data = os.read(fd, 8192)
+                if data:
+                    lines = (partial + data).split('\n')
+                    stream[2] = lines.pop()
+                    lines = [line + '\n' for line in lines]
+                else:
+                    del streams[fd]
+                    lines = partial and [partial] or []
+                for line in lines:
+                    tail.add(line)
+                    if is_stdout and log_filter:
+                        self._log_output_line(line.rstrip(), log_filter)
+        proc.stdout.close()
+        if proc.stderr is not None:
+            proc.stderr.close()
+
+    def _wait_rusage(self, proc):
+        """
+        Waits for the process to finish, and returns its resource
+        usage (or None if ``os.wait4`` isn't available).
+        """
+        if not hasattr(os, 'wait4'):
+            proc.wait()
+            return None
+        while 1:
+            try:
+                pid, status, rusage = os.wait4(proc.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            break
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        return rusage
+
+    def _log_output_line(self, line, log_filter):
+        if isinstance(log_filter, int):
+            level = log_filter
+        else:
+            level = log_filter(line)
+        if isinstance(level, tuple):
+            line, level = level
+        if line:
+            self.logger.log(level, line)
+        if not self.logger.stdout_level_matches(level):
+            self.logger.show_progress()
+
+    def _open_spool_file(self, cmd, cwd):
+        """
+        Opens a new file to write the output of ``cmd`` to.  Returns
+        ``(file, filename)``.
+        """
+        spool_dir = self.spool_dir or self.path('logs/commands')
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        if isinstance(cmd, basestring):
+            name = cmd.split(None, 1)[0]
+        else:
+            name = cmd[0]
+        name = re.sub(r'[^a-zA-Z0-9_.-]', '_', os.path.basename(name))
+        self._spool_count += 1
+        filename = os.path.join(spool_dir, '%s-%s-%03i-%s.log' % (
+            datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            self._spool_count, name))
+        f = open(filename, 'w')
+        f.write('Running %s\nin %s\n\n' % (self._format_command(cmd), cwd))
+        self.logger.debug('Writing command output to %s' % self.display_path(filename))
+        return f, filename
+
     def _script_abspath(self, cmd, abspath):
         """
         Rewrite the command to use the given abspath
@@ -757,7 +1073,12 @@ class Maker(object):
         same one as is supposed to be checked out.  If not, the user
         will be asked about changing the repository (and may opt not
         to).  If ``self.quick`` is false, the repository will also be
-        updated.
+        updated; with ``self.smart_update`` only if it is behind the
+        repository (or the wrong revision).
+
+        If ``self.svn_mirror_dir`` is set, the checkout or update is
+        done from a local mirror of the repository (see
+        ``svn_mirror``).
         """
         dest = self.path(dest)
         repo = repo.rstrip('/')
@@ -798,21 +1119,232 @@ class Maker(object):
                     else:
                         assert 0, response
         if self.exists(dest) and current_repo:
+            if self.smart_update and self._svn_checkout_is_current(dest, revision):
+                self.logger.notify('Checkout %s is up to date; skipping update' % dest)
+                return
             cmd = ['svn', 'update']
             if revision:
                 cmd.extend(['-r', str(revision)])
             cmd.append(dest)
-            self.run_command(cmd)
+            mirror = self.svn_mirror(current_repo)
+            if mirror is None:
+                self.run_command(cmd)
+            else:
+                mirror_root, root = mirror
+                self._svn_relocate(dest, root, mirror_root)
+                try:
+                    self.run_command(cmd)
+                finally:
+                    self._svn_relocate(dest, mirror_root, root)
             self.logger.notify('Updated repository at %s' % dest)
         else:
             ## FIXME: dot progress?
             cmd = ['svn', 'checkout']
             if revision:
                 cmd.extend(['-r', str(revision)])
-            cmd.extend([repo, dest])
-            self.run_command(cmd, log_filter=self._filter_svn)
+            mirror = self.svn_mirror(repo)
+            if mirror is None:
+                cmd.extend([repo, dest])
+                self.run_command(cmd, log_filter=self._filter_svn)
+            else:
+                mirror_root, root = mirror
+                cmd.extend([mirror_root + repo[len(root):], dest])
+                self.run_command(cmd, log_filter=self._filter_svn)
+                self._svn_relocate(dest, mirror_root, root)
             self.logger.notify('Checked out repository to %s' % dest)
 
+    def _svn_relocate(self, dest, from_url, to_url):
+        self.run_command(['svn', 'switch', '--relocate', from_url, to_url, dest])
+
+    def svn_mirror(self, repo):
+        """
+        Returns ``(mirror_root, root)`` if a local mirror of the svn
+        repository ``repo`` is in use: the ``file:`` URL of the
+        mirror, and the root URL of the repository it mirrors.
+        Returns None if there is no mirror (or it can't be made).
+
+        Mirrors are kept in ``self.svn_mirror_dir``, one for each
+        repository root.  A mirror is made with ``svnsync`` the first
+        time it is needed, and brought up to date once per run.  The
+        mirror has the UUID of the repository, so working copies can
+        be relocated between the two.
+        """
+        if not self.svn_mirror_dir or self.simulate or repo.startswith('file:'):
+            return None
+        root = self._svn_repository_root(repo)
+        if root is None:
+            return None
+        # Checkouts can be made in several threads (see InstallSpec)
+        self._svn_mirror_lock.acquire()
+        try:
+            if root not in self._svn_mirrors:
+                self._svn_mirrors[root] = self._sync_svn_mirror(root)
+            mirror_root = self._svn_mirrors[root]
+        finally:
+            self._svn_mirror_lock.release()
+        if mirror_root is None:
+            return None
+        return mirror_root, root
+
+    def _svn_repository_root(self, repo):
+        repo = repo.rstrip('/')
+        for i in range(2):
+            self._svn_info_lock.acquire()
+            try:
+                for root in self._svn_repositories:
+                    if repo == root or repo.startswith(root + '/'):
+                        return root
+            finally:
+                self._svn_info_lock.release()
+            if i == 0:
+                # svn info gets the root too:
+                self.svn_last_changed_revisions([repo])
+        self.logger.debug('Cannot find the repository root of %s' % repo)
+        return None
+
+    def _sync_svn_mirror(self, root):
+        """
+        Creates (if necessary) and updates the mirror of the
+        repository at ``root``, returning the mirror's URL.
+        """
+        name = re.sub(r'[^\w.-]+', '_', root.split('://', 1)[-1]).strip('_')
+        path = os.path.join(self.svn_mirror_dir, name)
+        url = 'file://' + urllib.pathname2url(path)
+        lock = self.process_lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            try:
+                if not os.path.exists(path):
+                    self._create_svn_mirror(root, path)
+                self.logger.notify('Updating the svn mirror of %s' % root)
+                self.run_command(['svnsync', 'sync', '--non-interactive', url])
+            except OSError, e:
+                self.logger.warn('Cannot use an svn mirror of %s (%s); using the repository directly'
+                                 % (root, (getattr(e, 'stderr', None) or str(e)).strip()))
+                return None
+        finally:
+            if lock is not None:
+                lock.release()
+        return url
+
+    def _create_svn_mirror(self, root, path):
+        self.logger.notify('Creating an svn mirror of %s in %s' % (root, path))
+        if not os.path.exists(self.svn_mirror_dir):
+            os.makedirs(self.svn_mirror_dir)
+        # Set up elsewhere, so that a mirror that exists is always
+        # ready to be synced:
+        tmp = '%s.tmp-%s' % (path, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        self.run_command(['svnadmin', 'create', tmp])
+        self.run_command(['svnadmin', 'setuuid', tmp, self._svn_repositories[root]])
+        # svnsync needs to set revision properties:
+        hook = os.path.join(tmp, 'hooks', 'pre-revprop-change')
+        f = open(hook, 'w')
+        f.write('#!/bin/sh\nexit 0\n')
+        f.close()
+        os.chmod(hook, 0755)
+        self.run_command(['svnsync', 'init', '--non-interactive',
+                          'file://' + urllib.pathname2url(tmp), root])
+        os.rename(tmp, path)
+
+    def _svn_checkout_is_current(self, dest, revision=None):
+        """
+        True if the working copy at ``dest`` is at ``revision``, or
+        (with no revision) has nothing to update: no commit in its
+        repository is newer than the working copy.
+        """
+        info = self.svn_info(dest)
+        if info is None or info[1] is None:
+            return False
+        url, wc_revision = info
+        if revision:
+            return int(revision) == wc_revision
+        remote_revision = self.svn_last_changed_revisions([url]).get(url)
+        if remote_revision is None:
+            return False
+        self.logger.debug('Checkout %s is at r%s; the repository last changed in r%s'
+                          % (dest, wc_revision, remote_revision))
+        return wc_revision >= remote_revision
+
+    _svn_info_entry_re = re.compile(r'<entry\b.*?</entry>', re.S)
+    _svn_info_url_re = re.compile(r'<url>(.*?)</url>', re.S)
+    _svn_info_commit_re = re.compile(r'<commit\s[^>]*revision="(\d+)"')
+    _svn_info_root_re = re.compile(r'<root>(.*?)</root>', re.S)
+    _svn_info_uuid_re = re.compile(r'<uuid>(.*?)</uuid>', re.S)
+
+    def svn_last_changed_revisions(self, urls):
+        """
+        Returns a dictionary of ``{url: revision}``, with the revision
+        each svn URL was last changed in (URLs that can't be found
+        are left out).  The URLs that weren't looked up earlier in
+        this run are looked up with one ``svn info`` for each server.
+
+        The repository roots and UUIDs that ``svn info`` reports are
+        remembered too (for ``svn_mirror``).
+
+        Threads that ask at the same time wait for each other, so a
+        URL is only looked up once.
+        """
+        self._svn_info_lock.acquire()
+        try:
+            return self._svn_last_changed_revisions(urls)
+        finally:
+            self._svn_info_lock.release()
+
+    def _svn_last_changed_revisions(self, urls):
+        servers = []
+        by_server = {}
+        for url in urls:
+            url = url.rstrip('/')
+            if urllib.unquote(url) in self._svn_remote_revisions or self.simulate:
+                continue
+            scheme, netloc = urlparse.urlsplit(url)[:2]
+            server = '%s://%s' % (scheme, netloc)
+            if server not in by_server:
+                servers.append(server)
+                by_server[server] = []
+            if url not in by_server[server]:
+                by_server[server].append(url)
+        for server in servers:
+            server_urls = by_server[server]
+            for url in server_urls:
+                self._svn_remote_revisions[urllib.unquote(url)] = None
+            self.logger.info('Getting the last changed revision of %s repositories from %s'
+                             % (len(server_urls), server))
+            try:
+                stdout = self.run_command(
+                    ['svn', 'info', '--xml'] + server_urls,
+                    log_error=False, simulate=False, keep_output=True)
+            except RunCommandError, e:
+                # Some of the URLs may still have worked:
+                self.logger.info('Could not get the revisions of all the repositories: %s'
+                                 % (e.stderr or str(e)).strip())
+                stdout = e.stdout or ''
+            except OSError, e:
+                self.logger.warn('Unable to run svn command (%s)' % e)
+                continue
+            for entry in self._svn_info_entry_re.findall(stdout):
+                root_match = self._svn_info_root_re.search(entry)
+                uuid_match = self._svn_info_uuid_re.search(entry)
+                if root_match and uuid_match:
+                    root = unescape_xml(root_match.group(1)).strip().rstrip('/')
+                    self._svn_repositories[root] = uuid_match.group(1).strip()
+                url_match = self._svn_info_url_re.search(entry)
+                commit_match = self._svn_info_commit_re.search(entry)
+                if not url_match or not commit_match:
+                    continue
+                found = urllib.unquote(unescape_xml(url_match.group(1)).strip().rstrip('/'))
+                if found in self._svn_remote_revisions:
+                    self._svn_remote_revisions[found] = int(commit_match.group(1))
+        result = {}
+        for url in urls:
+            revision = self._svn_remote_revisions.get(urllib.unquote(url.rstrip('/')))
+            if revision is not None:
+                result[url] = revision
+        return result
+
     def _filter_svn(self, line):
         """
         Filters svn output
@@ -821,18 +1353,41 @@ class Maker(object):
         # @@
 
     _repo_url_re = re.compile(r'^URL:\s+(.*)$', re.MULTILINE)
+    _repo_revision_re = re.compile(r'^Revision:\s+(\d+)', re.MULTILINE)
 
     def _get_repo_url(self, path):
         """
         Get the subversion URL that path was checked out from
         """
-        ## FIXME: ideally we'd set LANG or something, as the output
-        ## can get i18n'd
+        info = self.svn_info(path)
+        if info is None:
+            return None
+        return info[0]
+
+    def svn_info(self, path):
+        """
+        Returns ``(url, revision)`` for the svn working copy at
+        ``path``, or None if it isn't a working copy.
+
+        The working copy's metadata is read directly (see
+        ``fassembler.svnwc``); ``svn info`` is only run if it is in a
+        format that can't be read.
+        """
+        path = self.path(path)
+        try:
+            return svnwc.working_copy_info(path)
+        except svnwc.UnknownFormat, e:
+            self.logger.debug('%s; using svn info' % e)
+        # Otherwise the output gets translated:
+        env = os.environ.copy()
+        env['LC_ALL'] = 'C'
         try:
             stdout = self.run_command(
                 ['svn', 'info', path],
                 log_error=False,
-                simulate=False)
+                simulate=False,
+                keep_output=True,
+                env=env)
         except RunCommandError, e:
             if 'is not a working copy' in e.stderr:
                 # Not really a problem
@@ -845,7 +1400,13 @@ class Maker(object):
             raise ValueError(
                 "Could not determine svn URL of %s; output:\n%s"
                 % (path, stdout))
-        return match.group(1).strip().rstrip('/')
+        url = match.group(1).strip().rstrip('/')
+        match = self._repo_revision_re.search(stdout)
+        if match:
+            revision = int(match.group(1))
+        else:
+            revision = None
+        return url, revision
 
     all_answer = None
 
@@ -1081,6 +1642,17 @@ Responses:
             full_message = self.logger.colorize(full_message, 'bold cyan')
         if first_char:
             responses = [res.strip('()')[0] for res in responses]
+        # Questions can come from several threads at once (see
+        # InstallSpec.checkout_editables); ask them one at a time:
+        self._ask_lock.acquire()
+        try:
+            return self._ask_loop(full_message, msg_responses, responses,
+                                  default, help, first_char)
+        finally:
+            self._ask_lock.release()
+
+    def _ask_loop(self, full_message, msg_responses, responses, default,
+                  help, first_char):
         while 1:
             self.beep_if_necessary()
             while 1:
@@ -1115,6 +1687,31 @@ Responses:
             sys.stdout.write(chr(7))
             sys.stdout.flush()
             
+    def add_cleanup(self, func, *args):
+        """
+        Call ``func(*args)`` at the end of the run (from
+        ``run_cleanups``), whether or not it succeeded.
+        """
+        self._cleanups.append((func, args))
+
+    def run_cleanups(self):
+        """
+        Calls the functions given to ``add_cleanup``, the last one
+        first.  Errors are logged, and the rest are still called.
+        Returns true if none of them failed.
+        """
+        ok = True
+        while self._cleanups:
+            func, args = self._cleanups.pop()
+            try:
+                func(*args)
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self.logger.fatal('Error cleaning up: %s' % e, color='bold red')
+                ok = False
+        return ok
+
     def handle_exception(self, exc_info, can_continue=False, can_retry=False):
         """
         Give an interactive way to handle an exception.
@@ -1174,6 +1771,95 @@ Responses:
         """
         self.run_command(['wget', '--no-check-certificate', url, '-O', filename])
 
+    def unpack_tarball(self, url, dest_dir, cache=None, checksum=None,
+                       incremental=False):
+        """
+        Downloads the tarball at ``url`` (a URL or a local filename)
+        and unpacks it into ``dest_dir`` as it is downloaded, without
+        writing the tarball itself anywhere.
+
+        If ``cache`` (a ``fassembler.artifacts.ArtifactCache``) is
+        given, a copy of the tarball is stored in it at the same time,
+        and the copy is unpacked instead of downloading the tarball
+        again the next time.  ``checksum`` is the sha1 the tarball
+        should have, if known.
+
+        If ``incremental`` is true only the files that changed since
+        the last time a tarball was unpacked into ``dest_dir`` are
+        written, and files that are not in the tarball anymore are
+        removed (see ``fassembler.artifacts.update_stream``).
+        """
+        dest_dir = self.path(dest_dir)
+        if incremental:
+            extract = artifacts.update_stream
+        else:
+            extract = artifacts.extract_stream
+        if self.simulate:
+            self.logger.notify('Would download and unpack %s into %s'
+                               % (url, self.display_path(dest_dir)))
+            return
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if not urlparse.urlsplit(url)[0]:
+            # A local file
+            self.logger.notify('Unpacking %s into %s' % (url, self.display_path(dest_dir)))
+            f = open(url, 'rb')
+            try:
+                extract(f, dest_dir, self.logger, self.compress_jobs)
+            finally:
+                f.close()
+            return
+        cached = None
+        if cache is not None:
+            cached = cache.lookup(url, checksum)
+        if cached is not None:
+            self.logger.notify('Unpacking %s (cached copy of %s) into %s'
+                               % (cached, url, self.display_path(dest_dir)))
+            f = open(cached, 'rb')
+            try:
+                extract(f, dest_dir, self.logger, self.compress_jobs)
+            finally:
+                f.close()
+            return
+        self.logger.notify('Downloading %s and unpacking it into %s'
+                           % (url, self.display_path(dest_dir)))
+        start = time.time()
+        response = self._open_url(url)
+        tmp_filename = copy = None
+        if cache is not None:
+            tmp_filename, copy = cache.start(url)
+        stream = artifacts.DownloadStream(response, copy)
+        try:
+            try:
+                count = extract(stream, dest_dir, self.logger, self.compress_jobs)
+                digest = stream.finish()
+            except:
+                stream.close()
+                raise
+            if checksum and digest != checksum:
+                raise ValueError(
+                    "The tarball %s has the wrong checksum (sha1 %s; expected %s)"
+                    % (url, digest, checksum))
+        except:
+            if tmp_filename is not None:
+                cache.abort(tmp_filename)
+            raise
+        self.logger.info('Unpacked %s files (%.1fMB in %.1fs)'
+                         % (count, stream.bytes / 1048576.0, time.time() - start))
+        if tmp_filename is not None:
+            cache.commit(url, tmp_filename, digest)
+
+    def _open_url(self, url):
+        import urllib2
+        kw = {}
+        try:
+            import ssl
+            # Like wget --no-check-certificate in retrieve():
+            kw['context'] = ssl._create_unverified_context()
+        except (ImportError, AttributeError):
+            pass
+        return urllib2.urlopen(url, **kw)
+
     def backup(self, filename):
         """
         Moves the filename (file or directory) to a new location,
@@ -1218,3 +1904,12 @@ def dict_diff(d1, d2):
             lines.append('%s=%r (previously: %r)' % (key, d1[key], d2[key]))
     return '\n'.join(lines)
         
+
+def unescape_xml(text):
+    """
+    Undoes the escaping of text in XML (just the entities svn uses).
+    """
+    for entity, char in [('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+                         ('&apos;', "'"), ('&amp;', '&')]:
+        text = text.replace(entity, char)
+    return text
@@ -6,11 +6,89 @@ from UserDict import DictMixin
 from tempita import Template
 from cmdutils import CommandError
 import sys
+import threading
 from fassembler.util import asbool
 from fassembler.text import indent, underline, dedent
 
 _in_broken_ns = False
 
+class TemplateCache(object):
+    """
+    Keeps compiled templates, so that a string that is interpolated
+    over and over again is only parsed once.  Templates are keyed by
+    their content and name; when there are more than ``size`` the
+    least recently used ones are dropped.
+
+    ``hits`` and ``misses`` count how often a template was found in
+    the cache or had to be compiled.
+    """
+
+    def __init__(self, size=2000):
+        self.size = size
+        self.templates = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        # Templates are filled in from several threads at once (see
+        # InstallSpec.checkout_editables):
+        self.lock = threading.Lock()
+
+    def get(self, content, name=None, stacklevel=None):
+        """
+        Returns the compiled template for ``content``.  Like
+        ``tempita.Template``, if ``name`` is not given and stacklevel
+        is, the name comes from the calling frame (though the name of
+        a cached template is the name it got when it was compiled).
+        """
+        key = (type(content), content, name)
+        self.lock.acquire()
+        try:
+            self.clock += 1
+            entry = self.templates.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry[0] = self.clock
+                return entry[1]
+            self.misses += 1
+        finally:
+            self.lock.release()
+        if stacklevel is not None:
+            stacklevel += 1
+        tmpl = Template(content, name=name, stacklevel=stacklevel)
+        self.lock.acquire()
+        try:
+            self.templates[key] = [self.clock, tmpl]
+            if len(self.templates) > self.size:
+                self.evict()
+        finally:
+            self.lock.release()
+        return tmpl
+
+    def evict(self):
+        """
+        Drops the least recently used templates.  A quarter of the
+        cache is dropped at once, so this doesn't happen often.
+        Called with ``lock`` held.
+        """
+        entries = [(entry[0], key) for key, entry in self.templates.items()]
+        entries.sort()
+        for last_used, key in entries[:len(entries) - self.size*3/4]:
+            del self.templates[key]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.templates.clear()
+        finally:
+            self.lock.release()
+
+    def __str__(self):
+        return '%s templates cached, %s hits, %s misses' % (
+            len(self.templates), self.hits, self.misses)
+
+# Shared by everything that interpolates strings:
+template_cache = TemplateCache()
+
 class Namespace(DictMixin):
     """
     Represents a namespace that templates are executed in.
@@ -40,6 +118,69 @@ class Namespace(DictMixin):
         if name:
             self.dict['__name__'] = self.name
         self.dict.update(self.builtins)
+        # Memoized values of config options, by scope (see resolve()):
+        self.resolved = {}
+        # Maps an option to the options whose values read it:
+        self.dependents = {}
+        # Holds the options being resolved right now in each thread
+        # (see resolving):
+        self._local = threading.local()
+        self.memo_configs = []
+        # The namespace this is an overlay of (see overlay()):
+        self.base = None
+
+    @property
+    def resolving(self):
+        """
+        The options being resolved right now, in this thread (values
+        can be interpolated in several threads at once).
+        """
+        try:
+            return self._local.resolving
+        except AttributeError:
+            self._local.resolving = []
+            return self._local.resolving
+
+    def overlay(self):
+        """
+        Returns a new namespace that starts out with the same values
+        as this one, and that can be changed without affecting this
+        namespace.  Its sections are interpolated in the overlay (so
+        settings can use what is added to it, like ``task``), but the
+        memoized values are kept with this namespace (see ``scope``).
+        """
+        ns = self.__class__(self.name)
+        ns.base = self.base or self
+        ns.dict = self.dict.copy()
+        sections = {}
+        for key, value in ns.dict.items():
+            if isinstance(value, SectionNamespace):
+                if id(value) not in sections:
+                    sections[id(value)] = SectionNamespace(
+                        ns, value.config, value.section, name=value.name)
+                ns.dict[key] = sections[id(value)]
+        ns.resolved = self.resolved
+        ns.dependents = self.dependents
+        ns._local = self._local
+        ns.memo_configs = self.memo_configs
+        return ns
+
+    def scope(self):
+        """
+        What this namespace adds to the base namespace it is an
+        overlay of (like ``task``), as a key for memoized values,
+        since a value may depend on those.
+        """
+        if self.base is None:
+            return ()
+        base_dict = self.base.dict
+        items = []
+        for key, value in self.dict.items():
+            if (base_dict.get(key) is not value
+                and not isinstance(value, SectionNamespace)):
+                items.append((key, id(value)))
+        items.sort()
+        return tuple(items)
 
     ## All the UserDict abstract methods:
 
@@ -69,6 +210,10 @@ class Namespace(DictMixin):
             subname = section
         ns = SectionNamespace(self, config, section, name=subname)
         self.dict[variable or section] = ns
+        if (config not in self.memo_configs
+            and hasattr(config, 'add_change_listener')):
+            config.add_change_listener(self)
+            self.memo_configs.append(config)
 
     def add_all_sections(self, config):
         """
@@ -100,18 +245,79 @@ class Namespace(DictMixin):
                     pass
                 else:
                     name = caller.f_globals.get('__name__') or name
-        tmpl = Template(string, name=name)
-        try:
-            old_self = None
-            if self is not None:
-                old_self = self_.dict.get('self')
-                self_.dict['self'] = self
-            return tmpl.substitute(self_.dict)
-        finally:
-            if old_self is not None:
-                self_.dict['self'] = old_self
-            elif 'self' in self_.dict:
-                del self_.dict['self']
+        tmpl = template_cache.get(string, name=name)
+        # A copy, so that ``self`` (and anything the template sets)
+        # isn't seen by interpolations in other threads:
+        vars = self_.dict.copy()
+        if self is not None:
+            vars['self'] = self
+        return tmpl.substitute(vars)
+
+    def resolve(self, section_ns, key):
+        """
+        Returns the interpolated value of ``key`` in the section.
+
+        Values are memoized, along with the options each value read
+        while it was interpolated, so that when an option is changed
+        (see ``config_changed``) exactly the values that depend on it
+        are forgotten.  Values can also depend on things other than
+        options (``env``, files...), so the project forgets all of them
+        before each task (see ``forget_resolved``).  Values are
+        memoized separately for each ``scope()``.
+        """
+        config = section_ns.config
+        record = self.note_read(config, section_ns.section, key)
+        scope = self.scope()
+        values = self.resolved.get(record)
+        if values is not None and scope in values:
+            return values[scope]
+        value = section_ns[key]
+        if isinstance(value, basestring):
+            self.resolving.append(record)
+            try:
+                value = self.interpolate(value, name=section_ns.name, self=section_ns)
+            finally:
+                self.resolving.pop()
+        if config in self.memo_configs:
+            self.resolved.setdefault(record, {})[scope] = value
+        return value
+
+    def note_read(self, config, section, key):
+        """
+        Records that the option is being read (by the option being
+        resolved, if any).  Returns the key used for the option.
+        """
+        record = (config, config.sectionxform(section), config.optionxform(key))
+        if self.resolving:
+            self.dependents.setdefault(record, {})[self.resolving[-1]] = True
+        return record
+
+    def config_changed(self, config, section, option):
+        """
+        Called by the config when ``option`` in ``section`` is changed
+        (``option`` is None if the whole section changed).
+        """
+        default_section = config.sectionxform('DEFAULT')
+        for record in self.resolved.keys() + self.dependents.keys():
+            if (record[0] is config
+                and (record[1] == section or section == default_section)
+                and (option is None or record[2] == option)):
+                self.invalidate(record)
+
+    def forget_resolved(self):
+        """
+        Forgets all the memoized values.
+        """
+        self.resolved.clear()
+        self.dependents.clear()
+
+    def invalidate(self, record):
+        """
+        Forgets the value of an option, and of everything that read it.
+        """
+        self.resolved.pop(record, None)
+        for dependent in self.dependents.pop(record, {}).keys():
+            self.invalidate(dependent)
 
     def string_repr(self, detail=0):
         """
@@ -239,6 +445,7 @@ class SectionNamespace(DictMixin):
         self.name = name
 
     def __getitem__(self, key):
+        self.ns.note_read(self.config, self.section, key)
         if self.config.has_option(self.section, key):
             return self.config.get(self.section, key)
         elif key in self.config.defaults():
@@ -258,6 +465,7 @@ class SectionNamespace(DictMixin):
         return self.config.options(self.section)
 
     def __contains__(self, key):
+        self.ns.note_read(self.config, self.section, key)
         return (self.config.has_option(self.section, key)
                 or key in self.config.defaults())
 
@@ -268,10 +476,7 @@ class SectionNamespace(DictMixin):
     def __getattr__(self, key):
         if key not in self:
             raise AttributeError(key)
-        value = self[key]
-        if isinstance(value, basestring):
-            value = self.ns.interpolate(value, name=self.name, self=self)
-        return value
+        return self.ns.resolve(self, key)
 
     def string_repr(self, detail=0):
         """
@@ -0,0 +1,319 @@
+"""
+Compressing and decompressing bzip2 using several processes.
+
+``compress_file`` works like pbzip2: the file is cut into blocks of
+900k (bzip2's own block size), and each block is compressed on its
+own, in a pool of processes.  The result is a bzip2 file made of
+several streams, one after the other; ``bzip2`` (and ``tar jfx``)
+read that as a single file.
+
+``ParallelBZ2Reader`` decompresses such files: it finds where each
+stream starts and decompresses the streams in a pool of processes, in
+the order they come.  Ordinary bzip2 files (a single stream) are
+decompressed in this process, as they would be anyway.
+
+The pools use ``multiprocessing``; without it (Python 2.5 and
+earlier) everything is done in this process.  The number of processes
+is given by ``--compress-jobs`` (or the ``compress_jobs`` setting in
+``[general]``), and is the number of CPUs by default.
+"""
+
+import bz2
+import os
+import re
+from collections import deque
+from fassembler.util import cpu_count
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# bzip2's block size with -9:
+block_size = 900*1000
+
+# How much is read from the compressed file at once:
+read_size = 256*1024
+
+# If this much compressed data has been read without finding the
+# start of another stream, the file is taken to be an ordinary bzip2
+# file (a single stream):
+max_stream_size = 4*1024*1024
+
+# The header of a stream, followed by the header of its first block
+# (the "BZh9" and the 48-bit block magic, pi):
+_stream_start_re = re.compile(r'BZh[1-9]1AY&SY')
+
+def make_pool(jobs):
+    """
+    Returns a pool of ``jobs`` processes (by default, one per CPU), or
+    None if only one process should be used.
+    """
+    if jobs is None:
+        jobs = cpu_count()
+    if jobs <= 1 or multiprocessing is None:
+        return None
+    return multiprocessing.Pool(jobs)
+
+def ordered_map(pool, func, items, window):
+    """
+    Like ``pool.imap(func, items)``, but doesn't read ahead more than
+    ``window`` items (``imap`` reads all of ``items`` right away).
+    """
+    if pool is None:
+        for item in items:
+            yield func(item)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def compress_block(data):
+    return bz2.compress(data, 9)
+
+def read_blocks(fileobj):
+    while 1:
+        data = fileobj.read(block_size)
+        if not data:
+            break
+        yield data
+
+def compress_file(source, dest, jobs=None):
+    """
+    Compresses the file ``source`` to ``dest``, compressing blocks of
+    the file in ``jobs`` processes at once.
+    """
+    if jobs is None:
+        jobs = cpu_count()
+    pool = make_pool(jobs)
+    tmp_dest = '%s.tmp-%s' % (dest, os.getpid())
+    f = open(source, 'rb')
+    try:
+        out = open(tmp_dest, 'wb')
+        try:
+            for data in ordered_map(pool, compress_block, read_blocks(f), jobs * 2):
+                out.write(data)
+        finally:
+            out.close()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    finally:
+        f.close()
+    os.rename(tmp_dest, dest)
+
+def stream_ended(decompressor):
+    """
+    True if the decompressor has read the whole stream.
+    """
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+def decompress_streams(data):
+    """
+    Decompresses ``data``, one or more complete bzip2 streams.
+    Returns ``(decompressed, ok)``; ``ok`` is false if ``data`` wasn't
+    exactly a number of streams.
+    """
+    output = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        try:
+            output.append(decompressor.decompress(data))
+        except IOError:
+            return '', False
+        if not stream_ended(decompressor):
+            return '', False
+        data = decompressor.unused_data
+    return ''.join(output), True
+
+class ParallelBZ2Reader(object):
+    """
+    A file-like object that reads the bzip2 file ``fileobj``,
+    decompressing it (with ``jobs`` processes, if it has several
+    streams).  ``head`` is anything already read from ``fileobj``.
+    """
+
+    def __init__(self, fileobj, jobs=None, head=''):
+        self.fileobj = fileobj
+        if jobs is None:
+            jobs = cpu_count()
+        self.jobs = jobs
+        self.head = head
+        self.pool = None
+        self._chunks = self._decompress()
+        self._data = ''
+        self._pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._data):
+                try:
+                    self._data = self._chunks.next()
+                except StopIteration:
+                    self._data = ''
+                    break
+                self._pos = 0
+                continue
+            if size < 0:
+                part = self._data[self._pos:]
+            else:
+                part = self._data[self._pos:self._pos+size]
+                size -= len(part)
+            self._pos += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _decompress(self):
+        """
+        Yields the decompressed data.  The compressed data is cut up
+        at the start of each stream, and the pieces are decompressed
+        in the pool.
+        """
+        if self.jobs <= 1 or multiprocessing is None:
+            for data in self._decompress_sequentially(self.head):
+                yield data
+            return
+        buffer = self.head
+        # Where to look for the start of the next stream in buffer:
+        search_from = 1
+        pending = deque()
+        done = False
+        while not done:
+            data = self.fileobj.read(read_size)
+            if data:
+                buffer += data
+            else:
+                done = True
+            while 1:
+                match = _stream_start_re.search(buffer, search_from)
+                if match is None:
+                    # The start may be cut off at the end:
+                    search_from = max(1, len(buffer) - 9)
+                    break
+                search_from = 1
+                if self.pool is None:
+                    # The pool is only started once we know this is
+                    # a file with several streams:
+                    self.pool = multiprocessing.Pool(self.jobs)
+                piece = buffer[:match.start()]
+                buffer = buffer[match.start():]
+                pending.append((piece, self.pool.apply_async(decompress_streams, (piece,))))
+            if done:
+                if buffer:
+                    if self.pool is None:
+                        pending.append((buffer, None))
+                    else:
+                        pending.append((buffer, self.pool.apply_async(decompress_streams, (buffer,))))
+                    buffer = ''
+            elif len(buffer) > max_stream_size:
+                # An ordinary bzip2 file
+                break
+            while pending and (done or len(pending) > self.jobs * 2):
+                piece, result = pending.popleft()
+                if result is None:
+                    data, ok = decompress_streams(piece)
+                else:
+                    data, ok = result.get()
+                if not ok:
+                    # Maybe the data just happened to look like the
+                    # start of a stream, maybe it's broken (then
+                    # decompressing it again will say so):
+                    buffer = ''.join([piece] + [p for p, r in pending] + [buffer])
+                    pending.clear()
+                    done = False
+                    break
+                yield data
+            else:
+                continue
+            break
+        # Whatever wasn't decompressed in the pool:
+        rest = ''.join([p for p, r in pending] + [buffer])
+        pending.clear()
+        if rest or not done:
+            for data in self._decompress_sequentially(rest):
+                yield data
+
+    def _decompress_sequentially(self, data):
+        """
+        Decompresses ``data`` followed by the rest of the file, in
+        this process.
+        """
+        decompressor = bz2.BZ2Decompressor()
+        started = False
+        while 1:
+            while data:
+                if not started and not 'BZh'.startswith(data[:3]):
+                    # Like bzip2, ignore trailing garbage
+                    return
+                started = True
+                try:
+                    output = decompressor.decompress(data)
+                except EOFError:
+                    # The last stream ended at the end of the last
+                    # piece of data; this is the next one:
+                    decompressor = bz2.BZ2Decompressor()
+                    started = False
+                    continue
+                data = decompressor.unused_data
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
+                    started = False
+                if output:
+                    yield output
+            data = self.fileobj.read(read_size)
+            if not data:
+                break
+        if started and not stream_ended(decompressor):
+            raise IOError('The bzip2 data ends in the middle of a stream')
+
+class PeekedFile(object):
+    """
+    A file-like object reading ``head`` (already read from
+    ``fileobj``) and then the rest of ``fileobj``.
+    """
+
+    def __init__(self, fileobj, head):
+        self.fileobj = fileobj
+        self.head = head
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+        if size < 0:
+            data = self.head + self.fileobj.read()
+            self.head = ''
+            return data
+        data = self.head[:size]
+        self.head = self.head[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+    def close(self):
+        pass
+
+def open_stream(fileobj, jobs=None):
+    """
+    Returns a file-like object to read the tarball in ``fileobj``
+    from: if it is compressed with bzip2 the object decompresses it
+    (with ``ParallelBZ2Reader``), otherwise it gives the data as it is
+    (``tarfile`` can decompress that).  Close it when done.
+    """
+    head = fileobj.read(3)
+    if head == 'BZh':
+        return ParallelBZ2Reader(fileobj, jobs, head)
+    return PeekedFile(fileobj, head)
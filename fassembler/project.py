@@ -7,7 +7,9 @@ import os
 import sys
 import re
 from cStringIO import StringIO
-from fassembler.namespace import Namespace
+from fnmatch import fnmatch
+from fassembler.buildstate import fingerprint_task, signature_hash
+from fassembler.namespace import Namespace, template_cache
 from fassembler.text import indent, underline, dedent
 from cmdutils import CommandError
 from tempita import Template
@@ -59,6 +61,7 @@ class Project(object):
             raise NotImplementedError(
                 "No name has been assigned to %r" % self)
         self.build_properties = {}
+        self._base_namespace = None
 
     @property
     def config_section(self):
@@ -102,32 +105,119 @@ class Project(object):
                 % self)
         self.setup_config()
         tasks = self.bind_tasks()
-        for task in tasks:
+        state = self.environ.build_state
+        resuming = self.maker.resume
+        if not resuming:
+            state.clear('checkpoint', self.name)
+        # Fingerprints are only needed up to the last incremental task:
+        last_incremental = -1
+        for index, task in enumerate(tasks):
+            if task.incremental:
+                last_incremental = index
+        previous = ''
+        forced = False
+        for index, task in enumerate(tasks):
             self.logger.set_section(self.name+'.'+task.name)
-            self.logger.notify('== %s ==' % task.name, color='bold green')
-            self.logger.indent += 2
-            while 1:
-                try:
-                    try:
-                        self.logger.debug('Task Plan:')
-                        self.logger.debug(indent(str(task), '  '))
-                        task.run()
-                    finally:
-                        self.logger.indent -= 2
-                except (KeyboardInterrupt, CommandError):
-                    raise
-                except:
-                    should_continue = self.maker.handle_exception(sys.exc_info(), can_continue=True,
-                                                                  can_retry=True)
-                    if should_continue == 'retry':
-                        self.logger.notify('Retrying task %s' % task.name)
+            # Settings may depend on what the tasks before did:
+            self.forget_resolved_settings()
+            key = '%s %s' % (index, task.name)
+            signature = signature_hash(task)
+            if resuming:
+                checkpoint = state.get('checkpoint', self.name, key)
+                if checkpoint is not None and signature is not None:
+                    checkpoint_signature, checkpoint_previous = checkpoint.split(' ', 1)
+                    if checkpoint_signature == signature:
+                        self.logger.notify('== %s (done in an earlier run, skipping) ==' % task.name,
+                                           color='green')
+                        previous = checkpoint_previous
                         continue
-                    if not should_continue:
-                        self.logger.fatal('Project %s aborted.' % self.title, color='red')
-                        raise CommandError('Aborted', show_usage=False)
-                break
+                resuming = False
+                if index:
+                    self.logger.notify('Resuming project %s at task %s'
+                                       % (self.project_name, task.name), color='bold green')
+            # Everything after a forced task is run too, as it might
+            # depend on what the forced task does:
+            forced = forced or self.task_is_forced(task)
+            succeeded = None
+            if task.incremental and not forced:
+                fingerprint = fingerprint_task(task, previous)
+                if (fingerprint is not None
+                    and fingerprint == state.get('fingerprint', self.name, key)):
+                    self.logger.notify('== %s (unchanged, skipping) ==' % task.name, color='green')
+                    previous = fingerprint
+                    succeeded = True
+            if succeeded is None:
+                profile = self.maker.profile
+                if profile is not None:
+                    started = profile.start()
+                try:
+                    succeeded = self.run_task(task)
+                finally:
+                    if profile is not None:
+                        profile.add_task(self, task, started)
+                if index <= last_incremental:
+                    fingerprint = None
+                    if succeeded:
+                        fingerprint = fingerprint_task(task, previous)
+                    if task.incremental:
+                        state.set('fingerprint', self.name, key, fingerprint)
+                    if fingerprint is None:
+                        # Nothing after this can be trusted to be unchanged:
+                        previous = os.urandom(20).encode('hex')
+                    else:
+                        previous = fingerprint
+            if succeeded and signature is not None:
+                # So that --resume can start after this task:
+                state.set('checkpoint', self.name, key, '%s %s' % (signature, previous))
+            state.save()
+        # The project is done, so --resume has nothing to pick up:
+        state.clear('checkpoint', self.name)
+        state.save()
+        self.maker.flush_svn_adds()
         self.environ.add_built_project(self.project_name)
 
+    def run_task(self, task):
+        """
+        Runs a single task, handling any errors.  Returns true if the
+        task succeeded (false if it failed, but the user chose to
+        continue anyway).
+        """
+        self.logger.notify('== %s ==' % task.name, color='bold green')
+        self.logger.indent += 2
+        while 1:
+            try:
+                try:
+                    self.logger.debug('Task Plan:')
+                    self.logger.debug(indent(str(task), '  '))
+                    task.run()
+                    return True
+                finally:
+                    # Files the task created are added to svn together:
+                    self.maker.flush_svn_adds()
+                    self.logger.indent -= 2
+            except (KeyboardInterrupt, CommandError):
+                raise
+            except:
+                should_continue = self.maker.handle_exception(sys.exc_info(), can_continue=True,
+                                                              can_retry=True)
+                if should_continue == 'retry':
+                    self.logger.notify('Retrying task %s' % task.name)
+                    continue
+                if not should_continue:
+                    self.logger.fatal('Project %s aborted.' % self.title, color='red')
+                    raise CommandError('Aborted', show_usage=False)
+                return False
+
+    def task_is_forced(self, task):
+        """
+        True if the task was named with ``--force-task``.
+        """
+        for pattern in self.maker.force_tasks:
+            if (fnmatch(task.name, pattern)
+                or fnmatch('%s.%s' % (self.name, task.name), pattern)):
+                return True
+        return False
+
     def bind_tasks(self):
         """
         Bind all the task instances to the context in which they will
@@ -139,7 +229,11 @@ class Project(object):
                       logger=self.logger, config=self.config,
                       project=self)
             task.confirm_settings()
+            old_properties = self.build_properties.copy()
             task.setup_build_properties()
+            if self.build_properties != old_properties:
+                # Settings may refer to the build properties:
+                self.invalidate_namespace()
             tasks.append(task)
         return tasks
 
@@ -222,7 +316,7 @@ class Project(object):
             if not isinstance(string, basestring):
                 # Not a template at all, don't substitute
                 return string
-            tmpl = Template(string, name=name, stacklevel=stacklevel+1)
+            tmpl = template_cache.get(string, name=name, stacklevel=stacklevel+1)
         else:
             tmpl = string
         return ns.execute_template(tmpl)
@@ -233,16 +327,38 @@ class Project(object):
 
         Each call returns a new namespace.  This namespace can be
         further augmented (as it is by tasks).
+
+        The namespaces are overlays of a single base namespace, which
+        is only built again after ``invalidate_namespace()``.
+        """
+        if self._base_namespace is None:
+            ns = Namespace(self.config_section)
+            ns['env'] = self.environ
+            ns['maker'] = self.maker
+            ns['project'] = self
+            ns['os'] = os
+            ns['re'] = re
+            ns.add_all_sections(self.config)
+            ns['config'] = ns[self.config_section]
+            self._base_namespace = ns
+        return self._base_namespace.overlay()
+
+    def invalidate_namespace(self):
+        """
+        Call this when the configuration has changed (sections added,
+        or the environment's config reloaded), so that the namespace
+        is built again.
+        """
+        self._base_namespace = None
+
+    def forget_resolved_settings(self):
+        """
+        Forgets the memoized values of the settings (see
+        ``Namespace.resolve``), which may depend on more than the
+        configuration (``env``, files that exist...).
         """
-        ns = Namespace(self.config_section)
-        ns['env'] = self.environ
-        ns['maker'] = self.maker
-        ns['project'] = self
-        ns['os'] = os
-        ns['re'] = re
-        ns.add_all_sections(self.config)
-        ns['config'] = ns[self.config_section]
-        return ns
+        if self._base_namespace is not None:
+            self._base_namespace.forget_resolved()
 
     def setup_config(self):
         """
@@ -261,6 +377,7 @@ class Project(object):
                 default = setting.get_default(self.environ)
                 if default is not None:
                     self.config.set(self.config_section, setting.name, default)
+        self.invalidate_namespace()
 
     def confirm_on_path(self, *executables):
         """
@@ -0,0 +1,304 @@
+"""
+Builds several projects at once.
+
+Projects are run in forked worker processes.  A project is started
+only once every project it names in ``depends_on_projects`` (and
+that is part of the same run) has finished successfully; projects
+that don't depend on each other are built concurrently.
+"""
+
+import errno
+import os
+import select
+import signal
+import sys
+import traceback
+from cmdutils import CommandError
+from fassembler import zeocontrol
+from fassembler.util import DirectoryLock
+
+def normalize_project_name(name):
+    """
+    Turns a project name as given on the command line or in
+    ``depends_on_projects`` (like ``'fassembler:topp'`` or ``'topp'``)
+    into the name used to refer to the project in ``etc/projects.txt``
+    (``'topp'``).  This matches ``fassembler.command.ep_to_name``.
+    """
+    if ':' in name:
+        dist_name, ep_name = name.split(':', 1)
+        if ep_name == 'main':
+            return dist_name
+        return ep_name
+    return name
+
+class PrefixedWriter(object):
+    """
+    Wraps a file-like object, putting a prefix in front of every line
+    written to it.  Used for the log file of a worker process.
+    """
+
+    def __init__(self, file, prefix):
+        self.file = file
+        self.prefix = prefix
+
+    def write(self, text):
+        lines = text.splitlines(True)
+        self.file.write(''.join([self.prefix + line for line in lines]))
+        self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+class Worker(object):
+    """
+    A single forked process building one project.
+    """
+
+    def __init__(self, project, pid, fd):
+        self.project = project
+        self.pid = pid
+        self.fd = fd
+        self.buffer = ''
+
+    @property
+    def name(self):
+        return self.project.project_name
+
+class ProjectScheduler(object):
+    """
+    Runs ``projects`` using up to ``jobs`` worker processes at a time.
+
+    Output from each worker is shown prefixed with its project name.
+    After any project fails no new projects are started; projects
+    that are already running are allowed to finish.
+    """
+
+    def __init__(self, projects, maker, environ, logger, jobs):
+        self.projects = projects
+        self.maker = maker
+        self.environ = environ
+        self.logger = logger
+        self.jobs = jobs
+        self.names = {}
+        for project in projects:
+            self.names[normalize_project_name(project.project_name)] = project
+        self.started = []
+        self.done = []
+        self.failed = []
+        self.workers = {}
+
+    def dependencies(self, project):
+        """
+        The projects in this run that ``project`` has to wait for.
+        """
+        deps = []
+        for name in project.depends_on_projects:
+            dep = self.names.get(normalize_project_name(name))
+            if dep is not None and dep is not project:
+                deps.append(dep)
+        return deps
+
+    def check_cycles(self):
+        """
+        Raises CommandError if the projects depend on each other in a loop.
+        """
+        finished = {}
+        def visit(project, path):
+            if project in path:
+                names = [p.project_name for p in path[path.index(project):]]
+                raise CommandError(
+                    'Projects depend on each other in a loop: %s'
+                    % ' -> '.join(names + [project.project_name]),
+                    show_usage=False)
+            if project in finished:
+                return
+            for dep in self.dependencies(project):
+                visit(dep, path + [project])
+            finished[project] = True
+        for project in self.projects:
+            visit(project, [])
+
+    def ready_projects(self):
+        """
+        Projects that haven't been started yet, and whose dependencies
+        are all done, in the order they were given.
+        """
+        result = []
+        for project in self.projects:
+            if project in self.started:
+                continue
+            for dep in self.dependencies(project):
+                if dep not in self.done:
+                    break
+            else:
+                result.append(project)
+        return result
+
+    def run(self):
+        """
+        Build all the projects.  Returns true if all of them succeeded.
+        """
+        self.check_cycles()
+        self.maker.process_lock = DirectoryLock(self.maker.base_path)
+        # A ZEO server a project starts is used by the projects built
+        # after it in other workers, and stopped by this process at
+        # the end of the run:
+        zeocontrol.get_session(self.maker, self.logger).share()
+        if self.maker.interactive:
+            self.logger.notify(
+                'Building up to %s projects at once; questions cannot be asked, '
+                'so the defaults will be used' % self.jobs)
+        try:
+            while 1:
+                if not self.failed:
+                    for project in self.ready_projects():
+                        if len(self.workers) >= self.jobs:
+                            break
+                        self.start(project)
+                if not self.workers:
+                    break
+                self.wait()
+        except KeyboardInterrupt:
+            self.kill_workers()
+            raise CommandError('^C', show_usage=False)
+        not_built = [p.project_name for p in self.projects
+                     if p not in self.done and p not in self.failed]
+        if not_built:
+            self.logger.warn('Projects not built: %s' % ', '.join(not_built))
+        if self.failed:
+            self.logger.fatal('Projects failed: %s'
+                              % ', '.join([p.project_name for p in self.failed]),
+                              color='bold red')
+        return not self.failed and not not_built
+
+    def start(self, project):
+        """
+        Fork a worker process to build ``project``.
+        """
+        self.logger.notify('Starting project %s' % project.project_name,
+                           color='black green_bg')
+        self.started.append(project)
+        # Anything still buffered would be written by both processes:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read_fd)
+            for fd in self.workers:
+                os.close(fd)
+            os.dup2(write_fd, 1)
+            os.dup2(write_fd, 2)
+            os.close(write_fd)
+            self.run_child(project)
+            # run_child never returns
+        os.close(write_fd)
+        self.workers[read_fd] = Worker(project, pid, read_fd)
+
+    def run_child(self, project):
+        """
+        Runs in the worker process; builds the project and exits.
+        """
+        code = 1
+        try:
+            try:
+                self.maker.interactive = False
+                prefix = '[%s] ' % project.project_name
+                consumers = self.logger.consumers
+                for i in range(len(consumers)):
+                    level, consumer = consumers[i]
+                    if (hasattr(consumer, 'write')
+                        and consumer is not sys.stdout and consumer is not sys.stderr):
+                        consumers[i] = (level, PrefixedWriter(consumer, prefix))
+                try:
+                    project.run()
+                    self.environ.save()
+                    code = 0
+                finally:
+                    if self.maker.profile is not None:
+                        self.maker.profile.write_part()
+            except CommandError, e:
+                self.logger.fatal(str(e))
+            except KeyboardInterrupt:
+                pass
+            except:
+                self.logger.fatal('Error in project %s: %s'
+                                  % (project.project_name, sys.exc_info()[1]),
+                                  color='bold red')
+                traceback.print_exc()
+        finally:
+            try:
+                try:
+                    # Whatever the project kept running for the rest
+                    # of the run ends with this process (a shared ZEO
+                    # server is left to the parent, though):
+                    if not self.maker.run_cleanups():
+                        code = 1
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def wait(self):
+        """
+        Waits for output from the workers, showing it as it comes,
+        and collects any workers that have finished.
+        """
+        try:
+            readable = select.select(self.workers.keys(), [], [])[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            worker = self.workers[fd]
+            data = os.read(fd, 4096)
+            if data:
+                worker.buffer += data
+                lines = worker.buffer.split('\n')
+                worker.buffer = lines.pop()
+                for line in lines:
+                    self.show_line(worker, line)
+                continue
+            if worker.buffer:
+                self.show_line(worker, worker.buffer)
+            os.close(fd)
+            del self.workers[fd]
+            self.finish(worker)
+
+    def show_line(self, worker, line):
+        sys.stdout.write('[%s] %s\n' % (worker.name, line))
+        sys.stdout.flush()
+
+    def finish(self, worker):
+        """
+        Collects the exit status of a worker whose output has ended.
+        """
+        status = os.waitpid(worker.pid, 0)[1]
+        project = worker.project
+        if self.maker.profile is not None:
+            self.maker.profile.merge_part(worker.pid)
+        if os.WIFEXITED(status) and not os.WEXITSTATUS(status):
+            self.done.append(project)
+            self.logger.notify('Done with project %s' % project.project_name)
+            # The project may have saved settings that later projects
+            # need; they are in build.ini now:
+            self.environ.refresh_config()
+        else:
+            self.failed.append(project)
+            self.logger.fatal('Project %s failed' % project.project_name, color='bold red')
+
+    def kill_workers(self):
+        for worker in self.workers.values():
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for worker in self.workers.values():
+            try:
+                os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+            os.close(worker.fd)
+        self.workers = {}
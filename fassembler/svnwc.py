@@ -0,0 +1,133 @@
+"""
+Reads the metadata of svn working copies directly, instead of
+running ``svn info``.
+
+Working copies from svn 1.6 and earlier have a ``.svn/entries`` file
+in every directory (XML for svn 1.3 and earlier, a line-based format
+after that).  svn 1.7 and later keep everything in a sqlite database,
+``.svn/wc.db``, at the top of the working copy; that is read with
+``sqlite3`` if it is available.
+"""
+
+import os
+import re
+import urllib
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+class UnknownFormat(Exception):
+    """
+    Raised when the working copy's metadata can't be read (it is in a
+    format we don't know, or sqlite3 isn't available); ``svn info``
+    has to be used instead.
+    """
+
+def working_copy_info(path):
+    """
+    Returns ``(url, revision)`` for the working copy at ``path`` (the
+    revision as an int), or None if ``path`` isn't part of a working
+    copy.  Raises ``UnknownFormat`` if it can't tell.
+    """
+    path = os.path.abspath(path)
+    entries = os.path.join(path, '.svn', 'entries')
+    if os.path.exists(entries):
+        f = open(entries, 'rb')
+        content = f.read()
+        f.close()
+        if content.startswith('<?xml'):
+            return read_xml_entries(content, entries)
+        format = content.split('\n', 1)[0].strip()
+        if not format.isdigit():
+            raise UnknownFormat('Unknown format in %s' % entries)
+        format = int(format)
+        if 8 <= format <= 10:
+            return read_entries(content, entries)
+        if format >= 12 and os.path.exists(os.path.join(path, '.svn', 'wc.db')):
+            return read_wc_db(path, '')
+        raise UnknownFormat('Unknown working copy format %s in %s' % (format, entries))
+    if os.path.exists(os.path.join(path, '.svn', 'wc.db')):
+        return read_wc_db(path, '')
+    # With svn 1.7 and later only the top of the working copy has
+    # a .svn directory:
+    relpath = []
+    parent = path
+    while 1:
+        parent, name = os.path.split(parent)
+        if not name:
+            return None
+        relpath.insert(0, name)
+        if os.path.exists(os.path.join(parent, '.svn', 'wc.db')):
+            return read_wc_db(parent, '/'.join(relpath))
+        if os.path.exists(os.path.join(parent, '.svn')):
+            # An older working copy, that path isn't in
+            return None
+
+_xml_entry_re = re.compile(r'<entry\s([^>]*)>', re.S)
+_xml_attr_re = re.compile(r'(\w+)\s*=\s*"([^"]*)"')
+
+def read_xml_entries(content, filename):
+    """
+    Reads the XML ``entries`` files of svn 1.3 and earlier.
+    """
+    for match in _xml_entry_re.finditer(content):
+        attrs = dict(_xml_attr_re.findall(match.group(1)))
+        if attrs.get('name', '') == '':
+            if 'url' not in attrs or 'revision' not in attrs:
+                break
+            return attrs['url'].rstrip('/'), int(attrs['revision'])
+    raise UnknownFormat('No entry for the directory in %s' % filename)
+
+def read_entries(content, filename):
+    """
+    Reads the line-based ``entries`` files of svn 1.4 to 1.6.  The
+    first record is the directory itself; its fields are the name
+    (empty), kind, revision and URL.
+    """
+    record = content.split('\n\x0c\n', 1)[0]
+    lines = record.split('\n')
+    if len(lines) < 5 or lines[2] != 'dir':
+        raise UnknownFormat('No entry for the directory in %s' % filename)
+    try:
+        revision = int(lines[3])
+    except ValueError:
+        raise UnknownFormat('Bad revision %r in %s' % (lines[3], filename))
+    return lines[4].rstrip('/'), revision
+
+def read_wc_db(root, relpath):
+    """
+    Reads the information for ``relpath`` (a ``/``-separated path in
+    the working copy, ``''`` for the top) from the ``.svn/wc.db`` of
+    the working copy at ``root`` (svn 1.7 and later).
+    """
+    if sqlite3 is None:
+        raise UnknownFormat('sqlite3 is not available to read %s/.svn/wc.db' % root)
+    filename = os.path.join(root, '.svn', 'wc.db')
+    try:
+        conn = sqlite3.connect(filename)
+        try:
+            row = conn.execute(
+                'SELECT repository.root, nodes.repos_path, nodes.revision '
+                'FROM nodes JOIN repository ON nodes.repos_id = repository.id '
+                'WHERE nodes.local_relpath = ? AND nodes.op_depth = 0',
+                (relpath,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error, e:
+        raise UnknownFormat('Cannot read %s: %s' % (filename, e))
+    if row is None:
+        # Not versioned
+        return None
+    repos_root, repos_path, revision = row
+    if revision is None:
+        raise UnknownFormat('No revision for %r in %s' % (relpath, filename))
+    url = repos_root.rstrip('/')
+    if repos_path:
+        if isinstance(repos_path, unicode):
+            repos_path = repos_path.encode('utf8')
+        url += '/' + urllib.quote(repos_path, safe="/~!$&'()*+,;=:@")
+    return str(url), int(revision)
@@ -5,13 +5,18 @@ subclasses that actually do something.
 
 import copy
 import os
+import Queue
 import re
+import shutil
 import subprocess
 import sys
+import threading
 import urlparse
 
 from fassembler.distutilspatch import find_distutils_file, update_distutils_file
-from fassembler.util import asbool
+from fassembler.namespace import template_cache
+from fassembler.util import asbool, sha1
+from fassembler import venvclone
 from glob import glob
 from tempita import Template
 from types import StringTypes
@@ -45,6 +50,30 @@ class interpolated(object):
             self.__class__.__name__, self.name)
 
 
+def stable_repr(value):
+    """
+    Returns a repr of the value that will be the same from one run to
+    the next, or None if there isn't one (e.g., the value is an object
+    whose repr includes its id).
+    """
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        items = [stable_repr(item) for item in value]
+        if None in items:
+            return None
+        return '[%s]' % ', '.join(items)
+    if isinstance(value, dict):
+        items = []
+        for key, item in sorted(value.items()):
+            key, item = stable_repr(key), stable_repr(item)
+            if key is None or item is None:
+                return None
+            items.append('%s: %s' % (key, item))
+        return '{%s}' % ', '.join(items)
+    return None
+
+
 class Task(object):
     """
     Abstract base class for tasks
@@ -54,6 +83,14 @@ class Task(object):
     description = None
     name = interpolated('name')
 
+    # If true, the task is skipped when its fingerprint (see
+    # fassembler.buildstate.fingerprint_task) is the same as the last
+    # time it ran successfully:
+    incremental = False
+    # Attributes that are context, not part of what the task does:
+    unsigned_attributes = ['maker', 'environ', 'logger', 'config',
+                           'project', 'config_section', 'position']
+
     def __init__(self, name, stacklevel=1):
         self.name = name
         self.position = self._stacklevel_position(stacklevel+1)
@@ -107,7 +144,8 @@ class Task(object):
 
     def create_namespace(self):
         """
-        Create a task-local namespace.
+        Create a task-local namespace (an overlay of the project's
+        namespace).
         """
         ns = self.project.create_namespace()
         ns['task'] = self
@@ -129,7 +167,7 @@ class Task(object):
         ns = self.create_namespace()
         kw.setdefault('template_vars', ns.dict)
         def interpolater(content, vars, filename):
-            tmpl = Template(content, name=filename)
+            tmpl = template_cache.get(content, name=filename)
             return ns.execute_template(tmpl)
         kw.setdefault('interpolater', interpolater)
         method = getattr(self.maker, method_name)
@@ -184,6 +222,49 @@ class Task(object):
     def iter_subtasks(self):
         return []
 
+    def signature(self):
+        """
+        Returns a list of strings describing what this task does: its
+        class, and the values of all its (interpolated) attributes.
+        """
+        cls = self.__class__
+        sig = ['%s.%s' % (cls.__module__, cls.__name__)]
+        names = {}
+        for base in cls.__mro__:
+            for name, value in vars(base).items():
+                if isinstance(value, interpolated):
+                    names[name] = True
+        for name in sorted(names):
+            try:
+                value = getattr(self, name)
+            except AttributeError:
+                # Not set (yet)
+                continue
+            sig.append('%s=%s' % (name, stable_repr(value)))
+        for name, value in sorted(self.__dict__.items()):
+            if name in self.unsigned_attributes or (name.startswith('_') and name[1:] in names):
+                continue
+            value = stable_repr(value)
+            if value is not None:
+                sig.append('%s=%s' % (name, value))
+        return sig
+
+    def fingerprint_files(self):
+        """
+        Returns the files (or directories) this task reads, whose
+        content is part of its fingerprint.
+        """
+        return []
+
+    def fingerprint_data(self):
+        """
+        Returns strings that are part of the task's fingerprint, but
+        not of its signature: what it computes from the settings and
+        the files it reads (like the content of a template, filled
+        in).
+        """
+        return []
+
 class Script(Task):
     """
     Run a process/script
@@ -202,6 +283,9 @@ class Script(Task):
     {{if task.stdin}}
     Also send the text {{task.stdin|repr}} as stdin
     {{endif}}
+    {{if task.incremental}}
+    Skipped if nothing has changed since it last ran.
+    {{endif}}
     """
 
     script = interpolated('script')
@@ -209,16 +293,19 @@ class Script(Task):
     stdin = interpolated('stdin')
 
     def __init__(self, name, script, cwd=None, stacklevel=1, use_virtualenv=False,
-                 stdin=None, **extra_args):
+                 stdin=None, incremental=False, **extra_args):
         super(Script, self).__init__(name, stacklevel=stacklevel+1)
         self.script = script
         self.cwd = cwd
         self.use_virtualenv = use_virtualenv
         self.stdin = stdin
+        self.incremental = incremental
         self.extra_args = extra_args
 
     def run(self):
-        script = self.script
+        self.run_script(self.script)
+
+    def run_script(self, script):
         kw = self.extra_args.copy()
         if self.use_virtualenv:
             kw['script_abspath'] = self.venv_property('bin_path')
@@ -244,11 +331,55 @@ class CopyDir(Task):
         self.dest = dest
         self.add_dest_to_svn = add_dest_to_svn
 
+    incremental = True
+
     def run(self):
         self.logger.info(
             'Copying %s to %s' % (self.source, self.dest))
         self.copy_dir(self.source, self.dest, add_dest_to_svn=self.add_dest_to_svn)
 
+    def iter_files(self):
+        """
+        Yields ``(source, dest)`` for each file ``run`` copies (hidden
+        files are left out, as ``maker.copy_dir`` does).
+        """
+        source = self.source
+        template_vars = self.create_namespace().dict
+        dest_dir = self.maker.path(self.dest)
+        for dirpath, dirnames, filenames in os.walk(source):
+            for dirname in list(dirnames):
+                if dirname.startswith('.'):
+                    dirnames.remove(dirname)
+            dirnames.sort()
+            reldir = dirpath[len(source):].lstrip(os.path.sep)
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                dest = self.maker.fill_filename(
+                    self.maker.path(os.path.join(dest_dir, reldir, filename)), template_vars)
+                if dest.endswith('_tmpl'):
+                    dest = dest[:-5]
+                yield os.path.join(dirpath, filename), dest
+
+    def fingerprint_files(self):
+        # The copies are included so they are written again if they
+        # were changed or removed:
+        return [self.source] + [dest for source, dest in self.iter_files()]
+
+    def fingerprint_data(self):
+        # The templates, filled in with the current settings:
+        ns = self.create_namespace()
+        data = []
+        for source, dest in self.iter_files():
+            if source.endswith('_tmpl'):
+                f = open(source, 'rb')
+                try:
+                    content = f.read()
+                finally:
+                    f.close()
+                data.append(ns.execute_template(template_cache.get(content, name=source)))
+        return data
+
 class EnsureFile(Task):
     """
     Write a single file
@@ -274,6 +405,8 @@ class EnsureFile(Task):
     content = interpolated('content')
     content_path = interpolated('content_path')
 
+    incremental = True
+
     def __init__(self, name, dest, content=None, content_path=None, overwrite=True,
                  svn_add=False, executable=False, stacklevel=1,
                  force_overwrite=False):
@@ -306,6 +439,17 @@ class EnsureFile(Task):
         self.maker.ensure_file(self.dest, self.resolved_content, svn_add=self.svn_add,
                                overwrite=self.force_overwrite, executable=self.executable)
 
+    def fingerprint_files(self):
+        # The destination is included so the file is written again
+        # if it was changed or removed:
+        if self.content_path:
+            return [self.content_path, self.dest]
+        return [self.dest]
+
+    def fingerprint_data(self):
+        # The content, filled in with the current settings:
+        return [self.resolved_content]
+
 
 class EnsureSymlink(Task):
     """
@@ -428,6 +572,16 @@ class SvnCheckout(Task):
                 self.maker.run_command(
                     ['svn', 'ps', name, value, self.dest])
 
+    def fingerprint_data(self):
+        # The revision that is checked out (the files in .svn change
+        # even when an update brings nothing new):
+        info = None
+        if self.maker.exists(self.dest):
+            info = self.maker.svn_info(self.dest)
+        if info is None:
+            return ['not checked out']
+        return ['%s@%s' % info]
+
     def confirm_repository(self, repo):
         """
         Checks that the repository exists.  If it does not exist and
@@ -438,7 +592,7 @@ class SvnCheckout(Task):
         stdout, stderr, returncode = self.maker.run_command(
             ['svn', 'ls', repo],
             expect_returncode=True,
-            return_full=True)
+            return_full=True, keep_output=True)
         if returncode:
             if 'Unable to open' not in stderr:
                 self.logger.warn(
@@ -457,7 +611,7 @@ class SvnCheckout(Task):
         stdout, stderr, returncode = self.maker.run_command(
             ['svn', 'ls', repo],
             expect_returncode=True,
-            return_full=True)
+            return_full=True, keep_output=True)
         if returncode:
             self.logger.notify('Creating svn directory for %s' % repo)
             self.maker.run_command(
@@ -488,6 +642,11 @@ class VirtualEnv(Task):
     {{endif}}
     {{endif}}
 
+    {{if task.use_template()}}
+    The virtualenv will be cloned from a template virtualenv (kept in
+    {{task.template_path}}), which will be created if necessary.
+    {{endif}}
+
     Also, setuptools 0.6c11 will be installed in the virtualenv.
 
     {{if task.use_pip()}}
@@ -501,7 +660,31 @@ class VirtualEnv(Task):
         else:
             _use_pip = asbool(self.config.getdefault('general', 'use_pip'))
         return _use_pip
-            
+
+    def use_template(self):
+        """
+        True if the virtualenv should be cloned from a template (the
+        ``virtualenv_template`` setting).
+        """
+        if self.config.has_option(self.project.name, 'virtualenv_template'):
+            return asbool(self.config.get(self.project.name, 'virtualenv_template'))
+        return asbool(self.config.getdefault('general', 'virtualenv_template', 'false'))
+
+    @property
+    def template_path(self):
+        """
+        The template virtualenv for this interpreter, site-packages
+        setting and virtualenv version, under
+        ``var/virtualenv-templates/``.
+        """
+        import virtualenv
+        python = os.path.realpath(self.different_python or sys.executable)
+        key = '\n'.join([python, str(os.path.getmtime(python)),
+                         str(bool(self.site_packages)), str(self.use_pip()),
+                         getattr(virtualenv, 'virtualenv_version', '')])
+        name = '%s-%s' % (os.path.basename(python), sha1(key).hexdigest()[:12])
+        return os.path.join(self.environ.var_path, 'virtualenv-templates', name)
+
     def __init__(self, name='Create virtualenv', path=None, site_packages=False,
                  different_python=False, stacklevel=1,
                  
@@ -537,6 +720,59 @@ never_create_virtualenv=False):
         if self.never_create_virtualenv:
             self.logger.fatal("Virtualenv at %s does not exist, but should already exist!" % path)
             raise Exception
+        if self.use_template():
+            template = self.ensure_template()
+            if self.maker.simulate:
+                self.logger.notify('Would clone virtualenv %s to %s' % (template, path))
+            else:
+                venvclone.clone_environment(template, path, self.logger)
+            self.logger.notify('virtualenv created in %s' % path)
+            return
+        self.create_environment(path)
+        self.logger.notify('virtualenv created in %s' % path)
+
+    def ensure_template(self):
+        """
+        Creates the template virtualenv (with setuptools, and pip if
+        it is used) unless it exists already.  Returns its path.
+        """
+        template = self.template_path
+        if os.path.exists(template) or self.maker.simulate:
+            return template
+        lock = self.maker.process_lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            if os.path.exists(template):
+                # Another process made it while we waited
+                return template
+            self.logger.notify('Creating template virtualenv %s' % template)
+            # Created elsewhere and then moved, so that the template
+            # is never seen half-made:
+            tmp = '%s.tmp-%s' % (template, os.getpid())
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            self.logger.indent += 2
+            try:
+                self.create_environment(tmp)
+                reqs = ['setuptools==0.6c11']
+                if self.use_pip():
+                    reqs.append('pip')
+                for req in reqs:
+                    self.maker.run_command(
+                        os.path.join(tmp, 'bin', 'easy_install'), req,
+                        cwd=tmp)
+            finally:
+                self.logger.indent -= 2
+            venvclone.write_template_location(
+                tmp, tmp, 'virtualenv of %s' % (self.different_python or sys.executable))
+            os.rename(tmp, template)
+        finally:
+            if lock is not None:
+                lock.release()
+        return template
+
+    def create_environment(self, path):
         import virtualenv
         if not self.different_python:
             ## FIXME: kind of a nasty hack, but maybe it's okay?
@@ -560,19 +796,30 @@ never_create_virtualenv=False):
             self.logger.notify('Subprocess virtualenv creation')
             proc = subprocess.Popen(venv_args, stdout=subprocess.PIPE)
             proc.communicate()
-        self.logger.notify('virtualenv created in %s' % path)
-        
+
+    def signature(self):
+        sig = super(VirtualEnv, self).signature()
+        # So that everything after this is done again when the
+        # virtualenv is recreated:
+        python = os.path.join(self.path_resolved, 'bin', 'python')
+        if os.path.exists(python):
+            sig.append('created at %s' % os.path.getmtime(python))
+        return sig
 
     def iter_subtasks(self):
         if self.virtualenv_exists() and self.never_create_virtualenv:
             return []
 
         _tasks = []
+        find_links = []
         if self.environ.config.has_option('general', 'find_links'):
-            find_links = self.environ.config.get('general', 'find_links')
+            find_links.append(self.environ.config.get('general', 'find_links'))
+        if self.environ.dist_cache is not None:
+            find_links.append(self.environ.dist_cache.find_links)
+        if find_links:
             _tasks.append(
                 SetDistutilsValue('Add custom find_links locations',
-                                  'easy_install', 'find_links', find_links))
+                                  'easy_install', 'find_links', ' '.join(find_links)))
         _tasks.append(
             EasyInstall('Install latest setuptools',
                         'setuptools==0.6c11'))
@@ -622,11 +869,28 @@ class EasyInstall(Script):
             if find_links:
                 self.reqs[:0] = ['-f', ' '.join(find_links)]
         kw['stacklevel'] = kw.get('stacklevel', 1)+1
-        if kw.pop('use_pip', False):
+        self.use_pip = kw.pop('use_pip', False)
+        if self.use_pip:
             super(EasyInstall, self).__init__(name, ['pip', 'install'] + list(self.reqs), use_virtualenv=True, **kw)
         else:
             super(EasyInstall, self).__init__(name, ['easy_install'] + list(self.reqs), use_virtualenv=True, **kw)
 
+    def run(self):
+        cache = self.environ.dist_cache
+        script = list(self.script)
+        if cache is None:
+            self.run_script(script)
+        elif self.use_pip:
+            script[2:2] = ['--download-cache', cache.pip_download_cache]
+            self.run_script(script)
+        else:
+            build_dir = cache.make_build_directory()
+            script[1:1] = ['-b', build_dir]
+            try:
+                self.run_script(script)
+            finally:
+                cache.harvest(build_dir)
+
 class SourceInstall(SvnCheckout):
     """
     Install from svn source
@@ -760,6 +1024,30 @@ stdout_capture_maxbytes = 200KB
 stderr_capture_maxbytes = 200KB
 """
 
+class RemoveSupervisorConfig(InstallSupervisorConfig):
+
+    description = """
+    Remove the supervisor config {{task.conf_path}}, if it was
+    installed
+    """
+
+    def __init__(self, name='Remove supervisor startup script',
+                 script_name='{{project.name}}', stacklevel=1):
+        super(RemoveSupervisorConfig, self).__init__(
+            name, script_name=script_name, stacklevel=stacklevel+1)
+
+    def run(self):
+        filename = self.maker.path(self.conf_path)
+        if not os.path.exists(filename):
+            self.logger.info('No supervisor config at %s' % self.conf_path)
+            return
+        if self.maker.simulate:
+            self.logger.notify('Would remove supervisor config %s' % self.conf_path)
+            return
+        os.unlink(filename)
+        self.logger.notify('Supervisor config %s removed (run "supervisorctl update" '
+                           'to stop %s)' % (self.conf_path, self.script_name))
+
 class CheckMySQLDatabase(Task):
 
     db_name = interpolated('db_name')
@@ -990,6 +1278,7 @@ class SaveSetting(Task):
                         'Not overwriting build.ini option [%s] %s = %r (new value would have been %r)'
                         % (section, key, config.get(section, key), value))
         self.environ.save()
+        self.project.invalidate_namespace()
 
     def should_write_setting(self, section, key, value):
         if self.overwrite:
@@ -1076,6 +1365,8 @@ class Patch(Task):
     Patches applied to {{task.dest}}, -p {{task.strip}}.
     """
 
+    incremental = True
+
     def __init__(self, name, files, dest, strip='0', stacklevel=1):
         super(Patch, self).__init__(name, stacklevel=stacklevel+1)
         if isinstance(files, basestring):
@@ -1099,7 +1390,7 @@ class Patch(Task):
                 stdout, stderr, returncode = self.maker.run_command(
                     ['patch', '-p', self.strip, '--forward', '-i', file],
                     cwd=self.dest, expect_returncode=True,
-                    return_full=True)
+                    return_full=True, keep_output=True)
                 if returncode:
                     if 'Reversed (or previously applied) patch detected!  Skipping patch.' in stdout:
                         self.logger.info('Patch already applied.')
@@ -1143,6 +1434,9 @@ class Patch(Task):
     def expanded_files(self):
         return self.expand_globs(self.files)
 
+    def fingerprint_files(self):
+        return self.expanded_files
+
     def expand_globs(self, files):
         """
         Expand a list of files, treating each as a glob.
@@ -1170,6 +1464,42 @@ class InstallSpec(Task):
         super(InstallSpec, self).__init__(name, stacklevel=stacklevel+1)
         self.spec_filename = spec_filename
 
+    @property
+    def incremental(self):
+        """
+        The installation can only be skipped when the spec pins every
+        package to a version (or an svn revision); otherwise there
+        might be something new to install even if the spec is the
+        same.
+        """
+        filename = self.maker.path(self.spec_filename)
+        if not os.path.exists(filename):
+            return False
+        f = open(filename)
+        try:
+            for line in f:
+                if not line.strip() or line.strip().startswith('#'):
+                    continue
+                if line.strip() != line.rstrip():
+                    # Continuation of a multi-line setting
+                    continue
+                line = line.strip()
+                if (self._setting_re.search(line) or line.startswith('-f')
+                    or line.startswith('--find-links') or line.startswith('-Z')
+                    or line.startswith('--always-unzip')):
+                    continue
+                if line.startswith('-e') or line.startswith('--editable'):
+                    if not self._rev_svn_re.search(line.split('#', 1)[0].rstrip()):
+                        return False
+                elif '==' not in line and '://' not in line:
+                    return False
+        finally:
+            f.close()
+        return True
+
+    def fingerprint_files(self):
+        return [self.spec_filename]
+
     def run(self):
         if self.config.has_option(self.project.name, 'use_pip'):
             use_pip = asbool(self.config.get(self.project.name, 'use_pip'))
@@ -1180,6 +1510,9 @@ class InstallSpec(Task):
             return
         context, commands = self.read_commands()
         context['virtualenv_python'] = self.project.build_properties['virtualenv_python']
+        if self.environ.dist_cache is not None:
+            context['find_links'].append(self.environ.dist_cache.find_links)
+        self.checkout_editables(context, commands)
         extra_commands = []
         for command, arg in commands:
             result = command(context, arg)
@@ -1193,6 +1526,8 @@ class InstallSpec(Task):
         env['PIP_LOG_EXPLICIT_LEVELS'] = '1'
         env['PIP_DEFAULT_VCS'] = 'svn'
         env['PIP_SKIP_REQUIREMENTS_REGEX'] = '^\w+\s*=[^=]'
+        if self.environ.dist_cache is not None:
+            env['PIP_DOWNLOAD_CACHE'] = self.environ.dist_cache.pip_download_cache
         self.maker.run_command(
             "%s/bin/pip" % self.venv_property('path'),
             'install', '-r', self.spec_filename,
@@ -1282,13 +1617,12 @@ class InstallSpec(Task):
     _rev_svn_re = re.compile(r'@(\d+)$')
     _egg_spec_re = re.compile(r'egg=([^-=&]*)')
 
-    def install_editable(self, context, svn):
+    def parse_editable(self, context, svn):
         """
-        Installs one editable project.  This step does not install any
-        dependencies for the project; that is done later by
-        ``self.install_finalize_editable``
+        Parses the location of an editable project, returning ``(svn,
+        revision, dest)``: the repository, the revision to check out
+        (or None) and the directory to check it out to.
         """
-        ops = []
         name = None
         if '#' in svn:
             svn, fragment = svn.split('#', 1)
@@ -1300,7 +1634,6 @@ class InstallSpec(Task):
         if match:
             svn = svn[:match.start()]
             revision = match.group(1)
-        ops.append(svn)
         if name is None:
             parts = [p for p in svn.split('/') if p]
             if parts[-2] in ('tags', 'branches', 'tag', 'branch'):
@@ -1313,11 +1646,94 @@ class InstallSpec(Task):
                     "you should add #egg=Name to the URL" % svn)
         # Normalizing the name, so it's more predictable later:
         name = name.lower()
-        dest = os.path.join(context['src_base'], name)
-        self.logger.notify('Preparing checkout %s' % name)
+        return svn, revision, os.path.join(context['src_base'], name)
+
+    @property
+    def checkout_jobs(self):
+        """
+        How many editable projects are checked out (or updated) at
+        once; the ``svn_checkout_jobs`` setting of the project or of
+        the general section (default 4).
+        """
+        if self.config.has_option(self.project.name, 'svn_checkout_jobs'):
+            jobs = self.config.get(self.project.name, 'svn_checkout_jobs')
+        else:
+            jobs = self.config.getdefault('general', 'svn_checkout_jobs', '4')
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            raise ValueError(
+                "Bad value for svn_checkout_jobs: %r (should be a number)" % jobs)
+        return max(jobs, 1)
+
+    def checkout_editables(self, context, commands):
+        """
+        Checks out (or updates) all the editable projects before any
+        of them is installed.  This is mostly waiting on the network,
+        so the checkouts are done in several threads at once (see
+        ``checkout_jobs``).  The checkouts that are done are put in
+        ``context['checked_out']``, so ``install_editable`` won't do
+        them again.
+        """
+        checkouts = []
+        for command, arg in commands:
+            if command == self.install_editable:
+                checkouts.append(self.parse_editable(context, arg))
+        context['checked_out'] = done = {}
+        if not checkouts:
+            return
+        if self.maker.smart_update or self.maker.svn_mirror_dir:
+            # Looks up the revisions of all the repositories at once:
+            self.maker.svn_last_changed_revisions(
+                [svn for svn, revision, dest in checkouts if not revision])
+        jobs = min(self.checkout_jobs, len(checkouts))
+        self.logger.notify('Checking out %s editable projects (%s at a time)'
+                           % (len(checkouts), jobs))
+        queue = Queue.Queue()
+        for checkout in checkouts:
+            queue.put(checkout)
+        errors = []
+        def worker():
+            while 1:
+                try:
+                    svn, revision, dest = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.maker.checkout_svn(svn, dest, revision=revision)
+                    done[dest] = True
+                except:
+                    errors.append((dest, sys.exc_info()))
+                    self.logger.warn('Checkout of %s failed: %s'
+                                     % (os.path.basename(dest), sys.exc_info()[1]))
+        threads = []
+        for i in range(jobs):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Joining with a timeout lets ^C through:
+            while thread.isAlive():
+                thread.join(1)
+        if errors:
+            # Each failure has been logged already; the first one
+            # fails the task:
+            dest, exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def install_editable(self, context, svn):
+        """
+        Installs one editable project.  This step does not install any
+        dependencies for the project; that is done later by
+        ``self.install_finalize_editable``
+        """
+        svn, revision, dest = self.parse_editable(context, svn)
+        self.logger.notify('Preparing checkout %s' % os.path.basename(dest))
         self.logger.indent += 2
         try:
-            self.maker.checkout_svn(svn, dest, revision=revision)
+            if dest not in context.get('checked_out', {}):
+                self.maker.checkout_svn(svn, dest, revision=revision)
             self.maker.run_command(
                 'python', 'setup.py', 'develop', '--no-deps',
                 cwd=dest,
@@ -1358,6 +1774,11 @@ class InstallSpec(Task):
         if context['always_unzip']:
             cmd.append('--always-unzip')
         cmd.extend(eggs)
+        cache = self.environ.dist_cache
+        build_dir = None
+        if cache is not None:
+            build_dir = cache.make_build_directory()
+            cmd[1:1] = ['-b', build_dir]
         self.logger.notify('easy_installing %s' % ', '.join(eggs))
         self.logger.indent += 2
         try:
@@ -1368,6 +1789,8 @@ class InstallSpec(Task):
                 log_filter=self.make_log_filter())
         finally:
             self.logger.indent -= 2
+            if build_dir is not None:
+                cache.harvest(build_dir)
 
     log_filter_debug_regexes = [
         re.compile(r'references __(file|path)__$'),
@@ -1676,6 +2099,8 @@ class InstallTarball(Task):
     dest_path = interpolated('dest_path')
     _tarball_url = ''
     _src_name = ''
+    # The sha1 of the tarball, if known:
+    _tarball_sha1 = None
 
     description = """
     Install {{task._src_name}} into {{task.dest_path}}.
@@ -1702,32 +2127,20 @@ class InstallTarball(Task):
         if self.is_up_to_date():
             return
         url = self._tarball_url
+        dest_dir = os.path.dirname(self.dest_path)
+        self.maker.ensure_dir(dest_dir)
+        # A tarball left in the current directory is used instead of
+        # downloading it:
         tmp_fn = os.path.abspath(os.path.basename(url))
-        delete_tmp_fn = False
-        try:
-            if os.path.exists(tmp_fn):
-                self.logger.notify('Source file %s already exists' % tmp_fn)
-            else:
-                self.logger.notify('Downloading %s to %s' % (url, tmp_fn))
-                if not self.maker.simulate:
-                    self.maker.retrieve(url, tmp_fn)
-            self.maker.ensure_dir(os.path.dirname(self.dest_path))
-            if tmp_fn.endswith('gz'):
-                tarflags = 'zfx'
-            elif tmp_fn.endswith('bz2'):
-                tarflags = 'jfx'
-            elif tmp_fn.endswith('tar'):
-                tarflags = 'fx'
-            else:
-                raise Exception("Don't know how to untar file %r" % tmp_fn)
-            self.maker.run_command(
-                'tar', tarflags, tmp_fn,
-                cwd=os.path.dirname(self.dest_path))
+        if os.path.exists(tmp_fn):
+            self.logger.notify('Source file %s already exists' % tmp_fn)
+            self.maker.unpack_tarball(tmp_fn, dest_dir)
             self.post_unpack_hook()
-            delete_tmp_fn = True
-        finally:
-            if delete_tmp_fn and os.path.exists(tmp_fn):
-                os.unlink(tmp_fn)
+            os.unlink(tmp_fn)
+            return
+        self.maker.unpack_tarball(url, dest_dir, cache=self.environ.artifact_cache,
+                                  checksum=self._tarball_sha1)
+        self.post_unpack_hook()
 
 
 class Log(Task):
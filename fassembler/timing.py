@@ -0,0 +1,167 @@
+"""
+Records how long tasks and commands take (for ``fassembler
+--profile FILE``).
+
+The profile is written to FILE in the Chrome trace event format
+(load it in chrome://tracing), and a summary sorted by time is
+logged and written to FILE.txt.
+"""
+
+import os
+import time
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+class BuildProfile(object):
+    """
+    The timings of one fassembler run.
+    """
+
+    def __init__(self, filename, logger):
+        self.filename = filename
+        self.logger = logger
+        self.start_time = time.time()
+        self.events = []
+
+    def start(self):
+        """
+        Returns a marker to pass to ``add_task``, taken before the
+        task runs.
+        """
+        return (time.time(), os.times())
+
+    def add_task(self, project, task, started):
+        """
+        Records a task that ran since ``started``.
+        """
+        start, start_times = started
+        end = time.time()
+        end_times = os.times()
+        self.add_event(
+            '%s.%s' % (project.name, task.name), 'task', start, end,
+            dict(project=project.project_name,
+                 task_class=task.__class__.__name__,
+                 user_cpu=end_times[0] - start_times[0],
+                 sys_cpu=end_times[1] - start_times[1],
+                 children_user_cpu=end_times[2] - start_times[2],
+                 children_sys_cpu=end_times[3] - start_times[3]))
+
+    def add_command(self, cmd, start, end, rusage=None, output_bytes=None):
+        """
+        Records a command run by ``Maker.run_command``.  ``rusage`` is
+        its resource usage (from ``os.wait4``), if known.
+        """
+        if isinstance(cmd, basestring):
+            args = cmd.split()
+        else:
+            args = list(cmd)
+        program = os.path.basename(args[0])
+        # For things like "python setup.py ..." the script is what
+        # matters:
+        if program.startswith('python') and len(args) > 1 and not args[1].startswith('-'):
+            program = '%s %s' % (program, os.path.basename(args[1]))
+        details = dict(command=' '.join(args), output_bytes=output_bytes)
+        if rusage is not None:
+            details.update(dict(
+                user_cpu=rusage.ru_utime,
+                sys_cpu=rusage.ru_stime,
+                # Kilobytes on Linux:
+                max_rss=rusage.ru_maxrss,
+                # Counted by the kernel in 512-byte blocks:
+                bytes_written=rusage.ru_oublock * 512))
+        self.add_event(program, 'command', start, end, details)
+
+    def add_event(self, name, category, start, end, details):
+        self.events.append(dict(
+            name=name, cat=category, ph='X',
+            ts=int((start - self.start_time) * 1000000),
+            dur=int((end - start) * 1000000),
+            pid=os.getpid(),
+            # Tasks and commands get their own rows:
+            tid=category == 'task' and 1 or 2,
+            args=details))
+
+    def part_filename(self, pid):
+        return '%s.%s' % (self.filename, pid)
+
+    def write_part(self):
+        """
+        Writes the events of this process where ``merge_part`` will
+        find them; used by worker processes when building with
+        ``--jobs``.
+        """
+        f = open(self.part_filename(os.getpid()), 'w')
+        f.write(json.dumps(self.events))
+        f.close()
+
+    def merge_part(self, pid):
+        """
+        Adds the events written by ``write_part`` in the worker process
+        ``pid``.
+        """
+        filename = self.part_filename(pid)
+        if not os.path.exists(filename):
+            return
+        f = open(filename)
+        self.events.extend(json.loads(f.read()))
+        f.close()
+        os.unlink(filename)
+
+    def write(self):
+        """
+        Writes the trace file and the summary.
+        """
+        self.events.sort(key=lambda event: event['ts'])
+        f = open(self.filename, 'w')
+        f.write(json.dumps(dict(traceEvents=self.events, displayTimeUnit='ms'),
+                           indent=1))
+        f.close()
+        summary = self.summary()
+        f = open(self.filename + '.txt', 'w')
+        f.write(summary)
+        f.close()
+        self.logger.notify(summary)
+        self.logger.notify('Profile written to %s (summary in %s.txt)'
+                           % (self.filename, self.filename))
+
+    def summary(self):
+        """
+        A text summary: tasks and commands (grouped by program), most
+        time first.
+        """
+        lines = []
+        total = time.time() - self.start_time
+        lines.append('Total time: %.1fs' % total)
+        for category, title in [('task', 'Tasks'), ('command', 'Commands')]:
+            totals = {}
+            for event in self.events:
+                if event['cat'] != category:
+                    continue
+                entry = totals.setdefault(event['name'], [0, 0, 0.0, 0])
+                entry[0] += 1
+                entry[1] += event['dur']
+                args = event['args']
+                entry[2] += args.get('user_cpu', 0) + args.get('sys_cpu', 0)
+                entry[2] += args.get('children_user_cpu', 0) + args.get('children_sys_cpu', 0)
+                entry[3] = max(entry[3], args.get('max_rss') or 0)
+            if not totals:
+                continue
+            lines.append('')
+            lines.append('%s:' % title)
+            lines.append('  %9s %9s %6s %10s  %s' % ('wall', 'cpu', 'count', 'max RSS', 'name'))
+            items = [(entry[1], name, entry) for name, entry in totals.items()]
+            items.sort()
+            items.reverse()
+            for dur, name, entry in items:
+                if entry[3]:
+                    rss = '%.1fMB' % (entry[3] / 1024.0)
+                else:
+                    rss = ''
+                lines.append('  %8.1fs %8.1fs %6i %10s  %s'
+                             % (dur / 1000000.0, entry[2], entry[0], rss, name))
+        return '\n'.join(lines) + '\n'
@@ -86,6 +86,7 @@ class EnvironRefresh(tasks.Task):
 
     def run(self):
         self.environ.refresh_config()
+        self.project.invalidate_namespace()
 
 
 
@@ -157,6 +158,11 @@ class ToppProject(Project):
         Setting('find_links',
                 default='http://dist.socialplanning.org/eggs',
                 help='Custom locations for distutils and easy_install to look in'),
+        Setting('dist_cache',
+                default='{{config.var}}/dist-cache',
+                inherit_config=('general', 'dist_cache'),
+                help='Where downloaded distributions are kept, to be shared by all the '
+                'virtualenvs (set to nothing to download every time)'),
         Setting('projtxt',
                 default='{{project.req_settings.get("projtxt", "project")}}',
                 help='Displayed name for opencore project/group'),
@@ -196,6 +202,7 @@ class ToppProject(Project):
                            'topp_secret_filename': '{{env.var}}/secret.txt',
                            'admin_info_filename': '{{env.var}}/admin.txt',
                            'find_links': '{{config.find_links}}',
+                           'dist_cache': '{{config.dist_cache}}',
                            'db_prefix': '{{config.db_prefix}}',
                            'requirements_svn_repo': '{{config.requirements_svn_repo}}',
                            'projtxt': '{{config.projtxt}}',
@@ -269,3 +276,5 @@ class SupervisorProject(Project):
         tasks.EnsureDir('Ensure pid location exists',
                         '{{config.supervisor_var}}'),
         ]
+
+    depends_on_projects = ['fassembler:topp']
@@ -2,17 +2,22 @@
 Installation of the TOPP OpenCore environment.
 """
 
+from fassembler import artifacts
+from fassembler import parallelbz2
 from fassembler import tasks
+from fassembler import zeocontrol
 from fassembler.project import Project, Setting
-from fassembler.util import asbool
+from fassembler.util import asbool, sha1
 from glob import glob
-from time import sleep
 from xml.dom import minidom
+import errno
 import os
+import re
 import shutil
 import socket
-import subprocess
 import sys
+import tarfile
+import tempfile
 import urllib
 import warnings
 import util
@@ -61,6 +66,195 @@ class InstallZope(tasks.InstallTarball):
         self.maker.ensure_file(self.version_path, self._tarball_version,
                                svn_add=False)
 
+    def signature(self):
+        sig = super(InstallZope, self).signature()
+        # The version file is rewritten whenever the tarball is
+        # unpacked, and then everything built from the source has to
+        # be built again:
+        if os.path.exists(self.version_path):
+            sig.append('unpacked at %s' % os.path.getmtime(self.version_path))
+        return sig
+
+
+zope_configure_script = [
+    './configure', '--with-python={{project.build_properties["virtualenv_bin_path"]}}/python',
+    '--prefix={{config.zope_install}}']
+
+class ZopeBuildCacheTask(tasks.Task):
+    """
+    The base of the tasks that restore a built Zope installation from
+    the cache in ``config.zope_build_cache``, and store it there.
+
+    Builds are kept by a key made from the Zope tarball version, the
+    Python Zope is built with (its path and version) and the configure
+    arguments.  The key of the build in ``config.zope_install`` is
+    kept in a file there.
+    """
+
+    zope_install = interpolated('zope_install')
+    cache_dir = interpolated('cache_dir')
+
+    marker_filename = 'fassembler-build-key.txt'
+
+    def __init__(self, name, stacklevel=1):
+        super(ZopeBuildCacheTask, self).__init__(name, stacklevel=stacklevel+1)
+        self.zope_install = '{{config.zope_install}}'
+        self.cache_dir = '{{config.zope_build_cache}}'
+
+    def build_key(self):
+        key = self.project.build_properties.get('zope_build_key')
+        if key is not None:
+            return key
+        python = self.interpolate('{{project.build_properties["virtualenv_bin_path"]}}/python')
+        python_version = self.maker.run_command(
+            [python, '-c', 'import sys; print sys.version'], keep_output=True)
+        configure = [self.interpolate(arg) for arg in zope_configure_script]
+        parts = ['tarball=%s' % self.interpolate('{{config.zope_tarball_version}}'),
+                 'python=%s' % python,
+                 'python_version=%s' % python_version.strip(),
+                 'configure=%s' % ' '.join(configure)]
+        key = sha1('\n'.join(parts)).hexdigest()
+        self.logger.debug('Zope build key %s:\n  %s' % (key, '\n  '.join(parts)))
+        self.project.build_properties['zope_build_key'] = key
+        return key
+
+    @property
+    def archive_path(self):
+        return os.path.join(self.cache_dir, 'zope-%s.tar.gz' % self.build_key())
+
+    @property
+    def marker_path(self):
+        return os.path.join(self.zope_install, self.marker_filename)
+
+    def write_marker(self, key):
+        f = open(self.marker_path, 'w')
+        f.write(key + '\n')
+        f.close()
+
+    def installed_key(self):
+        if not os.path.exists(self.marker_path):
+            return None
+        f = open(self.marker_path)
+        key = f.read().strip()
+        f.close()
+        return key
+
+
+class RestoreZopeBuild(ZopeBuildCacheTask):
+
+    description = """
+    If {{task.zope_install}} was built already, or a build of the same
+    Zope (for the same Python, with the same configure arguments) is in
+    {{task.cache_dir or '(no cache)'}}, restore it, and skip configuring,
+    making and installing Zope.
+    """
+
+    def __init__(self, name='Restore Zope build from cache', stacklevel=1):
+        super(RestoreZopeBuild, self).__init__(name, stacklevel=stacklevel+1)
+
+    def run(self):
+        self.project.build_properties['zope_build_restored'] = False
+        if self.maker.simulate:
+            self.logger.notify('Would look for a cached build of Zope')
+            return
+        forced = self.project.build_properties.get('zope_build_forced')
+        if forced:
+            self.logger.notify('Building Zope (%s was forced)' % forced)
+            self.remove_marker()
+            return
+        key = self.build_key()
+        if self.installed_key() == key:
+            self.logger.notify('Zope in %s is built already (build %s)'
+                               % (self.zope_install, key))
+            self.project.build_properties['zope_build_restored'] = True
+            return
+        # If building fails part way, the old build key doesn't apply:
+        self.remove_marker()
+        if not self.cache_dir or not os.path.exists(self.archive_path):
+            self.logger.info('No cached build of Zope (build %s); building it' % key)
+            return
+        self.logger.notify('Restoring Zope into %s from %s'
+                           % (self.zope_install, self.archive_path))
+        tmp_dir = '%s.restore-%s' % (self.zope_install, os.getpid())
+        f = open(self.archive_path, 'rb')
+        try:
+            try:
+                artifacts.extract_stream(f, tmp_dir, self.logger)
+            except:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        finally:
+            f.close()
+        if os.path.exists(self.zope_install):
+            shutil.rmtree(self.zope_install)
+        os.rename(tmp_dir, self.zope_install)
+        self.write_marker(key)
+        self.project.build_properties['zope_build_restored'] = True
+
+    def remove_marker(self):
+        if os.path.exists(self.marker_path):
+            os.unlink(self.marker_path)
+
+
+class ZopeBuildScript(tasks.Script):
+    """
+    Configuring, making or installing Zope; skipped if
+    ``RestoreZopeBuild`` restored the build.
+    """
+
+    def setup_build_properties(self):
+        super(ZopeBuildScript, self).setup_build_properties()
+        # Forcing any step means building Zope again (see
+        # RestoreZopeBuild):
+        if self.project.task_is_forced(self):
+            self.project.build_properties['zope_build_forced'] = self.name
+
+    def run(self):
+        if self.project.build_properties.get('zope_build_restored'):
+            self.logger.notify('Zope was restored from the build cache; skipping')
+            return
+        super(ZopeBuildScript, self).run()
+
+
+class SaveZopeBuild(ZopeBuildCacheTask):
+
+    description = """
+    Store the Zope built in {{task.zope_install}} in
+    {{task.cache_dir or '(no cache)'}}, so it doesn't have to be built
+    again.
+    """
+
+    def __init__(self, name='Store Zope build in cache', stacklevel=1):
+        super(SaveZopeBuild, self).__init__(name, stacklevel=stacklevel+1)
+
+    def run(self):
+        if self.project.build_properties.get('zope_build_restored'):
+            return
+        if self.maker.simulate:
+            self.logger.notify('Would store the Zope build in %s' % (self.cache_dir or '(no cache)'))
+            return
+        key = self.build_key()
+        self.write_marker(key)
+        if not self.cache_dir:
+            return
+        archive = self.archive_path
+        if os.path.exists(archive):
+            self.logger.info('Zope build %s is cached already' % key)
+            return
+        self.maker.ensure_dir(self.cache_dir, svn_add=False)
+        tmp_archive = '%s.tmp-%s' % (archive, os.getpid())
+        tar = tarfile.open(tmp_archive, 'w:gz')
+        try:
+            try:
+                tar.add(self.zope_install, arcname='.')
+            finally:
+                tar.close()
+        except:
+            os.unlink(tmp_archive)
+            raise
+        os.rename(tmp_archive, archive)
+        self.logger.notify('Stored the Zope build in %s' % archive)
+
 
 class InstallZopeFakeEggs(tasks.Task):
 
@@ -85,7 +279,7 @@ class InstallZopeFakeEggs(tasks.Task):
                            prefix='Products')
 
     
-def make_tarball(tarball_version, tarball_url_dir, orig_zope_source):
+def make_tarball(tarball_version, tarball_url_dir, orig_zope_source, compress_jobs=None):
     tarball_url = '%s/OpenplansZope-%s.tar.bz2' % (tarball_url_dir,
                                                    tarball_version)
     filename = os.path.basename(tarball_url)
@@ -131,8 +325,15 @@ def make_tarball(tarball_version, tarball_url_dir, orig_zope_source):
             print 'Running %s' % ' '.join(args)
             util.popen(args, cwd=dest_name)
     print 'Creating %s' % filename
-    print 'Running tar cfj %s Zope (in %s)' % (filename, dir)
-    util.popen(['tar', 'cfj', filename, 'Zope'], cwd=dir)
+    tar_filename = os.path.splitext(filename)[0]
+    print 'Running tar cf %s Zope (in %s)' % (tar_filename, dir)
+    util.popen(['tar', 'cf', tar_filename, 'Zope'], cwd=dir)
+    if compress_jobs is None:
+        compress_jobs = util.cpu_count()
+    print 'Compressing %s with %s processes' % (tar_filename, compress_jobs)
+    parallelbz2.compress_file(os.path.join(dir, tar_filename), os.path.join(dir, filename),
+                              jobs=compress_jobs)
+    os.unlink(os.path.join(dir, tar_filename))
     print "Removing %s/%s" % (dir, 'Zope')
     shutil.rmtree(os.path.join(dir, 'Zope'))
     # use compileall?
@@ -150,6 +351,10 @@ class GetBundleTarball(tasks.Task):
 
     dest = interpolated('dest')
 
+    # Always runs: whether there is a new tarball is only known by
+    # asking the server.
+    incremental = False
+
     def __init__(self, name='Get opencore bundle tarball',
                  dest='{{env.base_path}}/{{project.name}}/src/opencore-bundle'):
         super(GetBundleTarball, self).__init__(name, stacklevel=1)
@@ -184,24 +389,22 @@ class GetBundleTarball(tasks.Task):
         else:
             self.logger.info('No tarball-id.txt file in %s' % tarball_id_fn)
         url = self.interpolate('{{config.opencore_bundle_tar_dir}}/openplans-bundle-{{config.opencore_bundle_name}}-%s.tar.bz2' % latest_id)
-        tmp_fn = os.path.abspath(os.path.basename(url))
-        self.logger.notify('Downloading tarball from %s to %s' % (url, tmp_fn))
-        delete_tmp_fn = False
-        try:
-            if not self.maker.simulate:
-                self.maker.retrieve(url, tmp_fn)
-            self.maker.ensure_dir(self.dest)
-            self.logger.notify('Unpacking into %s' % self.dest)
-            ## FIXME: is it really okay just to unpack right over whatever might already be there?
-            ## Should we warn or something?
-            self.maker.run_command(
-                'tar', 'jfx', tmp_fn,
-                cwd=self.dest)
-            delete_tmp_fn = True
-        finally:
-            if delete_tmp_fn and os.path.exists(tmp_fn):
-                self.logger.info('Deleting %s' % tmp_fn)
-                os.unlink(tmp_fn) 
+        self.maker.ensure_dir(self.dest)
+        ## FIXME: is it really okay just to unpack right over whatever might already be there?
+        ## Should we warn or something?
+        self.maker.unpack_tarball(url, self.dest, cache=self.environ.artifact_cache,
+                                  incremental=self.update_incrementally)
+
+    @property
+    def update_incrementally(self):
+        """
+        Whether to unpack only what changed in the bundle (the
+        ``opencore_bundle_incremental`` setting).
+        """
+        return asbool(self.interpolate('{{config.opencore_bundle_incremental}}'))
+
+    def fingerprint_files(self):
+        return [os.path.join(self.dest, 'tarball-id.txt')]
 
 
 class SymlinkProducts(tasks.Task):
@@ -411,27 +614,78 @@ class RunZopectlScript(tasks.Task):
         self.script_path = script_path
         self.script_args = ' '.join(script_args.split())
 
+    @property
+    def zopectl_path(self):
+        return self.interpolate('{{env.base_path}}/opencore/zope/bin/zopectl')
+
     def run(self):
         if self.maker.simulate:
             self.logger.notify('Would run "zopectl run %s %s"' %
                                (self.script_path, self.script_args))
             return
-        if os.path.exists(self.script_path):
-            zopectl_path = self.interpolate('{{env.base_path}}/opencore/zope/bin/zopectl')
-            process_args = [zopectl_path, 'run', self.script_path]
+        if self.script_exists():
+            process_args = [self.zopectl_path, 'run', self.script_path]
             process_args.append(self.script_args)
             self.maker.run_command(process_args)
-        else:
-            self.maker.beep_if_necessary()
-            self.logger.warn('Tried to run zopectl script at %s but the '
-                             'path does not exist' % self.script_path,
-                             color='red')
+
+    def script_exists(self):
+        if os.path.exists(self.script_path):
+            return True
+        self.maker.beep_if_necessary()
+        self.logger.warn('Tried to run zopectl script at %s but the '
+                         'path does not exist' % self.script_path,
+                         color='red')
+        return False
+
+
+# Runs several scripts in one "zopectl run" (see
+# RunZopeScriptsWithZeo.run_batch); this is run with execfile, with
+# app in its namespace, by the Zope's own Python.
+zopectl_batch_template = """\
+# Written by fassembler; runs several zopectl scripts in one Zope
+import sys
+import time
+import traceback
+import transaction
+
+scripts = %(scripts)r
+
+def report(status, index, extra=''):
+    sys.stdout.write('\\nfassembler-zopectl-script: %%s %%s %%s\\n' %% (status, index, extra))
+    sys.stdout.flush()
+
+for index in range(len(scripts)):
+    path, args = scripts[index]
+    report('start', index)
+    start = time.time()
+    sys.argv = [path] + args
+    try:
+        try:
+            execfile(path, {'__name__': '__main__', '__file__': path, 'app': app})
+        except SystemExit, e:
+            if e.code:
+                raise
+        transaction.commit()
+    except:
+        traceback.print_exc()
+        transaction.abort()
+        report('failed', index)
+        sys.exit(1)
+    report('done', index, '%%.1f' %% (time.time() - start))
+
+# Written last, so a batch that stopped early (even with no error)
+# doesn't pass for one that finished:
+report('all-done', len(scripts))
+"""
+
+_zopectl_batch_re = re.compile(
+    r'^fassembler-zopectl-script: (start|done|failed|all-done) (\d+) ?(.*)$')
 
 
 class RunZopeScriptsWithZeo(tasks.Task):
 
     description = """
-    {{if task.skip_zopectl_scripts()}}Not trying to start zeo and run zopectl scripts, because skip_zopectl_scripts was set{{else}}Start zeo, run all zopectl scripts, stop zeo{{endif}}
+    {{if task.skip_zopectl_scripts()}}Not trying to start zeo and run zopectl scripts, because skip_zopectl_scripts was set{{else}}Start zeo (or use the zeo an earlier task in this run started), run all zopectl scripts{{endif}}
     """
 
     script_path = interpolated('script_path')
@@ -440,6 +694,9 @@ class RunZopeScriptsWithZeo(tasks.Task):
     def skip_zopectl_scripts(self):
         return asbool(self.interpolate("{{config.skip_zopectl_scripts}}"))
 
+    def batch_zopectl_scripts(self):
+        return asbool(self.interpolate("{{config.batch_zopectl_scripts}}"))
+
     def __init__(self, *subtasks, **kw):
         stacklevel = kw.get('stacklevel', 1)
         super(RunZopeScriptsWithZeo, self).__init__(self.description,
@@ -457,7 +714,9 @@ class RunZopeScriptsWithZeo(tasks.Task):
 
     def bind(self, *args, **kw):
         super(RunZopeScriptsWithZeo, self).bind(*args, **kw)
-        subtasks = []
+        # The bound subtasks of each task (ForEach makes new copies of
+        # its tasks each time iter_subtasks is called):
+        self._bound_subtasks = {}
         for task in self.subtasks:
             self._bind_tasks(task, *args, **kw)
 
@@ -465,7 +724,9 @@ class RunZopeScriptsWithZeo(tasks.Task):
         task.bind(*args, **kw)
         task.confirm_settings()
         task.setup_build_properties()
-        for subtask in task.iter_subtasks():
+        subtasks = list(task.iter_subtasks())
+        self._bound_subtasks[id(task)] = subtasks
+        for subtask in subtasks:
             self._bind_tasks(subtask, *args, **kw)
 
     def run(self):
@@ -475,22 +736,117 @@ class RunZopeScriptsWithZeo(tasks.Task):
 
         self.start_zeo()
         try:
+            if self.batch_zopectl_scripts():
+                # The zopectl scripts are collected here, and all run
+                # in one Zope process by run_batch:
+                self._batch = []
             for task in self.subtasks:
                 self._run_task(task)
+            self.run_batch()
         finally:
-            self.stop_zeo()
+            self._batch = None
+
+    _batch = None
 
     def _run_task(self, task):
+        if self._batch is not None:
+            if isinstance(task, RunZopectlScript):
+                self.logger.info('Adding %s to the zopectl scripts to run' % task.name)
+                self._batch.append(task)
+                return
+            if not isinstance(task, (tasks.ConditionalTask, tasks.ForEach)):
+                # Any other task may depend on what the scripts do:
+                self.run_batch()
         self.logger.notify("running subtask: %s" % task.title)
         self.logger.indent += 2
         try:
             task.run()
-            for subtask in task.iter_subtasks():
+            for subtask in self._bound_subtasks[id(task)]:
                 self._run_task(subtask)
         finally:
             self.logger.indent -= 2
 
 
+    def run_batch(self):
+        """
+        Runs the zopectl scripts collected so far in a single ``zopectl
+        run``, committing the transaction after each one.
+        """
+        scripts = self._batch
+        if not scripts:
+            return
+        self._batch = []
+        if self.maker.simulate:
+            self.logger.notify('Would run in one "zopectl run": %s'
+                               % ', '.join([task.script_path for task in scripts]))
+            return
+        scripts = [task for task in scripts if task.script_exists()]
+        if len(scripts) < 2:
+            for task in scripts:
+                self.logger.notify("running subtask: %s" % task.title)
+                task.run()
+            return
+        self.logger.notify('Running %s zopectl scripts in one Zope process:\n  %s'
+                           % (len(scripts), '\n  '.join([task.script_path for task in scripts])))
+        fd, driver_path = tempfile.mkstemp(prefix='fassembler-zopectl-', suffix='.py')
+        f = os.fdopen(fd, 'w')
+        f.write(zopectl_batch_template % dict(
+            scripts=[(task.script_path, task.script_args.split(' ')) for task in scripts]))
+        f.close()
+        self.logger.indent += 2
+        try:
+            # If Zope fails before the first script starts, that may
+            # be the failure on first start; it is tried again once:
+            for attempt in 1, 2:
+                stdout, stderr, returncode = self.maker.run_command(
+                    [scripts[0].zopectl_path, 'run', driver_path],
+                    expect_returncode=True, return_full=True, keep_output=True)
+                started, failed, finished = self.report_batch(scripts, stdout)
+                if not returncode and failed is None and finished:
+                    return
+                if attempt == 1 and not started and not finished:
+                    self.logger.warn('Zope failed before running any scripts; trying again')
+                    continue
+                break
+            self.logger.warn('Output of zopectl run:\n%s%s' % (stdout, stderr))
+            if failed is not None:
+                raise Exception('The zopectl script %s failed' % scripts[failed].script_path)
+            raise Exception('zopectl run failed (code %s) after running %s of %s scripts'
+                            % (returncode, started, len(scripts)))
+        finally:
+            self.logger.indent -= 2
+            os.unlink(driver_path)
+
+    def report_batch(self, scripts, stdout):
+        """
+        Logs the status of each script, from the markers the batch
+        writes to stdout.  Returns ``(started, failed, finished)``:
+        the number of scripts that were started, the index of the
+        script that failed (or None), and whether the batch got to the
+        end (the ``all-done`` marker).  Only ``finished`` (with the
+        exit code) says the batch worked.
+        """
+        started = 0
+        failed = None
+        finished = False
+        for line in stdout.splitlines():
+            match = _zopectl_batch_re.match(line.strip())
+            if not match:
+                continue
+            status, index, extra = match.groups()
+            if status == 'all-done':
+                finished = int(index) == len(scripts)
+                continue
+            task = scripts[int(index)]
+            if status == 'start':
+                started += 1
+            elif status == 'done':
+                self.logger.notify('%s: done (%ss)' % (task.name, extra))
+            else:
+                failed = int(index)
+                self.logger.warn('%s: failed' % task.name, color='red')
+        return started, failed, finished
+
     ## ZEO start/stop methods: ##
 
     @property
@@ -505,10 +861,31 @@ class RunZopeScriptsWithZeo(tasks.Task):
     def zeoctl_path(self):
         return self.interpolate('{{env.base_path}}/opencore/zeo/bin/zeoctl')
 
+    @property
+    def zeo_conf_path(self):
+        return self.interpolate('{{env.base_path}}/opencore/zeo/etc/zeo.conf')
+
+    @property
+    def zeo_timeout(self):
+        return float(self.interpolate('{{config.zeo_timeout}}'))
+
+    def zeo_controller(self):
+        return zeocontrol.ZEOController(self.zeoctl_path, self.zeo_conf_path,
+                                        self.zeo_timeout, self.maker, self.logger)
 
     def start_zeo(self):
+        """
+        Starts ZEO, unless it was started earlier in this run.  ZEO is
+        left running for the tasks (and projects) after this one, and
+        stopped at the end of the run.
+        """
         if self.maker.simulate:
             return
+        session = zeocontrol.get_session(self.maker, self.logger)
+        if session.acquire(self.zeo_controller(), self.check_zeo_port):
+            self.logger.notify('Zeo started')
+
+    def check_zeo_port(self):
         port = self.zeo_port
         host = self.zeo_host
         sock = socket.socket()
@@ -516,7 +893,7 @@ class RunZopeScriptsWithZeo(tasks.Task):
             try:
                 sock.bind((host, port))
             except socket.error, exc:
-                if exc.args[0] == 48: # address in use
+                if exc.args[0] == errno.EADDRINUSE:
                     self.logger.warn('Note: ports can sometimes take a minute to be freed after stopping ZEO')
                     self.logger.warn('Retry if you think the port should be free')
                     raise Exception('The ZEO Address %s:%s is already in use: %s' % (host, port, exc))
@@ -524,34 +901,6 @@ class RunZopeScriptsWithZeo(tasks.Task):
                     raise Exception('Cannot bind to ZEO port at %s:%s: %s' % (host, port, exc))
         finally:
             sock.close()
-        if self.zeo_status_contains('pid'):
-            raise Exception('Zeo is running already. Please stop zeo before running.')
-        self.maker.run_command([self.zeoctl_path, 'start'])
-        self.check_zeoctl_timeout('pid', 'starts')
-        self.logger.notify('Zeo started')
-
-    def stop_zeo(self):
-        if self.maker.simulate:
-            return
-        if self.zeo_status_contains('not running'):
-            raise Exception('Expected Zeo to be running but it is not.')
-        self.maker.run_command([self.zeoctl_path, 'stop'])
-        self.check_zeoctl_timeout('not running', 'stops')
-        self.logger.notify('Zeo stopped')
-
-    zeoctl_timeout = 30
-    
-    def check_zeoctl_timeout(self, check_for_status, action):
-        elapsed = 0
-        while elapsed < self.zeoctl_timeout and not self.zeo_status_contains(check_for_status):
-            self.logger.notify('Sleeping while zeo %s...' % action)
-            sleep(1)
-            elapsed += 1
-            if elapsed == self.zeoctl_timeout:
-                raise Exception("Could not start zeo after trying for %d seconds" % self.zeoctl_timeout)
-
-    def zeo_status_contains(self, substr):
-        return substr in subprocess.Popen([self.zeoctl_path, 'status'], stdout=subprocess.PIPE).communicate()[0]
 
 
 class PatchTwill(tasks.Task):
@@ -654,6 +1003,40 @@ class I18nDude(Project):
     depends_on_projects = ['fassembler:topp', 'fassembler:opencore']
 
 
+# The memory an object in the ZODB cache takes, roughly, in kilobytes
+# (Plone objects are big):
+zodb_object_kb = 10
+
+def zope_tuning(cpu_count, memory_mb, instances):
+    """
+    The default tuning for one of ``instances`` Zope instances on a
+    computer with ``cpu_count`` CPUs and ``memory_mb`` megabytes of
+    memory (None if not known).  Returns a dictionary with
+    ``zserver_threads``, ``zodb_cache_size`` (objects per thread) and
+    ``zeo_client_cache_size`` (like ``'500MB'``).
+
+    Half of the memory is given to the Zope instances; each one uses
+    half of its share for the ZODB caches of its threads.  The ZEO
+    client caches (on disk, but read through the OS's cache) get a
+    quarter of the memory.
+    """
+    instances = max(instances, 1)
+    threads = max(2, min(8, cpu_count * 2 // instances))
+    if not memory_mb:
+        # The numbers used before these were computed:
+        return dict(zserver_threads=threads, zodb_cache_size=10000,
+                    zeo_client_cache_size='500MB')
+    share_kb = memory_mb * 1024 // 2 // instances
+    cache_size = share_kb // 2 // threads // zodb_object_kb
+    cache_size = max(5000, min(100000, cache_size // 1000 * 1000))
+    client_cache_mb = max(100, min(2048, memory_mb // 4 // instances))
+    return dict(zserver_threads=threads, zodb_cache_size=cache_size,
+                zeo_client_cache_size='%sMB' % client_cache_mb)
+
+# The transactions kept in ZEO's invalidation queue for each Zope
+# instance:
+invalidations_per_zope = 1000
+
 class OpenCoreBase(Project):
     defaults = dict(opencore_site_id='openplans',
                     opencore_site_title='OpenCore Site',
@@ -669,6 +1052,29 @@ class OpenCoreBase(Project):
     def run_clockserver(self):
         return True
 
+    def zope_instances(self):
+        """
+        The number of Zope instances (ZEO clients) in this build.
+        """
+        return self.environ.num_extra_zopes + 1
+
+    def zope_tuning(self):
+        """
+        The default tuning of each Zope instance for this computer
+        (see ``zope_tuning()``).
+        """
+        return zope_tuning(self.environ.cpu_count, self.environ.memory_mb,
+                           self.zope_instances())
+
+    def zeo_invalidation_queue_size(self):
+        """
+        The default size of ZEO's invalidation queue:
+        ``invalidations_per_zope`` transactions for each Zope instance
+        (more clients commit more transactions while one of them is
+        restarting).
+        """
+        return invalidations_per_zope * self.zope_instances()
+
 class OpenCoreProject(OpenCoreBase):
     """
     Install OpenCore
@@ -714,6 +1120,34 @@ class OpenCoreProject(OpenCoreBase):
         Setting('zope_instance',
                 default='{{project.build_properties["virtualenv_path"]}}/zope',
                 help='Location of Zope instance home'),
+        Setting('zserver_threads',
+                default='{{project.zope_tuning()["zserver_threads"]}}',
+                inherit_config=('general', 'zserver_threads'),
+                help='Number of threads serving requests in Zope (by default based on the '
+                'number of CPUs, shared by num_extra_zopes+1 instances)'),
+        Setting('zodb_cache_size',
+                default='{{project.zope_tuning()["zodb_cache_size"]}}',
+                inherit_config=('general', 'zodb_cache_size'),
+                help='Size of the ZODB cache of each Zope thread, in objects (by default '
+                'based on the memory, shared by num_extra_zopes+1 instances)'),
+        Setting('zeo_client_cache_size',
+                default='{{project.zope_tuning()["zeo_client_cache_size"]}}',
+                inherit_config=('general', 'zeo_client_cache_size'),
+                help='Size of the ZEO client cache of this Zope (like 500MB; by default '
+                'based on the memory, shared by num_extra_zopes+1 instances)'),
+        Setting('zeo_client_name',
+                default='zope',
+                help='Name of the persistent ZEO client cache (empty to use a temporary '
+                'cache, that is lost when Zope restarts)'),
+        Setting('make_jobs',
+                default='{{env.cpu_count}}',
+                inherit_config=('general', 'make_jobs'),
+                help='Number of jobs make runs at once when building Zope'),
+        Setting('zope_build_cache',
+                default='{{env.var}}/zope-builds',
+                inherit_config=('general', 'zope_build_cache'),
+                help='Directory where builds of Zope are kept, to be restored instead of '
+                'building Zope again (empty for no cache)'),
         ## FIXME: not sure if this is right:
         ## FIXME: should also be more global
         ## FIXME: also, type check on bool-ness
@@ -750,6 +1184,10 @@ class OpenCoreProject(OpenCoreBase):
         Setting('opencore_bundle_tar_info',
                 default='{{config.opencore_bundle_tar_dir}}/openplans-bundle-{{config.opencore_bundle_name}}.txt',
                 help='Location of the pointer to the real tarball'),
+        Setting('opencore_bundle_incremental',
+                default='true',
+                help='When updating the bundle tarball, only rewrite the files that changed '
+                'and remove the files that are gone'),
         Setting('opencore_bundle_svn_repo',
                 default='{{config.opencore_bundle_svn_repo_dir}}/{{config.opencore_bundle_name}}',
                 help='Full svn repository for checkouts'),
@@ -809,12 +1247,16 @@ setglobal projprefs    '{{env.config.get("general", "projprefs")}}'
         tasks.TestLxml('{{env.base_path}}/opencore'),
         tasks.CopyDir('Create custom skel',
                       skel_dir, '{{project.name}}/src/Zope/custom_skel'),
-        tasks.Script('Configure Zope', [
-        './configure', '--with-python={{project.build_properties["virtualenv_bin_path"]}}/python',
-        '--prefix={{config.zope_install}}'],
-                     cwd='{{config.zope_source}}'),
-        tasks.Script('Make Zope', ['make'], cwd='{{config.zope_source}}'),
-        tasks.Script('Install Zope', ['make', 'install'], cwd='{{config.zope_source}}'),
+        # The build steps always run (not incremental=True):
+        # RestoreZopeBuild checks the build marker in zope_install, and
+        # they skip themselves if it finds the build there.
+        RestoreZopeBuild(),
+        ZopeBuildScript('Configure Zope', zope_configure_script,
+                        cwd='{{config.zope_source}}'),
+        ZopeBuildScript('Make Zope', ['make', '-j', '{{config.make_jobs}}'],
+                        cwd='{{config.zope_source}}'),
+        ZopeBuildScript('Install Zope', ['make', 'install'], cwd='{{config.zope_source}}'),
+        SaveZopeBuild(),
         # this could maybe be a ConditionalTask, but the -fr ensures
         # it won't fail
         tasks.Script('Delete zope instance binaries',
@@ -906,6 +1348,26 @@ setglobal projprefs    '{{env.config.get("general", "projprefs")}}'
 
 
 
+def parse_time_window(value):
+    """
+    Parses a time window like ``'03:00-05:00'`` (it may go past
+    midnight, like ``'23:30-01:00'``), returning ``(start, end)`` in
+    minutes after midnight.
+    """
+    times = []
+    for part in value.split('-'):
+        try:
+            hour, minute = [int(n) for n in part.strip().split(':')]
+        except ValueError:
+            hour = minute = -1
+        if not 0 <= hour < 24 or not 0 <= minute < 60:
+            times = None
+            break
+        times.append(hour*60 + minute)
+    if not times or len(times) != 2:
+        raise ValueError('Bad time window %r (it should be like 03:00-05:00)' % value)
+    return tuple(times)
+
 class ZEOProject(OpenCoreBase):
     """
     Install ZEO
@@ -923,6 +1385,13 @@ class ZEOProject(OpenCoreBase):
                 "useful if you already have another ZEO instance running "
                 "and you know your database is fully set up "
                 "(i.e. when building an upgrade in parallel to a running site)"),
+        Setting('batch_zopectl_scripts',
+                default='true',
+                help="Run all the zopectl scripts in one Zope process (instead of "
+                "starting Zope for each script)"),
+        Setting('zeo_timeout',
+                default='30',
+                help='Seconds to wait for ZEO to start or stop'),
         Setting('zeo_instance',
                 default='{{project.build_properties["virtualenv_path"]}}/zeo',
                 help='Instance home for ZEO'),
@@ -935,6 +1404,47 @@ class ZEOProject(OpenCoreBase):
         Setting('zeo_host',
                 default='localhost',
                 help='Interface/host to serve ZEO on'),
+        Setting('zeo_invalidation_queue_size',
+                default='{{project.zeo_invalidation_queue_size()}}',
+                inherit_config=('general', 'zeo_invalidation_queue_size'),
+                help='Number of transactions ZEO remembers the invalidations of; a Zope that '
+                'reconnects (e.g. after a restart) within that many transactions only gets '
+                'those invalidations, instead of verifying its whole ZEO client cache.  '
+                'The default allows 1000 per Zope instance (num_extra_zopes+1); raise it '
+                'if the site commits more than that while a Zope restarts.  Each entry '
+                'takes a little memory in ZEO (the oids changed by the transaction)'),
+        Setting('zeo_transaction_timeout',
+                default='',
+                inherit_config=('general', 'zeo_transaction_timeout'),
+                help='Seconds a client may hold the commit lock before ZEO aborts its '
+                'transaction (empty for no limit); it should be longer than the slowest '
+                'commit, e.g. 300'),
+        Setting('zeo_monitor_address',
+                default='',
+                inherit_config=('general', 'zeo_monitor_address'),
+                help='host:port for the ZEO monitor server, which reports statistics '
+                '(empty for none)'),
+        Setting('zeo_pack_gc',
+                default='',
+                inherit_config=('general', 'zeo_pack_gc'),
+                help='If false, packing Data.fs only removes old revisions, skipping the '
+                'garbage collection of unreachable objects (much faster on a big '
+                'database); empty leaves it out of zeo.conf.  Needs ZODB 3.9 or later'),
+        Setting('zeo_pack',
+                default='false',
+                inherit_config=('general', 'zeo_pack'),
+                help='Run a job under supervisor (opencore-zeo-pack) that packs Data.fs '
+                'once a day, in zeo_pack_window.  bin/pack-opencore-zeo --now packs '
+                'right away, e.g. from cron'),
+        Setting('zeo_pack_days',
+                default='7',
+                inherit_config=('general', 'zeo_pack_days'),
+                help='Days of history (undo) kept when packing Data.fs'),
+        Setting('zeo_pack_window',
+                default='03:00-05:00',
+                inherit_config=('general', 'zeo_pack_window'),
+                help='Time of day (local time, like 03:00-05:00) in which the pack job '
+                'starts packing; whether it also collects garbage is set by zeo_pack_gc'),
         Setting('zope_install',
                 default='{{project.build_properties["virtualenv_path"]}}/lib/zope',
                 help='Location of Zope software'),
@@ -963,6 +1473,12 @@ class ZEOProject(OpenCoreBase):
 #!/bin/sh
 cd {{env.base_path}}
 exec {{config.zeo_instance}}/bin/runzeo
+"""
+
+    pack_start_script_template = """\
+#!/bin/sh
+cd {{env.base_path}}
+exec {{env.base_path}}/bin/pack-opencore-zeo
 """
 
     actions = [
@@ -992,6 +1508,19 @@ exec {{config.zeo_instance}}/bin/runzeo
                         '{{env.var}}/zeo'),
         # ZEO doesn't really have a uri
         tasks.InstallSupervisorConfig(script_name='opencore-zeo'),
+        tasks.EnsureFile('Write the ZODB pack script',
+                         '{{env.base_path}}/bin/pack-opencore-zeo',
+                         content_path='%s/zeo_pack.py_tmpl' % files_dir,
+                         svn_add=True, executable=True, overwrite=True),
+        tasks.EnsureFile('Write the ZODB pack job start script',
+                         '{{env.base_path}}/bin/start-opencore-zeo-pack',
+                         content=pack_start_script_template,
+                         svn_add=True, executable=True, overwrite=True),
+        tasks.ConditionalTask('Install the ZODB pack job if zeo_pack is set',
+                              ('{{config.zeo_pack}}',
+                               tasks.InstallSupervisorConfig(script_name='opencore-zeo-pack')),
+                              (True,
+                               tasks.RemoveSupervisorConfig(script_name='opencore-zeo-pack'))),
         RunZopeScriptsWithZeo(
             tasks.ConditionalTask('Run initial zope ctl to bypass failure-on-first-start',
                                   ('{{os.path.exists(env.base_path + "/opencore/src/opencore/do_nothing.py")}}',
@@ -1011,6 +1540,9 @@ exec {{config.zeo_instance}}/bin/runzeo
         ]
 
 
+    def zeo_pack_window(self):
+        return parse_time_window(self.interpolate('{{config.zeo_pack_window}}'))
+
     depends_on_projects = ['fassembler:opencore']
 
 
@@ -1029,6 +1561,13 @@ class MaildropProject(OpenCoreBase):
                 "useful if you already have another ZEO instance running "
                 "and you know your database is fully set up "
                 "(i.e. when building an upgrade in parallel to a running site)"),
+        Setting('batch_zopectl_scripts',
+                default='true',
+                help="Run all the zopectl scripts in one Zope process (instead of "
+                "starting Zope for each script)"),
+        Setting('zeo_timeout',
+                default='30',
+                help='Seconds to wait for ZEO to start or stop'),
         Setting('smtp_host',
                 default='localhost',
                 help='Host to send mail to'),
@@ -1104,9 +1643,12 @@ execfile(config_location)
 
 if __name__ == '__main__':
     if len(sys.argv) < 4:
-        print 'Usage: %s TARBALL_VERSION TARBALL_URL_DIR ZOPE_SOURCE_URL' % sys.argv[0]
+        print 'Usage: %s TARBALL_VERSION TARBALL_URL_DIR ZOPE_SOURCE_URL [COMPRESS_JOBS]' % sys.argv[0]
         sys.exit()
-    make_tarball(sys.argv[1], sys.argv[2], sys.argv[3])
+    compress_jobs = None
+    if len(sys.argv) > 4:
+        compress_jobs = int(sys.argv[4])
+    make_tarball(sys.argv[1], sys.argv[2], sys.argv[3], compress_jobs)
 
 class CopyExtraZopeConfig(ZopeConfigTask):
 
@@ -1239,6 +1781,25 @@ exec {{config.zope_instance}}/bin/runzope -X debug-mode={{if config.debug!='0'}}
         Setting('zope_tarball_version',
                 default='2.9.9openplans.1',
                 help='Version suffix for the Zope source tarball'),
+        Setting('zserver_threads',
+                default='{{project.zope_tuning()["zserver_threads"]}}',
+                inherit_config=('general', 'zserver_threads'),
+                help='Number of threads serving requests in Zope (by default based on the '
+                'number of CPUs, shared by num_extra_zopes+1 instances)'),
+        Setting('zodb_cache_size',
+                default='{{project.zope_tuning()["zodb_cache_size"]}}',
+                inherit_config=('general', 'zodb_cache_size'),
+                help='Size of the ZODB cache of each Zope thread, in objects (by default '
+                'based on the memory, shared by num_extra_zopes+1 instances)'),
+        Setting('zeo_client_cache_size',
+                default='{{project.zope_tuning()["zeo_client_cache_size"]}}',
+                inherit_config=('general', 'zeo_client_cache_size'),
+                help='Size of the ZEO client cache of this Zope (like 500MB; by default '
+                'based on the memory, shared by num_extra_zopes+1 instances)'),
+        Setting('zeo_client_name',
+                default='{{config.zope_instance_name}}',
+                help='Name of the persistent ZEO client cache (empty to use a temporary '
+                'cache, that is lost when Zope restarts)'),
 
         ]
 
@@ -1286,3 +1847,6 @@ exec {{config.zope_instance}}/bin/runzope -X debug-mode={{if config.debug!='0'}}
                      cwd='{{env.base_path}}/opencore/src/zcmlloader'),
         
         ]
+
+    # Uses the opencore virtualenv and Zope installation:
+    depends_on_projects = ['fassembler:topp', 'fassembler:opencore']
@@ -1,4 +1,11 @@
+import os
 import subprocess
+import threading
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python 2.4
+    from sha import new as sha1
 
 def asbool(obj):
     if isinstance(obj, (str, unicode)):
@@ -22,3 +29,61 @@ def popen(args, raise_on_returncode=True, **kw):
         raise OSError("Running %r failed.\nOutput:\n%s" %
                       (' '.join(args), stderr or stdout))
     return proc.returncode, stdout, stderr
+
+def cpu_count():
+    """
+    The number of CPUs this computer has (1 if that can't be found
+    out).
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        count = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        count = 0
+    return max(count, 1)
+
+class DirectoryLock(object):
+    """
+    An exclusive lock on a directory, shared between processes (using
+    ``flock``).  Used to serialize changes to shared files when
+    several fassembler processes work in the same base path.
+
+    The lock can be acquired more than once by the same thread; it is
+    freed when it has been released as many times.  Other threads in
+    the process wait for it like other processes do.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.depth = 0
+        # flock is per process, so the threads take turns with this:
+        self._thread_lock = threading.RLock()
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            if not self.depth:
+                import fcntl
+                fd = os.open(self.path, os.O_RDONLY)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self.fd = fd
+        except:
+            self._thread_lock.release()
+            raise
+        self.depth += 1
+
+    def release(self):
+        try:
+            self.depth -= 1
+            if not self.depth:
+                import fcntl
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self._thread_lock.release()
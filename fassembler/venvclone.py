@@ -0,0 +1,128 @@
+"""
+Makes new virtualenvs by cloning a template virtualenv (used by
+``tasks.VirtualEnv`` when the ``virtualenv_template`` setting is on).
+
+The files of the template are hard linked into the new environment,
+except for the files that have the location of the environment in
+them or that get changed in place later (scripts, ``.pth`` files,
+``distutils.cfg``...); those are copied, with the template's location
+replaced by the new one.  This is the same kind of fixing up
+``make_environment_relocatable`` does in ``fassembler-boot.py``, but
+to absolute paths.  Compiled files (``.pyc``, ``.pyo``) are left out:
+Python may rewrite them in place, and they have the template's
+location in them; they are compiled again in the new environment.
+"""
+
+import os
+import shutil
+
+# Files with these extensions (and everything in bin/) are copied
+# instead of linked:
+copy_extensions = ['.pth', '.cfg', '.egg-link', '.txt', '.sh', '.csh', '.fish']
+
+# Compiled files, which are not cloned:
+compiled_extensions = ['.pyc', '.pyo']
+
+# The file in a template that records where it was created:
+info_filename = 'fassembler-template.txt'
+
+def read_template_location(template):
+    """
+    Returns the path the template was created at; the scripts and
+    files in the template refer to that path.
+    """
+    f = open(os.path.join(template, info_filename))
+    try:
+        for line in f:
+            if line.startswith('location:'):
+                return line.split(':', 1)[1].strip()
+    finally:
+        f.close()
+    return template
+
+def write_template_location(template, location, description):
+    f = open(os.path.join(template, info_filename), 'w')
+    f.write('# Written by fassembler; a template virtualenv\n')
+    f.write('location: %s\n' % location)
+    f.write('description: %s\n' % description)
+    f.close()
+
+def is_compiled(relpath):
+    return os.path.splitext(relpath)[1] in compiled_extensions
+
+def should_copy(relpath):
+    if relpath.split(os.path.sep, 1)[0] == 'bin':
+        return True
+    for ext in copy_extensions:
+        if relpath.endswith(ext):
+            return True
+    return False
+
+def clone_environment(template, dest, logger):
+    """
+    Clones the virtualenv ``template`` to ``dest``.  If ``dest``
+    already exists the files from the template replace the ones there
+    (like re-running virtualenv on an environment); other files are
+    left alone.
+    """
+    old_location = read_template_location(template)
+    dest = os.path.abspath(dest)
+    linked = copied = skipped = 0
+    for dirpath, dirnames, filenames in os.walk(template):
+        reldir = dirpath[len(template):].lstrip(os.path.sep)
+        dest_dir = os.path.join(dest, reldir)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        # os.walk lists symlinks to directories with the directories:
+        for name in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, name)):
+                dirnames.remove(name)
+                filenames.append(name)
+        for name in filenames:
+            if not reldir and name == info_filename:
+                continue
+            source = os.path.join(dirpath, name)
+            relpath = os.path.join(reldir, name)
+            target = os.path.join(dest_dir, name)
+            if os.path.lexists(target):
+                # Never write into the existing file; it may be a
+                # link to the template:
+                os.unlink(target)
+            if is_compiled(relpath) and not os.path.islink(source):
+                skipped += 1
+                continue
+            if os.path.islink(source):
+                link = os.readlink(source)
+                if link.startswith(old_location):
+                    link = dest + link[len(old_location):]
+                os.symlink(link, target)
+            elif should_copy(relpath):
+                copy_fixed_up(source, target, old_location, dest)
+                copied += 1
+            else:
+                try:
+                    os.link(source, target)
+                    linked += 1
+                except OSError, e:
+                    # E.g., the template is on another filesystem
+                    logger.debug('Cannot link %s (%s); copying' % (relpath, e))
+                    shutil.copy2(source, target)
+                    copied += 1
+    logger.info('Cloned virtualenv %s to %s (%s files linked, %s copied, '
+                '%s compiled files left out)'
+                % (template, dest, linked, copied, skipped))
+
+def copy_fixed_up(source, target, old_location, new_location):
+    """
+    Copies the file, replacing ``old_location`` with ``new_location``
+    if it is a text file.
+    """
+    f = open(source, 'rb')
+    content = f.read()
+    f.close()
+    if '\0' not in content[:1024]:
+        content = content.replace(old_location, new_location)
+    f = open(target, 'wb')
+    f.write(content)
+    f.close()
+    shutil.copymode(source, target)
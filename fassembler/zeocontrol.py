@@ -0,0 +1,401 @@
+"""
+Starting and stopping the opencore ZEO server, and waiting for it.
+
+Instead of running ``zeoctl status`` once a second, this looks at the
+ZEO server directly: ZEO is up when something accepts connections at
+its address (the ``address`` in the ``<zeo>`` section of
+``zeo.conf``), and it is down when its processes (found out from the
+zdrun control socket, the ``socket-name`` in ``<runner>``) are gone.
+Both are checked with an exponential backoff, starting at a few
+milliseconds.
+
+Once started, ZEO is kept running for the rest of the fassembler run
+(``ZEOSession``), so that the projects after the first don't have to
+wait for ZEO to open ``Data.fs`` again; it is stopped at the end of
+the run.
+"""
+
+import errno
+import os
+import re
+import socket
+import tempfile
+import time
+from fassembler.util import DirectoryLock, sha1
+
+# The first and the longest wait between checks, in seconds:
+first_delay = 0.005
+max_delay = 0.5
+
+class ZEOTimeout(Exception):
+    """
+    Raised when ZEO doesn't start or stop in time.
+    """
+
+def wait_for(check, timeout, first_delay=first_delay, max_delay=max_delay):
+    """
+    Calls ``check()`` until it returns true, waiting twice as long
+    each time (up to ``max_delay``).  Returns false if ``check`` still
+    wasn't true after ``timeout`` seconds.
+    """
+    deadline = time.time() + timeout
+    delay = first_delay
+    while 1:
+        if check():
+            return True
+        now = time.time()
+        if now >= deadline:
+            return False
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, max_delay)
+
+_define_re = re.compile(r'^%define\s+(\w+)\s+(.*)$')
+_section_re = re.compile(r'^<(/?)(\w+)')
+_var_re = re.compile(r'\$(\w+)|\$\{(\w+)\}')
+
+def read_zeo_conf(filename):
+    """
+    Reads the settings fassembler needs from a ``zeo.conf`` file:
+    returns a dictionary with ``'address'`` (from ``<zeo>``) and
+    ``'socket-name'`` (from ``<runner>``), with any ``%define``
+    variables substituted.  This is not a full ZConfig parser.
+    """
+    defines = {}
+    result = {}
+    section = None
+    def substitute(match):
+        name = match.group(1) or match.group(2)
+        return defines.get(name.lower(), match.group(0))
+    f = open(filename)
+    try:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = _define_re.match(line)
+            if match:
+                defines[match.group(1).lower()] = _var_re.sub(substitute, match.group(2).strip())
+                continue
+            match = _section_re.match(line)
+            if match:
+                if match.group(1):
+                    section = None
+                else:
+                    section = match.group(2).lower()
+                continue
+            parts = line.split(None, 1)
+            if len(parts) < 2:
+                continue
+            key = parts[0].lower()
+            if (section, key) in (('zeo', 'address'), ('runner', 'socket-name')):
+                result[key] = _var_re.sub(substitute, parts[1].strip())
+    finally:
+        f.close()
+    return result
+
+def parse_address(address):
+    """
+    Turns a ZEO address (``host:port``, ``port``, or the path of a
+    Unix socket) into ``(family, address)`` for ``socket``.
+    """
+    if '/' in address:
+        return socket.AF_UNIX, address
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = '', address
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+def can_connect(family, address):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(address)
+        except socket.error:
+            return False
+        return True
+    finally:
+        sock.close()
+
+def zdrun_command(socket_name, command):
+    """
+    Sends a command to the zdrun daemon manager through its control
+    socket, returning the response, or None if zdrun isn't running.
+    """
+    if not os.path.exists(socket_name):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_name)
+            sock.sendall(command + '\n')
+            response = []
+            while 1:
+                data = sock.recv(1000)
+                if not data:
+                    break
+                response.append(data)
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+    return ''.join(response)
+
+def zdrun_pids(socket_name):
+    """
+    Returns the process ids of zdrun and of the program it runs (0 if
+    it isn't running), or None if zdrun isn't running.
+    """
+    response = zdrun_command(socket_name, 'status')
+    if response is None:
+        return None
+    status = {}
+    for line in response.splitlines():
+        if '=' in line:
+            key, value = line.split('=', 1)
+            status[key.strip()] = value.strip()
+    try:
+        return int(status.get('manager', 0)), int(status.get('application', 0))
+    except ValueError:
+        return None
+
+def pid_exists(pid):
+    """
+    True if the process is still running (an exited process that
+    hasn't been reaped yet, a zombie, doesn't count).
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+        # EPERM: it exists, but isn't ours
+    try:
+        f = open('/proc/%d/stat' % pid)
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+    except IOError:
+        # Gone, or no /proc
+        return not os.path.exists('/proc/self')
+    # The state comes after the command name, which is in parentheses:
+    return stat[stat.rfind(')')+1:].split()[0] != 'Z'
+
+class ZEOController(object):
+    """
+    Starts and stops the ZEO server configured in ``conf_path`` (with
+    ``zeoctl_path`` for starting it), waiting up to ``timeout``
+    seconds for it.  ``conf`` is what ``read_zeo_conf`` returns; it is
+    read from ``conf_path`` if not given.
+    """
+
+    def __init__(self, zeoctl_path, conf_path, timeout, maker, logger, conf=None):
+        self.zeoctl_path = zeoctl_path
+        self.conf_path = conf_path
+        self.timeout = timeout
+        self.maker = maker
+        self.logger = logger
+        if conf is None:
+            conf = read_zeo_conf(conf_path)
+        if 'address' not in conf or 'socket-name' not in conf:
+            raise Exception('Cannot find the ZEO address and the zdrun socket-name in %s'
+                            % conf_path)
+        self.address = conf['address']
+        self.family, self.sock_address = parse_address(conf['address'])
+        self.socket_name = conf['socket-name']
+
+    def is_running(self):
+        pids = zdrun_pids(self.socket_name)
+        return pids is not None and pids[1] != 0
+
+    def is_accepting(self):
+        return can_connect(self.family, self.sock_address)
+
+    def start(self):
+        if self.is_running():
+            raise Exception('Zeo is running already. Please stop zeo before running.')
+        start = time.time()
+        self.maker.run_command([self.zeoctl_path, 'start'])
+        if not wait_for(self.is_accepting, self.timeout):
+            raise ZEOTimeout('ZEO did not start accepting connections at %s in %s seconds'
+                             % (self.address, self.timeout))
+        self.logger.info('ZEO is accepting connections at %s (%.2fs)'
+                         % (self.address, time.time() - start))
+
+    def stop(self):
+        pids = zdrun_pids(self.socket_name)
+        if pids is None or not pids[1]:
+            raise Exception('Expected Zeo to be running but it is not.')
+        start = time.time()
+        self.logger.info('Stopping ZEO (zdrun pid %s, ZEO pid %s)' % pids)
+        zdrun_command(self.socket_name, 'stop')
+        def stopped():
+            for pid in pids:
+                if pid and pid_exists(pid):
+                    return False
+            return True
+        if not wait_for(stopped, self.timeout):
+            raise ZEOTimeout('ZEO (pids %s) did not stop in %s seconds'
+                             % (', '.join([str(pid) for pid in pids if pid]), self.timeout))
+        self.logger.info('ZEO stopped (%.2fs)' % (time.time() - start))
+
+def file_digest(filename):
+    f = open(filename, 'rb')
+    try:
+        return sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+class ZEOSession(object):
+    """
+    The ZEO server shared by all the tasks of a run: the first task
+    that needs ZEO starts it, and the tasks after it use the same
+    server.  It is stopped by ``maker.run_cleanups()``, at the end of
+    the run.  Get it with ``get_session(maker, logger)``.
+
+    When projects are built in worker processes (``--jobs``), the
+    session is ``share()``d before the workers are forked: the server
+    a worker starts is recorded in a file, so that the workers after
+    it use the same server, and it is only stopped by the process
+    that made the session.
+    """
+
+    def __init__(self, maker, logger):
+        self.maker = maker
+        self.logger = logger
+        # The controller of the ZEO server this session started, and
+        # the sha1 of its zeo.conf then:
+        self.controller = None
+        self.conf_digest = None
+        # Set by share():
+        self.state_filename = None
+        self.state_lock = None
+        self.pid = os.getpid()
+
+    def share(self):
+        """
+        Keeps the state of the session in a file from now on, so that
+        forked processes share the server.
+        """
+        if self.state_filename is not None:
+            return
+        fd, self.state_filename = tempfile.mkstemp(prefix='fassembler-zeo-', suffix='.txt')
+        os.close(fd)
+        self.state_lock = DirectoryLock(self.state_filename)
+        self.save_state()
+
+    def acquire(self, controller, before_start=None):
+        """
+        Makes sure the ZEO server of ``controller`` is running,
+        starting it unless this session started it already (and its
+        ``zeo.conf`` is unchanged since).  ``before_start()`` is
+        called before starting ZEO.  Returns true if ZEO was started.
+        """
+        if self.state_lock is not None:
+            self.state_lock.acquire()
+        try:
+            self.load_state()
+            conf_digest = file_digest(controller.conf_path)
+            current = self.controller
+            if current is not None:
+                if (os.path.abspath(current.conf_path) == os.path.abspath(controller.conf_path)
+                    and self.conf_digest == conf_digest and current.is_accepting()):
+                    self.logger.notify('Using the ZEO server already running at %s'
+                                       % current.address)
+                    return False
+                if current.is_running():
+                    self.logger.notify('Restarting ZEO (its configuration changed)')
+                self.stop()
+            if before_start is not None:
+                before_start()
+            controller.start()
+            self.controller = controller
+            self.conf_digest = conf_digest
+            self.save_state()
+            return True
+        finally:
+            if self.state_lock is not None:
+                self.state_lock.release()
+
+    def release(self):
+        """
+        Stops ZEO, if this session started it and it is still running.
+        In a forked process (see ``share()``) this does nothing; the
+        process that made the session stops ZEO.
+        """
+        if os.getpid() != self.pid:
+            return
+        if self.state_lock is not None:
+            self.state_lock.acquire()
+        try:
+            self.load_state()
+            self.stop()
+        finally:
+            if self.state_lock is not None:
+                self.state_lock.release()
+        if self.state_filename is not None:
+            os.unlink(self.state_filename)
+            self.state_filename = self.state_lock = None
+
+    def stop(self):
+        controller = self.controller
+        if controller is None:
+            return
+        self.controller = None
+        self.conf_digest = None
+        self.save_state()
+        if controller.is_running():
+            controller.stop()
+            self.logger.notify('Zeo stopped')
+
+    # The attributes of the controller kept in the state file:
+    state_keys = ['zeoctl_path', 'conf_path', 'timeout', 'address', 'socket_name']
+
+    def load_state(self):
+        """
+        Reads the server started by any process sharing the session.
+        """
+        if self.state_filename is None:
+            return
+        state = {}
+        f = open(self.state_filename)
+        try:
+            for line in f:
+                if '=' in line:
+                    name, value = line.rstrip('\n').split('=', 1)
+                    state[name] = value
+        finally:
+            f.close()
+        if not state:
+            self.controller = self.conf_digest = None
+            return
+        self.controller = ZEOController(
+            state['zeoctl_path'], state['conf_path'], float(state['timeout']),
+            self.maker, self.logger,
+            conf={'address': state['address'], 'socket-name': state['socket_name']})
+        self.conf_digest = state['conf_digest']
+
+    def save_state(self):
+        if self.state_filename is None:
+            return
+        # Written in place, as the file is also the lock:
+        f = open(self.state_filename, 'w')
+        try:
+            if self.controller is not None:
+                for name in self.state_keys:
+                    f.write('%s=%s\n' % (name, getattr(self.controller, name)))
+                f.write('conf_digest=%s\n' % self.conf_digest)
+        finally:
+            f.close()
+
+def get_session(maker, logger):
+    """
+    Returns the ``ZEOSession`` of this run, creating it the first
+    time.
+    """
+    session = maker.services.get('zeo')
+    if session is None:
+        session = maker.services['zeo'] = ZEOSession(maker, logger)
+        maker.add_cleanup(session.release)
+    return session
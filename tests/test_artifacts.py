@@ -0,0 +1,123 @@
+"""
+Tests for unpacking tarballs incrementally
+(``fassembler.artifacts.update_stream``).
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+from cStringIO import StringIO
+from cmdutils import Logger
+from fassembler import artifacts
+
+def make_tarball(files, symlinks=None):
+    """
+    A gzipped tarball (in a file-like object) with ``files`` (``{path:
+    content}``) and ``symlinks`` (``{path: target}``).
+    """
+    out = StringIO()
+    tar = tarfile.open(fileobj=out, mode='w:gz')
+    for path in sorted(files):
+        info = tarfile.TarInfo(path)
+        info.size = len(files[path])
+        info.mode = 0644
+        info.mtime = time.time()
+        tar.addfile(info, StringIO(files[path]))
+    for path in sorted(symlinks or {}):
+        info = tarfile.TarInfo(path)
+        info.type = tarfile.SYMTYPE
+        info.linkname = symlinks[path]
+        tar.addfile(info)
+    tar.close()
+    return StringIO(out.getvalue())
+
+def write_file(filename, content):
+    f = open(filename, 'w')
+    f.write(content)
+    f.close()
+
+def read_file(filename):
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class UpdateStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.logger = Logger([])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def update(self, files, symlinks=None):
+        return artifacts.update_stream(make_tarball(files, symlinks), self.dest, self.logger)
+
+    def path(self, path):
+        return os.path.join(self.dest, path)
+
+    def test_first_update_writes_everything(self):
+        count = self.update({'a.txt': 'a', 'sub/b.txt': 'b'}, {'link': 'a.txt'})
+        self.assertEqual(count, 3)
+        self.assertEqual(read_file(self.path('a.txt')), 'a')
+        self.assertEqual(read_file(self.path('sub/b.txt')), 'b')
+        self.assertEqual(os.readlink(self.path('link')), 'a.txt')
+        manifest = artifacts.read_manifest(self.dest)
+        self.assertEqual(sorted(manifest), ['a.txt', 'link', 'sub/b.txt'])
+        self.assertEqual(manifest['a.txt'], (1, artifacts.file_sha1(self.path('a.txt'))))
+        self.assertEqual(manifest['link'], (0, 'symlink'))
+
+    def test_only_changed_files_are_written(self):
+        self.update({'same.txt': 'same', 'changed.txt': 'old'})
+        same_inode = os.stat(self.path('same.txt')).st_ino
+        changed_inode = os.stat(self.path('changed.txt')).st_ino
+        self.update({'same.txt': 'same', 'changed.txt': 'new'})
+        self.assertEqual(read_file(self.path('changed.txt')), 'new')
+        # Files are written by renaming a new file over them:
+        self.assertEqual(os.stat(self.path('same.txt')).st_ino, same_inode)
+        self.assertNotEqual(os.stat(self.path('changed.txt')).st_ino, changed_inode)
+
+    def test_same_size_change_is_written(self):
+        self.update({'a.txt': 'one'})
+        self.update({'a.txt': 'two'})
+        self.assertEqual(read_file(self.path('a.txt')), 'two')
+
+    def test_unrecorded_file_is_compared(self):
+        # A file that is there already (without a manifest) with the
+        # same content is left alone:
+        write_file(self.path('a.txt'), 'a')
+        inode = os.stat(self.path('a.txt')).st_ino
+        self.update({'a.txt': 'a'})
+        self.assertEqual(os.stat(self.path('a.txt')).st_ino, inode)
+
+    def test_removed_files(self):
+        self.update({'keep.txt': 'k', 'old/gone.txt': 'g', 'edited.txt': 'e'},
+                    {'link': 'keep.txt'})
+        write_file(self.path('edited.txt'), 'changed here')
+        self.update({'keep.txt': 'k'})
+        self.assert_(os.path.exists(self.path('keep.txt')))
+        self.assert_(not os.path.exists(self.path('old/gone.txt')))
+        # The directory it leaves empty is removed too:
+        self.assert_(not os.path.exists(self.path('old')))
+        self.assert_(not os.path.lexists(self.path('link')))
+        # Changed locally, so it is kept:
+        self.assertEqual(read_file(self.path('edited.txt')), 'changed here')
+        self.assertEqual(sorted(artifacts.read_manifest(self.dest)), ['keep.txt'])
+
+    def test_changed_symlink(self):
+        self.update({'a.txt': 'a', 'b.txt': 'b'}, {'link': 'a.txt'})
+        self.update({'a.txt': 'a', 'b.txt': 'b'}, {'link': 'b.txt'})
+        self.assertEqual(os.readlink(self.path('link')), 'b.txt')
+
+    def test_members_outside_dest_are_skipped(self):
+        self.update({'../outside.txt': 'x', 'inside.txt': 'y'})
+        self.assert_(not os.path.exists(os.path.join(os.path.dirname(self.dest), 'outside.txt')))
+        self.assertEqual(read_file(self.path('inside.txt')), 'y')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""
+Tests for the fingerprints that let ``Project.run`` skip incremental
+tasks (``fassembler.buildstate``).
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from cmdutils import Logger
+from fassembler import tasks
+from fassembler.buildstate import BuildState, fingerprint_task
+from fassembler.environ import Environment
+from fassembler.filemaker import Maker
+from fassembler.project import Project, Setting
+
+class Counter(tasks.Task):
+    """
+    Counts how many times it ran (in ``runs``).
+    """
+
+    incremental = True
+    runs = None
+
+    def __init__(self, name, stacklevel=1):
+        super(Counter, self).__init__(name, stacklevel=stacklevel+1)
+
+    def run(self):
+        self.runs.append(self.name)
+
+class AlwaysCounter(Counter):
+    incremental = False
+
+class SampleProject(Project):
+    name = 'sample'
+    title = 'Sample project'
+    settings = [
+        Setting('port', default='8080', help='Port'),
+        Setting('skel', default='{{env.base_path}}/skel', help='Files to copy'),
+        ]
+    actions = [
+        tasks.CopyDir('Copy the skeleton', '{{config.skel}}', 'etc/copy'),
+        tasks.EnsureFile('Write the config', 'etc/sample.conf',
+                         content='port = {{config.port}}\n', force_overwrite=True),
+        Counter('Count'),
+        AlwaysCounter('Always count'),
+        ]
+
+def write_file(filename, content):
+    f = open(filename, 'w')
+    f.write(content)
+    f.close()
+
+def read_file(filename):
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class ProjectRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.base, 'etc'))
+        os.mkdir(os.path.join(self.base, 'skel'))
+        write_file(os.path.join(self.base, 'skel', 'app.ini_tmpl'),
+                   'port = {{config.port}}\n')
+        self.logger = Logger([])
+        self.runs = []
+        Counter.runs = self.runs
+        self.set_port('8080')
+
+    def tearDown(self):
+        Counter.runs = None
+        shutil.rmtree(self.base)
+
+    def set_port(self, port):
+        write_file(os.path.join(self.base, 'etc', 'build.ini'),
+                   '[general]\nvar = %s/var\n\n[sample]\nport = %s\n' % (self.base, port))
+
+    def run_project(self, force_tasks=None, resume=False):
+        environ = Environment(self.base, self.logger)
+        maker = Maker(self.base, self.logger, interactive=False,
+                      force_tasks=force_tasks, resume=resume)
+        environ.maker = maker
+        project = SampleProject('sample', maker, environ, self.logger, environ.config)
+        project.run()
+
+    def test_unchanged_tasks_are_skipped(self):
+        self.run_project()
+        self.run_project()
+        self.assertEqual(self.runs, ['Count', 'Always count', 'Always count'])
+
+    def test_forced_task_runs(self):
+        self.run_project()
+        self.run_project(force_tasks=['Count'])
+        self.assertEqual(self.runs, ['Count', 'Always count', 'Count', 'Always count'])
+
+    def test_resume_after_complete_build(self):
+        # A build that finished leaves nothing to resume:
+        self.run_project()
+        self.run_project(resume=True)
+        self.assertEqual(self.runs, ['Count', 'Always count', 'Always count'])
+
+    def test_changed_setting_rewrites_file(self):
+        self.run_project()
+        self.set_port('9090')
+        self.run_project()
+        self.assertEqual(read_file(os.path.join(self.base, 'etc', 'sample.conf')),
+                         'port = 9090\n')
+        self.assertEqual(read_file(os.path.join(self.base, 'etc', 'copy', 'app.ini')),
+                         'port = 9090\n')
+        # The task after it runs again too:
+        self.assertEqual(self.runs, ['Count', 'Always count', 'Count', 'Always count'])
+
+    def test_removed_file_is_written_again(self):
+        self.run_project()
+        os.unlink(os.path.join(self.base, 'etc', 'sample.conf'))
+        os.unlink(os.path.join(self.base, 'etc', 'copy', 'app.ini'))
+        self.run_project()
+        self.assert_(os.path.exists(os.path.join(self.base, 'etc', 'sample.conf')))
+        self.assert_(os.path.exists(os.path.join(self.base, 'etc', 'copy', 'app.ini')))
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.logger = Logger([])
+        self.maker = Maker(self.base, self.logger, interactive=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def make_task(self, files, data):
+        task = Counter('Count')
+        task.maker = self.maker
+        task.logger = self.logger
+        task.fingerprint_files = lambda: files
+        task.fingerprint_data = lambda: data
+        return task
+
+    def test_fingerprint_changes(self):
+        filename = os.path.join(self.base, 'input.txt')
+        write_file(filename, 'one')
+        fingerprint = fingerprint_task(self.make_task([filename], ['a']), '')
+        self.assertEqual(fingerprint, fingerprint_task(self.make_task([filename], ['a']), ''))
+        self.assertNotEqual(fingerprint, fingerprint_task(self.make_task([filename], ['a']), 'x'))
+        self.assertNotEqual(fingerprint, fingerprint_task(self.make_task([filename], ['b']), ''))
+        write_file(filename, 'two')
+        self.assertNotEqual(fingerprint, fingerprint_task(self.make_task([filename], ['a']), ''))
+
+    def test_build_state(self):
+        filename = os.path.join(self.base, 'var', 'state.txt')
+        state = BuildState(filename, self.maker, self.logger)
+        state.set('fingerprint', 'sample', '0 A\ttask', 'abc')
+        state.save()
+        state = BuildState(filename, self.maker, self.logger)
+        self.assertEqual(state.get('fingerprint', 'sample', '0 A\ttask'), 'abc')
+        state.clear('fingerprint', 'sample')
+        self.assertEqual(state.get('fingerprint', 'sample', '0 A\ttask'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Tests for the memoized settings of ``fassembler.namespace``.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from cmdutils import Logger
+from fassembler import tasks
+from fassembler.environ import Environment
+from fassembler.filemaker import Maker
+from fassembler.project import Project, Setting
+
+class Record(tasks.Task):
+    """
+    Records the interpolated ``value`` in ``values``.
+    """
+
+    value = tasks.interpolated('value')
+    values = None
+
+    def __init__(self, name, value, stacklevel=1):
+        super(Record, self).__init__(name, stacklevel=stacklevel+1)
+        self.value = value
+
+    def run(self):
+        self.values.append(self.value)
+
+class SampleProject(Project):
+    name = 'sample'
+    title = 'Sample project'
+    settings = [
+        Setting('port', default='8080', help='Port'),
+        Setting('url', default='http://localhost:{{config.port}}/', help='URL'),
+        Setting('marker_exists',
+                default='{{os.path.exists(env.base_path + "/marker")}}',
+                help='Whether the marker file was written'),
+        Setting('label', default='{{task.name}} on {{config.port}}',
+                help='Refers to the task'),
+        ]
+    actions = [
+        Record('Before', '{{config.marker_exists}}'),
+        tasks.EnsureFile('Write the marker', 'marker', content='x'),
+        Record('After', '{{config.marker_exists}}'),
+        ]
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.base, 'etc'))
+        f = open(os.path.join(self.base, 'etc', 'build.ini'), 'w')
+        f.write('[general]\nvar = %s/var\n' % self.base)
+        f.close()
+        self.logger = Logger([])
+        self.environ = Environment(self.base, self.logger)
+        self.maker = Maker(self.base, self.logger, interactive=False)
+        self.environ.maker = self.maker
+        self.project = SampleProject('sample', self.maker, self.environ, self.logger,
+                                     self.environ.config)
+        self.project.setup_config()
+        Record.values = []
+
+    def tearDown(self):
+        Record.values = None
+        shutil.rmtree(self.base)
+
+    def test_changed_option_is_resolved_again(self):
+        self.assertEqual(self.project.interpolate('{{config.url}}'), 'http://localhost:8080/')
+        self.environ.config.set('sample', 'port', '9090')
+        self.assertEqual(self.project.interpolate('{{config.url}}'), 'http://localhost:9090/')
+
+    def test_setting_refers_to_task(self):
+        self.project.bind_tasks()
+        before, write, after = self.project.actions
+        self.assertEqual(before.interpolate('{{config.label}}'), 'Before on 8080')
+        self.assertEqual(after.interpolate('{{config.label}}'), 'After on 8080')
+        self.assertEqual(before.interpolate('{{config.label}}'), 'Before on 8080')
+        self.environ.config.set('sample', 'port', '9090')
+        self.assertEqual(after.interpolate('{{config.label}}'), 'After on 9090')
+
+    def test_values_are_resolved_again_for_each_task(self):
+        self.project.run()
+        self.assertEqual(Record.values, ['False', 'True'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Tests for compressing and decompressing bzip2 in several processes
+(``fassembler.parallelbz2``).
+"""
+
+import bz2
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from fassembler import parallelbz2
+
+def sample_data(size):
+    """
+    Data that compresses somewhat, but not to nothing.
+    """
+    rand = random.Random(size)
+    words = ['fassembler', 'zope', 'opencore', 'bzip2', 'stream', 'block']
+    parts = []
+    length = 0
+    while length < size:
+        part = '%s %s\n' % (rand.choice(words), rand.randint(0, 1000000))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)[:size]
+
+def read_all(reader, size=-1):
+    parts = []
+    while 1:
+        data = reader.read(size)
+        if not data:
+            break
+        parts.append(data)
+        if size < 0:
+            break
+    return ''.join(parts)
+
+class ParallelBZ2Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Small blocks, so the test data makes several streams:
+        self.old_block_size = parallelbz2.block_size
+        parallelbz2.block_size = 20000
+        self.data = sample_data(150000)
+        self.source = os.path.join(self.dir, 'data.txt')
+        f = open(self.source, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        parallelbz2.block_size = self.old_block_size
+        shutil.rmtree(self.dir)
+
+    def compress(self, jobs):
+        dest = os.path.join(self.dir, 'data.txt.bz2')
+        parallelbz2.compress_file(self.source, dest, jobs=jobs)
+        f = open(dest, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def decompress(self, compressed, jobs, size=-1):
+        reader = parallelbz2.open_stream(StringIO(compressed), jobs)
+        try:
+            return read_all(reader, size)
+        finally:
+            reader.close()
+
+    def test_compress_makes_streams(self):
+        compressed = self.compress(jobs=2)
+        streams = parallelbz2._stream_start_re.findall(compressed)
+        self.assertEqual(len(streams), 8)
+        self.assertEqual(parallelbz2.decompress_streams(compressed), (self.data, True))
+        # The same with one process:
+        self.assertEqual(self.compress(jobs=1), compressed)
+
+    def test_round_trip(self):
+        compressed = self.compress(jobs=2)
+        for jobs in 1, 2:
+            self.assertEqual(self.decompress(compressed, jobs), self.data)
+            self.assertEqual(self.decompress(compressed, jobs, size=1000), self.data)
+
+    def test_single_stream(self):
+        # An ordinary bzip2 file:
+        compressed = bz2.compress(self.data)
+        for jobs in 1, 2:
+            self.assertEqual(self.decompress(compressed, jobs, size=4096), self.data)
+
+    def test_trailing_garbage(self):
+        compressed = self.compress(jobs=2) + 'not bzip2'
+        for jobs in 1, 2:
+            self.assertEqual(self.decompress(compressed, jobs), self.data)
+
+    def test_truncated(self):
+        compressed = self.compress(jobs=2)
+        for jobs in 1, 2:
+            self.assertRaises(IOError, self.decompress, compressed[:-100], jobs)
+
+    def test_not_bzip2(self):
+        self.assertEqual(self.decompress(self.data, 2, size=100), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests for cloning virtualenvs from a template
+(``fassembler.venvclone``).
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from cmdutils import Logger
+from fassembler import venvclone
+
+def write_file(filename, content):
+    dir = os.path.dirname(filename)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    f = open(filename, 'w')
+    f.write(content)
+    f.close()
+
+def read_file(filename):
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class CloneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.template = os.path.join(self.dir, 'template')
+        self.dest = os.path.join(self.dir, 'env')
+        self.logger = Logger([])
+        write_file(os.path.join(self.template, 'bin', 'activate'),
+                   'VIRTUAL_ENV=%s\n' % self.template)
+        write_file(os.path.join(self.template, 'lib', 'mod.py'), 'x = 1\n')
+        write_file(os.path.join(self.template, 'lib', 'mod.pyc'), 'compiled')
+        write_file(os.path.join(self.template, 'lib', 'mod.pyo'), 'optimized')
+        venvclone.write_template_location(self.template, self.template, 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, *parts):
+        return os.path.join(self.dest, *parts)
+
+    def test_clone(self):
+        venvclone.clone_environment(self.template, self.dest, self.logger)
+        self.assertEqual(read_file(self.path('bin', 'activate')),
+                         'VIRTUAL_ENV=%s\n' % self.dest)
+        self.assertEqual(os.stat(self.path('lib', 'mod.py')).st_ino,
+                         os.stat(os.path.join(self.template, 'lib', 'mod.py')).st_ino)
+        self.assert_(not os.path.exists(self.path('lib', 'mod.pyc')))
+        self.assert_(not os.path.exists(self.path('lib', 'mod.pyo')))
+        self.assert_(not os.path.exists(self.path(venvclone.info_filename)))
+
+    def test_linked_compiled_files_are_removed(self):
+        # Left by a clone that linked compiled files:
+        os.makedirs(self.path('lib'))
+        os.link(os.path.join(self.template, 'lib', 'mod.pyc'), self.path('lib', 'mod.pyc'))
+        venvclone.clone_environment(self.template, self.dest, self.logger)
+        self.assert_(not os.path.exists(self.path('lib', 'mod.pyc')))
+        self.assertEqual(read_file(os.path.join(self.template, 'lib', 'mod.pyc')), 'compiled')
+
+if __name__ == '__main__':
+    unittest.main()
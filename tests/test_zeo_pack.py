@@ -0,0 +1,77 @@
+"""
+Tests for the settings of the ZODB pack job in the zeo project
+(``fassembler.topp_opencore``), and for installing and removing its
+supervisor config.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from cmdutils import Logger
+from fassembler import tasks
+from fassembler.environ import Environment
+from fassembler.filemaker import Maker
+from fassembler.project import Project, Setting
+from fassembler.topp_opencore import parse_time_window
+
+class ParseTimeWindowTest(unittest.TestCase):
+
+    def test_window(self):
+        self.assertEqual(parse_time_window('03:00-05:00'), (180, 300))
+        self.assertEqual(parse_time_window(' 3:15 - 4:45 '), (195, 285))
+
+    def test_past_midnight(self):
+        self.assertEqual(parse_time_window('23:30-01:00'), (1410, 60))
+
+    def test_bad_windows(self):
+        for value in ['', '03:00', '03:00-05:00-07:00', '24:00-01:00',
+                      '03:60-05:00', '3-5', 'night']:
+            self.assertRaises(ValueError, parse_time_window, value)
+
+class PackJobProject(Project):
+    name = 'zeo'
+    title = 'Pack job'
+    settings = [
+        Setting('zeo_pack', default='false', help='Install the pack job'),
+        ]
+    actions = [
+        tasks.ConditionalTask('Install the pack job if zeo_pack is set',
+                              ('{{config.zeo_pack}}',
+                               tasks.InstallSupervisorConfig(script_name='opencore-zeo-pack')),
+                              (True,
+                               tasks.RemoveSupervisorConfig(script_name='opencore-zeo-pack'))),
+        ]
+
+class PackJobConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.base, 'etc'))
+        self.logger = Logger([])
+        self.conf = os.path.join(self.base, 'etc', 'supervisor.d', 'opencore-zeo-pack.ini')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def run_project(self, zeo_pack):
+        f = open(os.path.join(self.base, 'etc', 'build.ini'), 'w')
+        f.write('[general]\nvar = %s/var\n\n[zeo]\nzeo_pack = %s\n' % (self.base, zeo_pack))
+        f.close()
+        environ = Environment(self.base, self.logger)
+        maker = Maker(self.base, self.logger, interactive=False)
+        environ.maker = maker
+        project = PackJobProject('zeo', maker, environ, self.logger, environ.config)
+        project.run()
+
+    def test_turned_off(self):
+        self.run_project('true')
+        self.assert_(os.path.exists(self.conf))
+        self.run_project('false')
+        self.assert_(not os.path.exists(self.conf))
+        # Nothing to remove:
+        self.run_project('false')
+        self.assert_(not os.path.exists(self.conf))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+Tests for reading ``zeo.conf`` and talking to zdrun
+(``fassembler.zeocontrol``).
+"""
+
+import copy
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from cmdutils import Logger
+from fassembler import zeocontrol
+
+zeo_conf = """\
+# A zeo.conf like the one the zeo project writes
+%define INSTANCE /usr/local/topp/opencore/zeo
+%define VAR ${INSTANCE}/var
+
+<zeo>
+  address 8100
+  read-only false
+</zeo>
+
+<filestorage 1>
+  path $var/Data.fs
+</filestorage>
+
+<eventlog>
+  <logfile>
+    path $INSTANCE/log/zeo.log
+  </logfile>
+</eventlog>
+
+<runner>
+  program $INSTANCE/bin/runzeo
+  socket-name ${VAR}/zdsock
+  address 9999
+</runner>
+"""
+
+class ReadZEOConfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'zeo.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, content):
+        f = open(self.filename, 'w')
+        f.write(content)
+        f.close()
+        return zeocontrol.read_zeo_conf(self.filename)
+
+    def test_read(self):
+        self.assertEqual(self.read(zeo_conf), {
+            'address': '8100',
+            'socket-name': '/usr/local/topp/opencore/zeo/var/zdsock'})
+
+    def test_unknown_variable(self):
+        conf = self.read('<runner>\n  socket-name $nothing/zdsock\n</runner>\n')
+        self.assertEqual(conf, {'socket-name': '$nothing/zdsock'})
+
+    def test_missing(self):
+        self.assertEqual(self.read('<filestorage 1>\n  path Data.fs\n</filestorage>\n'), {})
+
+class ParseAddressTest(unittest.TestCase):
+
+    def test_port(self):
+        self.assertEqual(zeocontrol.parse_address('8100'),
+                         (socket.AF_INET, ('localhost', 8100)))
+
+    def test_host_port(self):
+        self.assertEqual(zeocontrol.parse_address('zeo.example.com:8100'),
+                         (socket.AF_INET, ('zeo.example.com', 8100)))
+        self.assertEqual(zeocontrol.parse_address(':8100'),
+                         (socket.AF_INET, ('localhost', 8100)))
+
+    def test_unix_socket(self):
+        self.assertEqual(zeocontrol.parse_address('/var/zeo/zeo.sock'),
+                         (socket.AF_UNIX, '/var/zeo/zeo.sock'))
+
+    def test_bad_port(self):
+        self.assertRaises(ValueError, zeocontrol.parse_address, 'localhost:zeo')
+
+class ZdrunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socket_name = os.path.join(self.dir, 'zdsock')
+        self.commands = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def serve(self, response):
+        """
+        Answers one command on the control socket, like zdrun.
+        """
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_name)
+        server.listen(1)
+        def answer():
+            try:
+                conn = server.accept()[0]
+                self.commands.append(conn.recv(1000))
+                conn.sendall(response)
+                conn.close()
+            finally:
+                server.close()
+        thread = threading.Thread(target=answer)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def test_pids(self):
+        thread = self.serve('status\nmanager=100\napplication=101\nstatus=0\n')
+        self.assertEqual(zeocontrol.zdrun_pids(self.socket_name), (100, 101))
+        thread.join()
+        self.assertEqual(self.commands, ['status\n'])
+
+    def test_not_running(self):
+        self.assertEqual(zeocontrol.zdrun_pids(self.socket_name), None)
+
+    def test_wait_for(self):
+        calls = []
+        def check():
+            calls.append(1)
+            return len(calls) == 3
+        self.assert_(zeocontrol.wait_for(check, 5, first_delay=0.001))
+        self.assertEqual(len(calls), 3)
+        self.assert_(not zeocontrol.wait_for(lambda: False, 0.01, first_delay=0.001))
+
+class FakeController(zeocontrol.ZEOController):
+    """
+    Records when it is started, instead of running zeoctl.
+    """
+
+    starts = None
+
+    def start(self):
+        self.starts.append(self.conf_path)
+
+class SharedSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.logger = Logger([])
+        self.conf_path = os.path.join(self.dir, 'zeo.conf')
+        # Something for ZEO's address to connect to:
+        self.address = os.path.join(self.dir, 'zeo.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.address)
+        self.server.listen(5)
+        f = open(self.conf_path, 'w')
+        f.write('<zeo>\n  address %s\n</zeo>\n<runner>\n  socket-name %s/zdsock\n</runner>\n'
+                % (self.address, self.dir))
+        f.close()
+        self.starts = []
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def controller(self):
+        controller = FakeController('zeoctl', self.conf_path, 5, None, self.logger)
+        controller.starts = self.starts
+        return controller
+
+    def test_workers_share_server(self):
+        session = zeocontrol.ZEOSession(None, self.logger)
+        session.share()
+        state_filename = session.state_filename
+        # What a forked worker would have:
+        worker = copy.copy(session)
+        worker.pid = -1
+        self.assert_(worker.acquire(self.controller()))
+        worker.release()
+        # The next worker uses the server the first one started:
+        worker = copy.copy(session)
+        worker.pid = -1
+        self.assert_(not worker.acquire(self.controller()))
+        self.assertEqual(self.starts, [self.conf_path])
+        # The parent knows about it too:
+        session.load_state()
+        self.assertEqual(session.controller.address, self.address)
+        session.release()
+        self.assert_(not os.path.exists(state_filename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+"""
+Tests for the default Zope tuning
+(``fassembler.topp_opencore.zope_tuning``).
+"""
+
+import unittest
+from fassembler.topp_opencore import zope_tuning
+
+class ZopeTuningTest(unittest.TestCase):
+
+    def assertTuning(self, args, threads, cache_size, client_cache_size):
+        self.assertEqual(zope_tuning(*args),
+                         dict(zserver_threads=threads, zodb_cache_size=cache_size,
+                              zeo_client_cache_size=client_cache_size))
+
+    def test_small_computer(self):
+        self.assertTuning((2, 2048, 1), 4, 13000, '512MB')
+
+    def test_unknown_memory(self):
+        # The numbers used before they were computed:
+        self.assertTuning((4, None, 2), 4, 10000, '500MB')
+
+    def test_big_computer(self):
+        # Threads and caches are capped:
+        self.assertTuning((16, 65536, 1), 8, 100000, '2048MB')
+
+    def test_many_instances(self):
+        # The memory is shared between the instances, but there are
+        # lower limits:
+        self.assertTuning((1, 512, 4), 2, 5000, '100MB')
+        self.assertTuning((4, 8192, 2), 4, 26000, '1024MB')
+
+    def test_no_instances(self):
+        self.assertEqual(zope_tuning(4, 4096, 0), zope_tuning(4, 4096, 1))
+
+if __name__ == '__main__':
+    unittest.main()